@@ -1,8 +1,17 @@
 from struct import *
 from enum import Enum
+from typing import NamedTuple
+from time import perf_counter
+from xml.etree import ElementTree
 import argparse
-from StreamIO import StreamIO
-import plotly.express as px
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sys
+from StreamIO import StreamIO, get_codec, SEEK_CUR
+from MapSchema import Schema, Scalar, Value, BOOL, INT, FLOAT, POINT, VECTOR, STRING, STRING_LIST, INT_LIST, enum_name, enum_value, list_of, skip_list, write_list, list_size
 
 # Reimplementation of the Color class, as defined in .NET
 class Color:
@@ -13,51 +22,131 @@ class Color:
         self.a = a
 
 
+# One section of a map that was read: where it starts and ends in the file, how long it took
+# and how many items (things, or records for sections without things) it held
+class SectionEvent(NamedTuple):
+    section: str
+    start: int
+    end: int
+    seconds: float
+    count: int
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
+
+# Instrumentation interface for the parser. MapData calls section_start and section_end around
+# each of its big sections; the default does nothing. Pass an instance as MapData(hooks=...).
+class ParseHooks:
+    def section_start(self, section: str, offset: int):
+        pass
+
+    def section_end(self, event: SectionEvent):
+        pass
+
+
+# Sends section events to a logging.Logger, at DEBUG level by default
+class LoggingHooks(ParseHooks):
+    def __init__(self, logger: logging.Logger = None, level: int = logging.DEBUG):
+        self.logger = logger or logging.getLogger("CaelondianAtlas")
+        self.level = level
+
+    def section_start(self, section: str, offset: int):
+        self.logger.log(self.level, "reading %s at offset %d", section, offset)
+
+    def section_end(self, event: SectionEvent):
+        self.logger.log(self.level, "read %s: %d items, %d bytes in %.3f ms", event.section, event.count, event.size, event.seconds * 1000)
+
+
+# Adds up the sections of every map it sees, for the --profile table
+class ProfileHooks(ParseHooks):
+    def __init__(self):
+        # section -> [times read, bytes, seconds, items]
+        self.sections = {}
+
+    def section_end(self, event: SectionEvent):
+        totals = self.sections.setdefault(event.section, [0, 0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += event.size
+        totals[2] += event.seconds
+        totals[3] += event.count
+
+    def __str__(self) -> str:
+        lines = ["{:<16} {:>6} {:>12} {:>10} {:>10} {:>10}".format("section", "reads", "bytes", "items", "ms", "MB/s")]
+        for section, (reads, size, seconds, count) in self.sections.items():
+            lines.append("{:<16} {:>6} {:>12,} {:>10,} {:>10.2f} {:>10.1f}".format(
+                section, reads, size, count, seconds * 1000, size / 1e6 / max(seconds, 1e-9)))
+        return "\n".join(lines)
+
+
 # Reimplementation of Bastion's BinaryLoadData class, that reads and parses a binary stream from a file
 class BinaryLoadData:
-    def __init__(self, stream):
+    # set by MapData while it fills a ThingTable, see read_things
+    thing_table = None
+    # receives the section events of the map being read
+    hooks = ParseHooks()
+    # the GameDataManager things are validated against, see game_data_of
+    game_data = None
+    # set by MapData while it shares the fields of terrain tiles, see TileTemplates
+    tile_templates = None
+
+    def __init__(self, stream, intern_strings: bool = False):
         self.stream = StreamIO(stream)
+        self.read = self.stream.read_func
+        self.color_codec = self.stream.codec("4B")
+        self.vector_codec = self.stream.codec("2f")
+        self.set_intern(intern_strings)
+
+    def set_intern(self, intern_strings: bool):
+        # per-map intern table, so repeated thing names, types and groups share one str
+        self.strings = None
+        if intern_strings:
+            self.strings = {}
+            self.string = self.interned_string
+
+    def interned_string(self) -> str:
+        s = type(self).string(self)
+        return self.strings.setdefault(s, s)
+
+    def unpack(self, codec: Struct) -> tuple:
+        return codec.unpack(self.read(codec.size))
 
     def bool(self) -> bool:
-        return self.stream.read_byte()
+        return self.stream.byte_codec.unpack(self.read(1))[0]
 
     def float(self) -> float:
-        return self.stream.read_float32()
+        return self.stream.float32_codec.unpack(self.read(4))[0]
 
     def int(self) -> int:
-        return self.stream.read_int32()
+        return self.stream.int32_codec.unpack(self.read(4))[0]
 
     def int_list(self) -> list:
-        n = self.stream.read_int32()
-        l = []
-        for i in range(n):
-            l.append(self.stream.read_int32())
-
-        return l
+        n = self.int()
+        if n <= 0:
+            return []
+        return list(self.stream.read_int32_array(n))
 
     def long(self) -> int:
-        return self.stream.read_int64()
+        return self.stream.int64_codec.unpack(self.read(8))[0]
 
     def string(self) -> str:
         s = self.stream.read_string()
         return s
 
     def str_list(self) -> list:
-        n = self.stream.read_int32()
+        n = self.int()
         l = []
         for i in range(n):
-            l.append(self.stream.read_string())
+            l.append(self.string())
 
         return l
 
     def vector(self) -> tuple:
-        return (self.stream.read_float32(), self.stream.read_float32())
+        return self.vector_codec.unpack(self.read(8))
 
     def color(self) -> Color:
-        b = self.stream.read_byte()
-        g = self.stream.read_byte()
-        r = self.stream.read_byte()
-        a = self.stream.read_byte()
+        b, g, r, a = self.color_codec.unpack(self.read(4))
         return Color(
             r,
             g,
@@ -66,25 +155,221 @@ class BinaryLoadData:
         
 
     def enum(self, enum_type: Enum):
-        return enum_type[self.stream.read_string()]
+        return enum_type[self.string()]
 
     def position(self):
         return self.stream.tell()
 
+    def seek(self, offset: int):
+        self.stream.seek(offset)
+
+    def skip(self, size: int):
+        self.stream.seek(size, SEEK_CUR)
+
+    def skip_string(self):
+        self.skip(self.stream.read_int7())
+
+
+# Zero-copy variant of BinaryLoadData. Memory-maps a file (or wraps any buffer) and decodes
+# straight out of it with unpack_from and an integer cursor, so no bytes object is made per field.
+class BufferLoadData(BinaryLoadData):
+    int32_codec = get_codec("<i")
+    int64_codec = get_codec("<q")
+    float32_codec = get_codec("<f")
+    color_codec = get_codec("<4B")
+    vector_codec = get_codec("<2f")
+
+    def __init__(self, stream, intern_strings: bool = False):
+        self.mmap = None
+        self.offset = 0
+        self.set_intern(intern_strings)
+        if isinstance(stream, str):
+            with open(stream, "rb") as f:
+                buffer = self.map_file(f)
+        elif hasattr(stream, "fileno"):
+            # like BinaryLoadData, start reading wherever the file currently is
+            self.offset = stream.tell()
+            buffer = self.map_file(stream)
+        else:
+            buffer = stream
+        self.view = memoryview(buffer)
+
+    def map_file(self, f):
+        try:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty files and pipes can't be mapped
+            f.seek(self.offset)
+            self.offset = 0
+            return f.read()
+        return self.mmap
+
+    def close(self):
+        self.view.release()
+        if self.mmap is not None:
+            self.mmap.close()
+        # drop the interned string method, which refers back to the loader
+        self.__dict__.pop("string", None)
+        self.strings = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def unpack(self, codec: Struct) -> tuple:
+        v = codec.unpack_from(self.view, self.offset)
+        self.offset += codec.size
+        return v
 
-# Reimplementation of the general purpose GameDataManager in Bastion
-class GameDataManager:
-    def getUnitData(unit_name):
-        return 1
+    def bool(self) -> bool:
+        v = self.view[self.offset]
+        self.offset += 1
+        return v
+
+    def float(self) -> float:
+        (v,) = self.float32_codec.unpack_from(self.view, self.offset)
+        self.offset += 4
+        return v
+
+    def int(self) -> int:
+        (v,) = self.int32_codec.unpack_from(self.view, self.offset)
+        self.offset += 4
+        return v
+
+    def int_list(self) -> list:
+        n = self.int()
+        if n <= 0:
+            return []
+        l = list(unpack_from("<%di" % n, self.view, self.offset))
+        self.offset += 4 * n
+        return l
+
+    def long(self) -> int:
+        (v,) = self.int64_codec.unpack_from(self.view, self.offset)
+        self.offset += 8
+        return v
+
+    def int7(self) -> int:
+        index = 0
+        result = 0
+        while True:
+            byte_value = self.view[self.offset]
+            self.offset += 1
+            result |= (byte_value & 0x7F) << (7 * index)
+            if byte_value & 0x80 == 0:
+                return result
+            index += 1
 
-    def getObstacleData(cunit_name):
-        return 2
+    def string(self) -> str:
+        # decode the 7-bit length prefix inline, it is a single byte for anything under 128 chars
+        view = self.view
+        start = self.offset
+        n = view[start]
+        start += 1
+        if n & 0x80:
+            self.offset = start
+            n = (n & 0x7F) | (self.int7() << 7)
+            start = self.offset
+        self.offset = start + n
+        if n <= 0:
+            return ""
+        return str(view[start:start + n], "utf8")
+
+    def vector(self) -> tuple:
+        v = self.vector_codec.unpack_from(self.view, self.offset)
+        self.offset += 8
+        return v
+
+    def color(self) -> Color:
+        b, g, r, a = self.color_codec.unpack_from(self.view, self.offset)
+        self.offset += 4
+        return Color(
+            r,
+            g,
+            b,
+            a)
 
-    def getGeneratorData(unit_name):
-        return 3
+    def enum(self, enum_type: Enum):
+        return enum_type[self.string()]
 
-    def getLootTableData(unit_name):
-        return 4
+    def position(self):
+        return self.offset
+
+    def seek(self, offset: int):
+        self.offset = offset
+
+    def skip(self, size: int):
+        self.offset += size
+
+    def skip_string(self):
+        n = self.view[self.offset]
+        if n & 0x80:
+            n = self.int7()
+        else:
+            self.offset += 1
+        self.offset += n
+
+
+# Counterpart of BinaryLoadData for saving. The buffer is allocated once at the record's final
+# size, see serialize, and every field is packed straight into it.
+class SaveData:
+    int32_codec = get_codec("<i")
+
+    def __init__(self, size: int):
+        self.buffer = bytearray(size)
+        self.pos = 0
+
+    def pack(self, codec: Struct, *values):
+        codec.pack_into(self.buffer, self.pos, *values)
+        self.pos += codec.size
+
+    def int(self, value: int):
+        self.int32_codec.pack_into(self.buffer, self.pos, value)
+        self.pos += 4
+
+    def int_list(self, values: list):
+        n = len(values)
+        self.int(n)
+        if n:
+            pack_into("<%di" % n, self.buffer, self.pos, *values)
+            self.pos += 4 * n
+
+    def int7(self, value: int):
+        buffer = self.buffer
+        while value >= 0x80:
+            buffer[self.pos] = (value & 0x7F) | 0x80
+            self.pos += 1
+            value >>= 7
+        buffer[self.pos] = value
+        self.pos += 1
+
+    def string(self, value: str):
+        data = value.encode("utf8")
+        n = len(data)
+        if n < 0x80:
+            self.buffer[self.pos] = n
+            self.pos += 1
+        else:
+            self.int7(n)
+        self.buffer[self.pos:self.pos + n] = data
+        self.pos += n
+
+    def str_list(self, values: list):
+        self.int(len(values))
+        for value in values:
+            self.string(value)
+
+
+# Serializes a MapData, MapThing, MapThingGroup, TerrainLayerData, SpawnPointData, BloomSettings
+# or any other object with a schema, the way the game's BinaryWriter would
+def serialize(obj) -> bytearray:
+    saver = SaveData(obj.schema.size(obj))
+    obj.schema.save(saver, obj)
+    if saver.pos != len(saver.buffer):
+        raise ValueError("{} wrote {} bytes, expected {}".format(type(obj).__name__, saver.pos, len(saver.buffer)))
+    return saver.buffer
 
 
 # Reimplementation of the GameDataType enum in Bastion
@@ -123,97 +408,265 @@ class TerrainTileType(Enum):
     HUE = 1
 
 
+# Reimplementation of the general purpose GameDataManager in Bastion. Holds the unit, obstacle,
+# generator and loot table definitions from the game's data files, indexed by name. Things are
+# validated against it the way Bastion does when placing them on a map, and every (type, name)
+# pair is only resolved once. A kind with no definitions loaded accepts every name, so without a
+# data directory all things are kept.
+class GameDataManager:
+    # what a data file's name starts with -> the data type of the definitions in it
+    FILE_KINDS = {"unit": DataType.UNIT, "obstacle": DataType.OBSTACLE, "generator": DataType.GENERATOR, "loot": DataType.LOOT}
+    # accepted names resolve to a definition; this one stands in while a kind has none loaded
+    ANY = {}
+
+    def __init__(self, data_dir: str = None):
+        self.definitions = {data_type: {} for data_type in self.FILE_KINDS.values()}
+        self.clear_memo()
+        if data_dir is not None:
+            self.load_directory(data_dir)
+
+    def clear_memo(self):
+        # data type -> name -> the type the thing is loaded as, or None
+        self.memo = {data_type: {} for data_type in self.definitions}
+
+    def add(self, data_type: DataType, name: str, definition: dict = None):
+        self.definitions[data_type][name] = definition if definition is not None else {"Name": name}
+        self.clear_memo()
+
+    def load_directory(self, data_dir: str):
+        """
+        Load every XML and JSON data file under a directory. A file's kind comes from the start
+        of its name, e.g. Units.xml or LootTables.json, and files of other kinds are ignored
+        :param data_dir: The game's data directory
+        :return: The number of definitions loaded
+        """
+        count = 0
+        for root, dirs, files in os.walk(data_dir):
+            for file in sorted(files):
+                stem, ext = os.path.splitext(file.lower())
+                data_type = next((t for prefix, t in self.FILE_KINDS.items() if stem.startswith(prefix)), None)
+                if data_type is None or ext not in (".xml", ".json"):
+                    continue
+                path = os.path.join(root, file)
+                entries = self.read_xml(path) if ext == ".xml" else self.read_json(path)
+                for definition in entries:
+                    name = definition.get("Name", definition.get("name"))
+                    if name is not None:
+                        self.definitions[data_type][name] = definition
+                        count += 1
+        self.clear_memo()
+        return count
+
+    @staticmethod
+    def read_xml(path: str) -> list:
+        # each child of the root element is a definition, its attributes are the fields
+        return [dict(element.attrib) for element in ElementTree.parse(path).getroot()]
+
+    @staticmethod
+    def read_json(path: str) -> list:
+        # a list of definitions, a {name: definition} dict, or either one under a single key
+        with open(path, encoding="utf8") as f:
+            data = json.load(f)
+        if isinstance(data, dict) and len(data) == 1 and isinstance(next(iter(data.values())), (list, dict)):
+            data = next(iter(data.values()))
+        if isinstance(data, dict):
+            return [{"Name": name, **definition} if isinstance(definition, dict) else {"Name": name} for name, definition in data.items()]
+        return [definition for definition in data if isinstance(definition, dict)]
+
+    def get_data(self, data_type: DataType, name: str):
+        table = self.definitions[data_type]
+        if not table:
+            return self.ANY
+        return table.get(name)
+
+    def getUnitData(self, unit_name: str):
+        return self.get_data(DataType.UNIT, unit_name)
+
+    def getObstacleData(self, obstacle_name: str):
+        return self.get_data(DataType.OBSTACLE, obstacle_name)
+
+    def getGeneratorData(self, generator_name: str):
+        return self.get_data(DataType.GENERATOR, generator_name)
+
+    def getLootTableData(self, loot_table_name: str):
+        return self.get_data(DataType.LOOT, loot_table_name)
+
+    def resolve(self, data_type: DataType, name: str):
+        if data_type == DataType.GENERATOR and self.getGeneratorData(name) is None:
+            # generators without generator data are loaded as plain obstacles
+            return DataType.OBSTACLE if self.getObstacleData(name) is not None else None
+        return data_type if self.get_data(data_type, name) is not None else None
+
+    def validate(self, data_type: DataType, name: str):
+        """
+        Check a thing against the game data
+        :param data_type: The thing's data type
+        :param name: The thing's name
+        :return: The data type the thing should be loaded as, or None if it isn't valid
+        """
+        names = self.memo.get(data_type)
+        if names is None:
+            # the game only checks units, obstacles, generators and loot
+            return data_type
+        valid = names.get(name, DataType.UNKNOWN)
+        if valid is DataType.UNKNOWN:
+            valid = names[name] = self.resolve(data_type, name)
+        return valid
+
+    def validate_things(self, things, dropped: list = None):
+        """
+        Validate a batch of things, remapping the data type of those the game loads as
+        something else. Each distinct (type, name) pair is resolved once
+        :param things: MapThings, e.g. a generator reading them from a loader
+        :param dropped: If given, (index, thing) is added for every invalid thing
+        :return: A generator of (index, thing) for the valid things
+        """
+        memo = self.memo
+        for i, thing in enumerate(things):
+            data_type = thing.data_type
+            names = memo.get(data_type)
+            if names is None:
+                yield i, thing
+                continue
+            valid = names.get(thing.m_name, DataType.UNKNOWN)
+            if valid is DataType.UNKNOWN:
+                valid = names[thing.m_name] = self.resolve(data_type, thing.m_name)
+            if valid is None:
+                if dropped is not None:
+                    dropped.append((i, thing))
+                continue
+            if valid is not data_type:
+                thing.normalise(data_type=valid)
+            yield i, thing
+
+    def digest(self) -> str:
+        """
+        Fingerprint of the loaded definitions' names, for caches of validated maps
+        :return: A hex digest, the same for every registry with no definitions
+        """
+        h = hashlib.sha256()
+        for data_type, table in self.definitions.items():
+            h.update("{}:{};".format(data_type.name, "\0".join(sorted(table))).encode())
+        return h.hexdigest()
+
+
+# the registry maps are validated against unless one is passed to MapData
+game_data = GameDataManager()
+
+
+def game_data_of(loader) -> GameDataManager:
+    return loader.game_data or game_data
+
+
+# Loads a data directory into the default registry, also used to set up batch worker processes
+def load_game_data(data_dir: str) -> int:
+    return game_data.load_directory(data_dir)
+
+
+# Checks a thing against the default game data, see GameDataManager.validate
+def validate_thing(data_type, name: str):
+    return game_data.validate(data_type, name)
+
+
+# Colors are stored as BGRA bytes, see BinaryLoadData.color
+COLOR = Scalar("4B", lambda bgra: Color(bgra[2], bgra[1], bgra[0], bgra[3]), lambda c: (c.b, c.g, c.r, c.a))
+
+
+# A copy of a field value that later in-place changes to the value don't affect
+def copied(value):
+    return list(value) if isinstance(value, list) else value
+
+
 # Reimplementation of the MapThing class in Bastion
 class MapThing:
-    m_groupNames = []
+    schema = Schema([
+        (1, "data_type", enum_name(DataType)),
+        (1, "m_name", STRING),
+        (1, "m_location", POINT),
+        (2, "m_active", BOOL),
+        (2, "m_activateWhenSeen", BOOL),
+        (3, "m_endLocation", POINT),
+        (4, "m_id", INT),
+        (5, "m_activateOnEnterID", INT),
+        (6, "m_activateOnEnterName", STRING),
+        (7, "m_activateOnEnterNames", STRING_LIST),
+        (8, "m_requiresSolidGround", BOOL),
+        (9, "m_groupName", STRING),
+        (10, "m_useTargetAI", BOOL),
+        (10, "m_useMoveAI", BOOL),
+        (10, "m_useAttackAI", BOOL),
+        # TODO: implement sprite effects class
+        # this.m_flipEffect = (SpriteEffects)loadData.loadInt();
+        (11, "m_flipEffect", INT),
+        (12, "m_flipHorizontal", BOOL),
+        (12, "m_flipVertical", BOOL),
+        (13, "m_activateOnEnterIDs", INT_LIST),
+        (14, "DropLoot", BOOL),
+        (15, "SortModifier", INT),
+        (16, "Color", COLOR),
+        (17, "Scale", FLOAT),
+        (18, "UseUnexploredHue", BOOL),
+        (19, "HealthFraction", FLOAT),
+        (20, "Walkable", BOOL),
+        (21, "Invulnerable", BOOL),
+        (22, "UseAsFx", BOOL),
+        (22, "RotationSpeed", FLOAT),
+        (22, "DrawLayer", enum_name(DrawLayer)),
+        (23, "OffsetZ", FLOAT),
+        (24, "Angle", FLOAT),
+        (25, "FallIn", BOOL),
+        (26, "AttachToID", INT),
+        (27, "ActivationRange", FLOAT),
+        (28, "HelpTextId", STRING),
+        (29, "Flying", BOOL),
+        (30, "m_groupNames", STRING_LIST),
+        (31, "GiveXP", BOOL),
+        (32, "Friendly", BOOL),
+        (33, "Parallax", BOOL),
+        (34, "IgnoreGridManager", BOOL),
+        (35, "Wobble", BOOL),
+    ])
+
+    # the fields a TerrainTile shares with the other tiles of its template
+    shared = None
 
     def __init__(self, loader: BinaryLoadData):
         self.m_location = (0, 0)
+        self.m_groupNames = []
         self.load(loader)
 
     def load(self, loader):
-        n = loader.int()
-        if n >= 1:
-            self.data_type = DataType[loader.string()]
-            self.m_name = loader.string()
-            self.m_location = (loader.int(), loader.int())
-        if n >= 2:
-            self.m_active = loader.bool()
-            self.m_activateWhenSeen = loader.bool()
-        if n >= 3:
-            self.m_endLocation = (loader.int(), loader.int())
-        if n >= 4:
-            self.m_id = loader.int()
-        if n >= 5:
-            self.m_activateOnEnterID = loader.int()
-        if n >= 6:
-            self.m_activateOnEnterName = loader.string()
-        if n >= 7:
-            self.m_activateOnEnterNames = loader.str_list()
-        if n >= 8:
-            self.m_requiresSolidGround = loader.bool()
-        if n >= 9:
-            self.m_groupName = loader.string()
-        if n >= 10:
-            self.m_useTargetAI = loader.bool()
-            self.m_useMoveAI = loader.bool()
-            self.m_useAttackAI = loader.bool()
-        if n >= 11:
-            # TODO: implement sprite effects class
-            # this.m_flipEffect = (SpriteEffects)loadData.loadInt();
-            self.m_flipEffect = loader.int()
-        if n >= 12:
-            self.m_flipHorizontal = loader.bool()
-            self.m_flipVertical = loader.bool()
-        if n >= 13:
-            self.m_activateOnEnterIDs = loader.int_list()
-        if n >= 14:
-            self.DropLoot = loader.bool()
-        if n >= 15:
-            self.SortModifier = loader.int()
-        if n >= 16:
-            self.Color = loader.color()
-        if n >= 17:
-            self.Scale = loader.float()
-        if n >= 18:
-            self.UseUnexploredHue = loader.bool()
-        if n >= 19:
-            self.HealthFraction = loader.float()
-        if n >= 20:
-            self.Walkable = loader.bool()
-        if n >= 21:
-            self.Invulnerable = loader.bool()
-        if n >= 22:
-            self.UseAsFx = loader.bool()
-            self.RotationSpeed = loader.float()
-            self.DrawLayer = DrawLayer[loader.string()]
-        if n >= 23:
-            self.OffsetZ = loader.float()
-        if n >= 24:
-            self.Angle = loader.float()
-        if n >= 25:
-            self.FallIn = loader.bool()
-        if n >= 26:
-            self.AttachToID = loader.int()
-        if n >= 27:
-            self.ActivationRange = loader.float()
-        if n >= 28:
-            self.HelpTextId = loader.string()
-        if n >= 29:
-            self.Flying = loader.bool()
-        if n >= 30:
-            self.m_groupNames = loader.str_list()
-            self.addToGroup(self.m_groupName)
-        if n >= 31:
-            self.GiveXP = loader.bool()
-        if n >= 32:
-            self.Friendly = loader.bool()
-        if n >= 33:
-            self.Parallax = loader.bool()
-        if n >= 34:
-            self.IgnoreGridManager = loader.bool()
-        if n >= 35:
-            self.Wobble = loader.bool()
+        self.loaded(self.schema.load(loader, self))
+
+    def fields(self) -> dict:
+        # every field of the thing, where code would otherwise read its __dict__
+        return self.__dict__
+
+    def loaded(self, version: int):
+        if version >= 30:
+            if self.m_groupName and self.m_groupName not in self.m_groupNames:
+                self.normalise(m_groupNames=self.m_groupNames + [self.m_groupName])
+
+    @classmethod
+    def from_fields(cls, version: int, d: dict):
+        # a thing from fields that were decoded elsewhere, e.g. in two parts by a ThingQuery
+        thing = cls.__new__(cls)
+        thing.m_location = (0, 0)
+        thing.m_groupNames = []
+        thing.__dict__.update(d)
+        thing.version = version
+        thing.loaded(version)
+        return thing
+
+    def normalise(self, **values):
+        # changes fields the way the loader does, remembering their on-disk value and the value
+        # they were changed to, so that saving a field that wasn't edited since writes it back
+        # as it was
+        saved = self.__dict__.setdefault("saved_fields", {})
+        for name, value in values.items():
+            if name not in saved and hasattr(self, name):
+                saved[name] = (copied(getattr(self, name)), copied(value))
+            setattr(self, name, value)
 
     def getFirstGroupName(self) -> str:
         if not self.m_groupNames:
@@ -233,7 +686,7 @@ class MapThing:
         self.m_groupNames.append(name)
 
     def to_dict(self):
-        d = self.__dict__
+        d = dict(self.fields())
         d['x'] = self.m_location[0]
         d['y'] = self.m_location[1]
         return d
@@ -242,72 +695,264 @@ class MapThing:
         return "Thing {} ({}), located at {}".format(self.m_name, self.data_type, self.m_location)
 
 
+# Sections of a map that hold things, used to tag rows of a ThingTable
+class ThingSection(Enum):
+    LEGACY = 0
+    GROUP = 1
+    TERRAIN = 2
+    BACKDROP_FLYER = 3
+
+
+# Reports a section of the map to the loader's hooks while it is read, see ParseHooks. count
+# turns the section's value into the number of items it held.
+def timed_section(name: str, kind: Value, count=len) -> Value:
+    read = kind.read
+
+    def read_section(loader, *context):
+        hooks = loader.hooks
+        start = loader.position()
+        hooks.section_start(name, start)
+        started = perf_counter()
+        value = read(loader, *context)
+        hooks.section_end(SectionEvent(name, start, loader.position(), perf_counter() - started, count(value)))
+        return value
+
+    return Value(read_section, kind.skip, kind.contextual, kind.write, kind.size)
+
+
+# A terrain tile loaded in flyweight mode, see TileTemplates. Its own __dict__ only holds its
+# position and id; every other field is read from shared, the values of its template. Setting
+# a field gives the tile its own value, and the methods that change a field in place copy it
+# into the tile first.
+class TerrainTile(MapThing):
+    __slots__ = ("shared",)
+    own_fields = ("m_location", "m_endLocation", "m_id")
+
+    def __getattr__(self, name: str):
+        # only called for attributes the tile doesn't have itself
+        if name == "shared":
+            raise AttributeError(name)
+        try:
+            return self.shared[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def fields(self) -> dict:
+        return {**self.shared, **self.__dict__}
+
+    def own(self, name: str):
+        # the tile's own copy of a shared field, so changing it doesn't change the template
+        d = self.__dict__
+        if name not in d and name in self.shared:
+            value = self.shared[name]
+            d[name] = list(value) if isinstance(value, list) else value
+        return d.get(name)
+
+    def addToGroup(self, name):
+        self.own("m_groupNames")
+        super().addToGroup(name)
+
+
+# Registry of the templates of TerrainTiles, for MapData(tile_templates=...). Terrain layers hold
+# huge numbers of tiles that only differ in location: every decoded tile whose other fields
+# (name, data type, flags, Color, scale, draw layer...) match an earlier tile's becomes a
+# TerrainTile sharing that tile's values, so they are stored once. Share a registry between
+# maps to share templates between them too. Keeps count of the memory it saved.
+#
+#   templates = TileTemplates()
+#   map_data = MapData("benchmarks/corpus/medium-v32.map", tile_templates=templates)
+#   print(templates)   # 20,000 tiles share 5,872 templates, 6.8 MB saved
+class TileTemplates:
+    def __init__(self):
+        self.templates = {}
+        self.tiles = 0
+        self.shared_tiles = 0
+        self.saved = 0
+
+    def share(self, thing: MapThing) -> MapThing:
+        """
+        The tile for a decoded terrain thing: a TerrainTile sharing the values of its template
+        :param thing: The thing as decoded
+        :return: The TerrainTile, or the thing itself if it has its own saved fields
+        """
+        self.tiles += 1
+        d = thing.__dict__
+        if "saved_fields" in d:
+            return thing
+        values = {name: value for name, value in d.items() if name not in TerrainTile.own_fields}
+        # the fields of a version come in the same order, so the values alone tell templates
+        # apart
+        key = tuple(map(template_key, values.values()))
+        template = self.templates.get(key)
+        if template is None:
+            # the shared values, and what a tile using them saves once it's known
+            template = self.templates[key] = [values, None]
+        shared = template[0]
+        tile = TerrainTile.__new__(TerrainTile)
+        tile.shared = shared
+        own = tile.__dict__
+        for name in TerrainTile.own_fields:
+            if name in d:
+                own[name] = d[name]
+
+        # what the tile doesn't hold anymore: its full dict, and after the template's first
+        # tile, its own copies of the shared values. That's measured on the second tile and
+        # assumed the same for the rest.
+        saved = sys.getsizeof(d) - sys.getsizeof(own) - 8
+        if shared is values:
+            # the template's values and its entry in templates
+            saved -= sys.getsizeof(values) + sys.getsizeof(template) + key_size(key)
+        else:
+            if template[1] is None:
+                template[1] = saved + sum(value_size(value) for name, value in values.items() if value is not shared[name])
+            saved = template[1]
+        self.shared_tiles += 1
+        self.saved += saved
+        return tile
+
+    def __str__(self) -> str:
+        return "{:,} tiles share {:,} templates, {:.1f} MB saved".format(self.tiles, len(self.templates), self.saved / 1e6)
+
+
+# A decoded field value as part of a TileTemplates key. Floats are keyed by their bits, as
+# -0.0 == 0.0 but they save differently; Colors and lists are keyed by their contents.
+def template_key(value):
+    cls = value.__class__
+    if cls is float:
+        return pack("<d", value)
+    if cls is Color:
+        return Color, template_key(value.r), template_key(value.g), template_key(value.b), template_key(value.a)
+    if cls is list or cls is tuple:
+        return tuple(map(template_key, value))
+    return value
+
+
+# Memory held by a template's key beyond the values it was made from
+def key_size(key) -> int:
+    if key.__class__ is tuple:
+        return sys.getsizeof(key) + sum(key_size(k) for k in key)
+    return sys.getsizeof(key) if key.__class__ is bytes else 0
+
+
+# Memory held by a decoded field value, for TileTemplates; small ints, bools, enums and None
+# are shared by Python anyway
+def value_size(value) -> int:
+    if value is None or isinstance(value, (bool, Enum)) or (isinstance(value, int) and -5 <= value <= 256):
+        return 0
+    if isinstance(value, Color):
+        return sys.getsizeof(value) + sys.getsizeof(value.__dict__)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(value_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+# Reads a list of things. When the loader is filling a ThingTable, the things are decoded
+# straight into its columns and the row range is returned instead of MapThing objects.
+# When it's sharing terrain tiles, terrain things become TerrainTiles, see TileTemplates.
+def read_things(loader, section: ThingSection = ThingSection.LEGACY, **tags):
+    if loader.thing_table is not None:
+        return loader.thing_table.read(loader, section, **tags)
+    if section == ThingSection.TERRAIN and loader.tile_templates is not None:
+        share = loader.tile_templates.share
+        return [share(MapThing(loader)) for i in range(loader.int())]
+    return [MapThing(loader) for i in range(loader.int())]
+
+
+skip_things = skip_list(MapThing.schema.skip)
+write_things = write_list(MapThing.schema.save)
+things_size = list_size(MapThing.schema.size)
+
+
+# Things a loader dropped from a list (invalid or duplicate things) are kept in the owner's
+# dropped dict as (index, thing) pairs, so they can be saved back in their place
+def saved_things(things, dropped: list = None) -> list:
+    if isinstance(things, range):
+        raise ValueError("things loaded into a ThingTable can't be saved")
+    things = list(things.values() if isinstance(things, dict) else things)
+    for index, thing in dropped or ():
+        things.insert(index, thing)
+    return things
+
+
+def keep_dropped(d: dict, name: str, dropped: list):
+    if dropped:
+        d.setdefault("dropped", {})[name] = dropped
+
+
+def thing_list(read, name: str) -> Value:
+    # the list of things in field name of a record
+    return Value(
+        read,
+        skip_things,
+        contextual=True,
+        write=lambda saver, things, d: write_things(saver, saved_things(things, d.get("dropped", {}).get(name))),
+        size=lambda things, d: things_size(saved_things(things, d.get("dropped", {}).get(name))),
+    )
+
+
 class MapThingGroup:
+    @staticmethod
+    def iter_things(loader, name: str, dropped: list = None):
+        # yields the group's things as Bastion keeps them: moved into the group, validated
+        # against the game data and unique by id. Things left out are added to dropped.
+        ids = set()
+        for i, mapThing in game_data_of(loader).validate_things(MapThingGroup.iter_moved(loader, name), dropped):
+            if mapThing.m_id not in ids:
+                ids.add(mapThing.m_id)
+                yield mapThing
+            elif dropped is not None:
+                dropped.append((i, mapThing))
+
+    @staticmethod
+    def iter_moved(loader, name: str):
+        for i in range(loader.int()):
+            mapThing = MapThing(loader)
+            if mapThing.getFirstGroupName() != name:
+                mapThing.normalise(m_groupName=name, m_groupNames=[name])
+            yield mapThing
+
+    @staticmethod
+    def read_things(loader, d: dict):
+        name = d["name"]
+        if loader.thing_table is not None:
+            return read_things(loader, ThingSection.GROUP, group=name, validate=True, unique=True)
+
+        dropped = []
+        things = {mapThing.m_id: mapThing for mapThing in MapThingGroup.iter_things(loader, name, dropped)}
+        keep_dropped(d, "m_things", dropped)
+        return things
+
+    schema = Schema([
+        (1, "name", STRING),
+        (1, "m_things", thing_list(read_things, "m_things")),
+        (0, "m_visible", BOOL),
+        (0, "m_selectable", BOOL),
+    ])
+
     def __init__(self, loader):
         self.load(loader)
 
     def load(self, loader):
-        num = loader.int()
-        if num >= 1:
-            self.name = loader.string()
-            self.m_things = {}
-            num2 = loader.int()
-            for i in range(num2):
-                mapThing = MapThing(loader)
-                if mapThing.getFirstGroupName() != self.name:
-                    mapThing.setGroupName(self.name)
-
-                valid = True
-
-                if mapThing.data_type != DataType.UNKNOWN:
-                    if mapThing.data_type == DataType.UNIT:
-                        unitData = GameDataManager.getUnitData(mapThing.m_name)
-
-                        if not unitData:
-                            valid = False
-                    if mapThing.data_type == DataType.OBSTACLE:
-                        obstacleData = GameDataManager.getObstacleData(mapThing.m_name)
-
-                        if not obstacleData:
-                            valid = False
-                    if (
-                        mapThing.data_type == DataType.GENERATOR
-                        and not GameDataManager.getGeneratorData(mapThing.m_name)
-                    ):
-                        obstacleData = GameDataManager.getObstacleData(mapThing.m_name)
-
-                        if not obstacleData:
-                            valid = False
-                        else:
-                            mapThing.data_type = DataType.OBSTACLE
-                    if mapThing.data_type == DataType.LOOT:
-                        lootTableData = GameDataManager.getLootTableData(
-                            mapThing.m_name
-                        )
-
-                        if not lootTableData:
-                            valid = False
-
-                if valid and mapThing.m_id not in self.m_things:
-                    self.m_things[mapThing.m_id] = mapThing
-
-        self.m_visible = loader.bool()
-        self.m_selectable = loader.bool()
+        self.schema.load(loader, self)
 
 
 # Reimplementation of the BloomSettings class in Bastion, which controls bloom settings for maps
 class BloomSettings:
+    schema = Schema([
+        (0, "name", STRING),
+        (0, "bloomThreshold", FLOAT),
+        (0, "blurAmount", FLOAT),
+        (0, "bloomIntensity", FLOAT),
+        (0, "baseIntensity", FLOAT),
+        (0, "bloomSaturation", FLOAT),
+        (0, "baseSaturation", FLOAT),
+    ], versioned=False)
+
     def __init__(self, loader: BinaryLoadData):
         self.load(loader)
 
     def load(self, loader: BinaryLoadData):
-        self.name = loader.string()
-        self.bloomThreshold = loader.float()
-        self.blurAmount = loader.float()
-        self.bloomIntensity = loader.float()
-        self.baseIntensity = loader.float()
-        self.bloomSaturation = loader.float()
-        self.baseSaturation = loader.float()
+        self.schema.load(loader, self)
 
 
 class Shader(Enum):
@@ -329,16 +974,23 @@ class GameData:
 
 
 class SpawnData:
+    schema = Schema([
+        (1, "m_name", STRING),
+        (1, "m_num", INT),
+        (2, "m_maxAttempts", INT),
+    ])
+
     def __init__(self):
         pass
 
     def load(self, loader: BinaryLoadData):
-        num = loader.int()
-        if num >= 1:
-            self.m_name = loader.string()
-            self.m_num = loader.int()
-        if num >= 2:
-            self.m_maxAttempts = loader.int()
+        self.schema.load(loader, self)
+
+    @staticmethod
+    def read(loader: BinaryLoadData):
+        spawnData = SpawnData()
+        spawnData.load(loader)
+        return spawnData
 
 
 class SpawnWaveData:
@@ -346,55 +998,57 @@ class SpawnWaveData:
         m_countScalar: float
         m_intervalScalar: float
 
-    m_spawns = []
+        def __init__(self, scalars: tuple = (1.0, 1.0)):
+            self.m_countScalar, self.m_intervalScalar = scalars
+
+    schema = Schema([
+        (1, "m_minInterval", FLOAT),
+        (1, "m_maxInterval", FLOAT),
+        (1, "m_spawns", list_of(SpawnData.read, SpawnData.schema.skip, SpawnData.schema.save, SpawnData.schema.size)),
+        (1, "m_loopToWave", INT),
+        (1, "m_repeatTimes", INT),
+        (1, "m_scale", Scalar("2f", Scale, lambda scale: (scale.m_countScalar, scale.m_intervalScalar))),
+        (2, "m_firstSpawnMinInterval", FLOAT),
+        (2, "m_firstSpawnMaxInterval", FLOAT),
+    ])
 
     def __init__(self):
-        pass
+        self.m_spawns = []
 
     def load(self, loader: BinaryLoadData):
-        num = loader.int()
-        if num >= 1:
-            self.m_minInterval = loader.float()
-            self.m_maxInterval = loader.float()
-            num2 = loader.int()
-            for i in range(num2):
-                spawnData = SpawnData()
-                spawnData.load(loader)
-                self.m_spawns.append(spawnData)
-
-            self.m_loopToWave = loader.int()
-            self.m_repeatTimes = loader.int()
-            self.m_scale = self.Scale()
-            self.m_scale.m_countScalar = loader.float()
-            self.m_scale.m_intervalScalar = loader.float()
-        if num >= 2:
-            self.m_firstSpawnMinInterval = loader.float()
-            self.m_firstSpawnMaxInterval = loader.float()
+        self.schema.load(loader, self)
+
+    @staticmethod
+    def read(loader: BinaryLoadData):
+        spawnWaveData = SpawnWaveData()
+        spawnWaveData.load(loader)
+        return spawnWaveData
 
 
 class SpawnPointData(GameData):
-    m_spawnWaves = []
+    schema = Schema([
+        (1, "m_name", STRING),
+        (1, "m_xOffsetMin", INT),
+        (1, "m_xOffsetMax", INT),
+        (1, "m_yOffsetMin", INT),
+        (1, "m_yOffsetMax", INT),
+        (1, "m_spawnWaves", list_of(SpawnWaveData.read, SpawnWaveData.schema.skip, SpawnWaveData.schema.save, SpawnWaveData.schema.size)),
+        (2, "m_snapHorizontal", BOOL),
+        (2, "m_snapVertical", BOOL),
+    ])
 
     def __init__(self, name):
         super().__init__(name)
+        self.m_spawnWaves = []
 
     def load(self, loader):
-        num = loader.int()
-        if num >= 1:
-            self.m_name = loader.string()
-            self.m_xOffsetMin = loader.int()
-            self.m_xOffsetMax = loader.int()
-            self.m_yOffsetMin = loader.int()
-            self.m_yOffsetMax = loader.int()
-
-            num2 = loader.int()
-            for i in range(num2):
-                spawnWaveData = SpawnWaveData()
-                spawnWaveData.load(loader)
-                self.m_spawnWaves.append(spawnWaveData)
-        if num >= 2:
-            self.m_snapHorizontal = loader.bool()
-            self.m_snapVertical = loader.bool()
+        self.schema.load(loader, self)
+
+    @staticmethod
+    def read(loader: BinaryLoadData):
+        spawnPointData = SpawnPointData("")
+        spawnPointData.load(loader)
+        return spawnPointData
 
 
 class TerrainLayerData:
@@ -403,33 +1057,26 @@ class TerrainLayerData:
         MULTIPLY = 1
         MASK = 2
 
+    schema = Schema([
+        (1, "name", STRING),
+        (1, "color", COLOR),
+        (2, "m_tiles", thing_list(lambda loader, d: read_things(loader, ThingSection.TERRAIN, layer=d["name"]), "m_tiles")),
+        (3, "m_linkedLayers", list_of(
+            lambda loader: TerrainLayerData(loader),
+            lambda loader: TerrainLayerData.schema.skip(loader),
+            lambda saver, layer: TerrainLayerData.schema.save(saver, layer),
+            lambda layer: TerrainLayerData.schema.size(layer),
+        )),
+        (4, "m_mask", BOOL),
+        (5, "m_blendFilter", enum_value(BlendFilter)),
+        (6, "shader", enum_value(Shader)),
+        (6, "contrast", FLOAT),
+        (7, "saturation", FLOAT),
+    ])
+
     def __init__(self, loader: BinaryLoadData):
         self.init()
-        num = loader.int()
-        if num >= 1:
-            self.name = loader.string()
-            self.color = loader.color()
-        if num >= 2:
-            self.m_tiles = []
-            num2 = loader.int()
-            for i in range(num2):
-                mapThing = MapThing(loader)
-                self.m_tiles.append(mapThing)
-        if num >= 3:
-            self.m_linkedLayers = []
-            num3 = loader.int()
-            for j in range(num3):
-                item = TerrainLayerData(loader)
-                self.m_linkedLayers.append(item)
-        if num >= 4:
-            self.m_mask = loader.bool()
-        if num >= 5:
-            self.m_blendFilter = self.BlendFilter(loader.int())
-        if num >= 6:
-            self.shader = Shader(loader.int())
-            self.contrast = loader.float()
-        if num >= 7:
-            self.saturation = loader.float()
+        self.schema.load(loader, self)
 
     def init(self):
         self.visible = True
@@ -438,203 +1085,588 @@ class TerrainLayerData:
         self.shader = None
         self.contrast = 0
         self.saturation = 0.3
+        self.m_tiles = []
+        self.m_linkedLayers = []
+
+
+save_layers = write_list(TerrainLayerData.schema.save)
+layers_size = list_size(TerrainLayerData.schema.size)
+
+
+# Accepts an already built loader, e.g. a BufferLoadData over a memory-mapped file, a path,
+# which is memory-mapped read only, or anything BinaryLoadData can read from
+def as_loader(stream) -> BinaryLoadData:
+    if isinstance(stream, BinaryLoadData):
+        return stream
+    if isinstance(stream, str):
+        return BufferLoadData(stream)
+    return BinaryLoadData(stream)
 
 
 # Reimplementation of the MapData class in Bastion, which is a container for map data.
 class MapData:
-    thingGroups = []
-    m_things = []
-
-    def __init__(self, stream):
-        loader = BinaryLoadData(stream)
-
-        num = loader.int()
-        if num >= 1:
-            if num < 20:
-                self.m_things = []
-                num2 = loader.int()
-                for i in range(num2):
-                    map_thing = MapThing(loader)
-                    valid = True
-
-                    if map_thing.data_type != DataType.UNKNOWN:
-                        if map_thing.data_type == DataType.UNIT:
-                            unitData = GameDataManager.getUnitData(map_thing.m_name)
-
-                            if not unitData:
-                                valid = False
-                        if map_thing.data_type == DataType.OBSTACLE:
-                            obstacleData = GameDataManager.getObstacleData(
-                                map_thing.m_name
-                            )
-
-                            if not obstacleData:
-                                valid = False
-                        if (
-                            map_thing.data_type == DataType.GENERATOR
-                            and not GameDataManager.getGeneratorData(map_thing.m_name)
-                        ):
-                            obstacleData = GameDataManager.getObstacleData(
-                                map_thing.m_name
-                            )
-
-                            if not obstacleData:
-                                valid = False
-                            else:
-                                map_thing.data_type = DataType.OBSTACLE
-                        if map_thing.data_type == DataType.LOOT:
-                            lootTableData = GameDataManager.getLootTableData(
-                                map_thing.m_name
-                            )
-
-                            if not lootTableData:
-                                valid = False
-
-                    if valid:
-                        self.m_things.append(map_thing)
-
-            self.m_spawmPointData = []
-            num3 = loader.int()
-            for j in range(num3):
-                print("reading spawn data...")
-                spawnPointData = SpawnPointData("")
-                spawnPointData.load(loader)
-                self.m_spawnPointData.append(spawnPointData)
-
-            print("Reading start data...")
-            self.startingCash = loader.int()
-            self.m_name = loader.string()
-            self.m_lootTableName = loader.string()
-        if num >= 2:
-            print("Reading pathfinders...")
-            self.PathfinderBonus = loader.float()
-        if num >= 3:
-            print("Reading scroll numbers...")
-            self.scrollSpeed = loader.float()
-            self.scrollAngle = loader.float()
-        if num >= 4:
-            print("Reading size numbers...")
-            self.m_size = (loader.int(), loader.int())
-        if num >= 5:
-            print("Reading music...")
-            self.MusicName = loader.string()
-        if num >= 6:
-            print("Reading ambiance...")
-            self.AmbienceName = loader.string()
-        if num >= 7:
-            print("Reading terrain layer data...")
-            self.m_terrainLayerData = []
-            num4 = loader.int()
-            for k in range(num4):
-                terrainLayerData = TerrainLayerData(loader)
-                self.m_terrainLayerData.append(terrainLayerData)
-                for item in terrainLayerData.m_linkedLayers:
-                    self.m_terrainLayerData.append(item)
-        if num >= 8:
-            self.m_scripts = loader.str_list()
-        if num >= 9:
-            self.backdropTiles = loader.str_list()
-            self.backdropColumns = loader.int()
-            self.backdropColor = loader.color()
-        if num >= 10:
-            self.backdropFlyers = loader.str_list()
-            self.backdropFlyerIntervalMin = loader.float()
-            self.backdropFlyerIntervalMax = loader.float()
-            self.backdropFlyerSpeedMin = loader.float()
-            self.backdropFlyerSpeedMax = loader.float()
-            self.backdropFlyerColor = loader.color()
-        if num >= 11:
-            self.FullBlackTime = loader.float()
-            self.FadeInTime = loader.float()
-        if num >= 12:
-            self.backdropFlyerRefractRate = loader.float()
-            self.backdropFlyerRefractAmount = loader.float()
-        if num >= 13:
-            self.backdropRows = loader.int()
-        if num >= 14:
-            self.backdropTileRefractRate = loader.float()
-            self.backdropTileRefractAmount = loader.float()
-        if num >= 15:
-            self.preplacedBackdropFlyers = []
-            num5 = loader.int()
-            for l in range(num5):
-                mapThing2 = MapThing(loader)
-                if mapThing2.data_type != DataType.UNKNOWN:
-                    self.preplacedBackdropFlyers.append(mapThing2)
-        if num >= 16:
-            self.backgroundBloomSetting = BloomSettings(loader)
-            self.terrainBloomSetting = BloomSettings(loader)
-        if num >= 17:
-            self.backdropFlyerParallax = loader.float()
-        if num >= 18:
-            self.tileAssembleSound = loader.string()
-        if num >= 19:
-            self.terrainType = loader.enum(TerrainTileType)
-            self.unexploredColor = loader.color()
-        if num >= 20:
-            num6 = loader.int()
-            for m in range(num6):
-                self.thingGroups.append(MapThingGroup(loader))
-        if num >= 21:
-            self.brightness = loader.float()
-        if num >= 22:
-            self.playerStartFall = loader.bool()
-        if num >= 23:
-            self.unexploredContrast = loader.float()
-            self.unexploredSaturation = loader.float()
-        if num >= 24:
-            self.tilePhaseInTimeMin = loader.float()
-            self.tilePhaseInTimeMax = loader.float()
-        if num >= 25:
-            self.terrainLightTexture = loader.string()
-            self.terrainLightVelocity = loader.vector()
-        if num >= 26:
-            self.keepWeapons = loader.bool()
-        if num >= 27:
-            self.canPlantSeeds = loader.bool()
-        if num >= 28:
-            self.titleId = loader.string()
-        if num >= 29:
-            self.noWeapons = loader.bool()
-        if num >= 30:
-            self.parallax = loader.float()
-        if num >= 31:
-            self.backdropSaturaton = loader.float()
-        if num >= 32:
-            location = loader.vector()
-            zoom = loader.float()
+    # sections that only exist in some versions of the format, made empty when missing
+    defaults = {"m_things": list, "thingGroups": list}
+
+    @staticmethod
+    def iter_legacy_things(loader: BinaryLoadData, dropped: list = None):
+        things = (MapThing(loader) for i in range(loader.int()))
+        for i, map_thing in game_data_of(loader).validate_things(things, dropped):
+            yield map_thing
+
+    @staticmethod
+    def read_legacy_things(loader: BinaryLoadData, d: dict) -> list:
+        if loader.thing_table is not None:
+            return read_things(loader, ThingSection.LEGACY, validate=True)
+        dropped = []
+        things = list(MapData.iter_legacy_things(loader, dropped))
+        keep_dropped(d, "m_things", dropped)
+        return things
+
+    @staticmethod
+    def read_terrain_layers(loader: BinaryLoadData) -> list:
+        m_terrainLayerData = []
+        num4 = loader.int()
+        for k in range(num4):
+            terrainLayerData = TerrainLayerData(loader)
+            m_terrainLayerData.append(terrainLayerData)
+            for item in terrainLayerData.m_linkedLayers:
+                m_terrainLayerData.append(item)
+        return m_terrainLayerData
+
+    @staticmethod
+    def saved_layers(layers: list) -> list:
+        # linked layers were flattened into the list by read_terrain_layers, but are saved with
+        # the layer they are linked to
+        linked = {id(item) for layer in layers for item in layer.m_linkedLayers}
+        return [layer for layer in layers if id(layer) not in linked]
+
+    @staticmethod
+    def iter_backdrop_flyers(loader: BinaryLoadData, dropped: list = None):
+        for i in range(loader.int()):
+            map_thing = MapThing(loader)
+            if map_thing.data_type != DataType.UNKNOWN:
+                yield map_thing
+            elif dropped is not None:
+                dropped.append((i, map_thing))
+
+    @staticmethod
+    def read_backdrop_flyers(loader: BinaryLoadData, d: dict) -> list:
+        if loader.thing_table is not None:
+            return read_things(loader, ThingSection.BACKDROP_FLYER, known=True)
+        dropped = []
+        things = list(MapData.iter_backdrop_flyers(loader, dropped))
+        keep_dropped(d, "preplacedBackdropFlyers", dropped)
+        return things
+
+    schema = Schema([
+        ((1, 20), "m_things", timed_section("legacy_things", thing_list(read_legacy_things, "m_things"))),
+        (1, "m_spawnPointData", timed_section("spawn_data", list_of(SpawnPointData.read, SpawnPointData.schema.skip, SpawnPointData.schema.save, SpawnPointData.schema.size))),
+        (1, "startingCash", INT),
+        (1, "m_name", STRING),
+        (1, "m_lootTableName", STRING),
+        (2, "PathfinderBonus", FLOAT),
+        (3, "scrollSpeed", FLOAT),
+        (3, "scrollAngle", FLOAT),
+        (4, "m_size", POINT),
+        (5, "MusicName", STRING),
+        (6, "AmbienceName", STRING),
+        (7, "m_terrainLayerData", timed_section("terrain_layers", Value(
+            read_terrain_layers,
+            skip_list(TerrainLayerData.schema.skip),
+            write=lambda saver, layers: save_layers(saver, MapData.saved_layers(layers)),
+            size=lambda layers: layers_size(MapData.saved_layers(layers)),
+        ), lambda layers: sum(len(layer.m_tiles) for layer in layers))),
+        (8, "m_scripts", STRING_LIST),
+        (9, "backdropTiles", STRING_LIST),
+        (9, "backdropColumns", INT),
+        (9, "backdropColor", COLOR),
+        (10, "backdropFlyers", STRING_LIST),
+        (10, "backdropFlyerIntervalMin", FLOAT),
+        (10, "backdropFlyerIntervalMax", FLOAT),
+        (10, "backdropFlyerSpeedMin", FLOAT),
+        (10, "backdropFlyerSpeedMax", FLOAT),
+        (10, "backdropFlyerColor", COLOR),
+        (11, "FullBlackTime", FLOAT),
+        (11, "FadeInTime", FLOAT),
+        (12, "backdropFlyerRefractRate", FLOAT),
+        (12, "backdropFlyerRefractAmount", FLOAT),
+        (13, "backdropRows", INT),
+        (14, "backdropTileRefractRate", FLOAT),
+        (14, "backdropTileRefractAmount", FLOAT),
+        (15, "preplacedBackdropFlyers", timed_section("backdrop_flyers", thing_list(read_backdrop_flyers, "preplacedBackdropFlyers"))),
+        (16, "backgroundBloomSetting", Value(BloomSettings, BloomSettings.schema.skip, write=BloomSettings.schema.save, size=BloomSettings.schema.size)),
+        (16, "terrainBloomSetting", Value(BloomSettings, BloomSettings.schema.skip, write=BloomSettings.schema.save, size=BloomSettings.schema.size)),
+        (17, "backdropFlyerParallax", FLOAT),
+        (18, "tileAssembleSound", STRING),
+        (19, "terrainType", enum_name(TerrainTileType)),
+        (19, "unexploredColor", COLOR),
+        (20, "thingGroups", timed_section("thing_groups", list_of(MapThingGroup, MapThingGroup.schema.skip, MapThingGroup.schema.save, MapThingGroup.schema.size), lambda groups: sum(len(group.m_things) for group in groups))),
+        (21, "brightness", FLOAT),
+        (22, "playerStartFall", BOOL),
+        (23, "unexploredContrast", FLOAT),
+        (23, "unexploredSaturation", FLOAT),
+        (24, "tilePhaseInTimeMin", FLOAT),
+        (24, "tilePhaseInTimeMax", FLOAT),
+        (25, "terrainLightTexture", STRING),
+        (25, "terrainLightVelocity", VECTOR),
+        (26, "keepWeapons", BOOL),
+        (27, "canPlantSeeds", BOOL),
+        (28, "titleId", STRING),
+        (29, "noWeapons", BOOL),
+        (30, "parallax", FLOAT),
+        (31, "backdropSaturaton", FLOAT),
+        (32, "cameraLocation", VECTOR),
+        (32, "cameraZoom", FLOAT),
+    ])
+
+    def __init__(self, stream, thing_table=None, hooks: ParseHooks = None, game_data: GameDataManager = None, tile_templates: TileTemplates = None):
+        loader = as_loader(stream)
+        try:
+            self.load(loader, thing_table, hooks, game_data, tile_templates)
+        finally:
+            # a file opened from a path is released as soon as the map is read
+            if isinstance(stream, str):
+                self.release(loader)
+
+    def release(self, loader):
+        loader.close()
+
+    def load(self, loader: BinaryLoadData, thing_table=None, hooks: ParseHooks = None, game_data: GameDataManager = None, tile_templates: TileTemplates = None):
+        # with a ThingTable, every thing is decoded into its columns and the thing containers
+        # (m_things, group m_things, m_tiles, preplacedBackdropFlyers) hold row ranges into it;
+        # with TileTemplates, terrain tiles are TerrainTiles sharing their fields
+        if thing_table is not None and tile_templates is not None:
+            raise ValueError("a map loaded into a ThingTable has no tiles to share")
+        self.things = thing_table
+        for name, default in self.defaults.items():
+            setattr(self, name, default())
+        previous_hooks, previous_game_data = loader.hooks, loader.game_data
+        loader.thing_table = thing_table
+        loader.tile_templates = tile_templates
+        loader.hooks = hooks or previous_hooks
+        loader.game_data = game_data or previous_game_data
+        try:
+            self.schema.load(loader, self)
+        finally:
+            loader.thing_table = None
+            loader.tile_templates = None
+            loader.hooks = previous_hooks
+            loader.game_data = previous_game_data
+        if thing_table is not None:
+            thing_table.finish()
+
+    def dump(self) -> bytearray:
+        """
+        Serialize the map in the version it was loaded with. A map that was loaded and not
+        changed is written back byte for byte
+        :return: The map file's contents
+        """
+        return serialize(self)
+
+    def save(self, path: str):
+        data = self.dump()
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def spatial_index(self, cell_size: int = None):
+        """
+        The SpatialIndex of the map's things, built on first use and kept with the map
+        :param cell_size: Grid cell size in map units, see SpatialIndex
+        :return: The index
+        """
+        index = self.__dict__.get("spatial")
+        if index is None or (cell_size is not None and index.cell_size != cell_size):
+            from SpatialIndex import SpatialIndex
+
+            index = self.spatial = SpatialIndex.from_map(self, cell_size)
+        return index
 
     def __str__(self) -> str:
         r = "Map: " + self.m_name + " {}. Music: {}".format(self.m_size, self.MusicName)
         return r
 
 
-# main
-if __name__ == "__main__":
+# A section of LazyMapData that is decoded the first time it is accessed
+class LazySection:
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj.materialize(self.name)
+
+
+# MapData that only decodes the map's header up front. The first pass skips over the big
+# sections (legacy things, spawn data, terrain layers, backdrop flyers and thing groups),
+# recording where each one starts; a section is decoded when it is first accessed and the
+# result is cached on the instance. The stream must stay open until every section that will
+# be used has been read, so prefer a BufferLoadData and close it when done.
+class LazyMapData(MapData):
+    m_things = LazySection()
+    m_spawnPointData = LazySection()
+    m_terrainLayerData = LazySection()
+    preplacedBackdropFlyers = LazySection()
+    thingGroups = LazySection()
+
+    sections = frozenset(("m_things", "m_spawnPointData", "m_terrainLayerData", "preplacedBackdropFlyers", "thingGroups"))
+
+    def load(self, loader: BinaryLoadData, thing_table=None, hooks: ParseHooks = None, game_data: GameDataManager = None, tile_templates: TileTemplates = None):
+        if thing_table is not None:
+            raise ValueError("LazyMapData can't fill a ThingTable")
+        # sections are read later, so the loader keeps the hooks, game data and templates
+        if hooks is not None:
+            loader.hooks = hooks
+        if game_data is not None:
+            loader.game_data = game_data
+        if tile_templates is not None:
+            loader.tile_templates = tile_templates
+
+        self.things = None
+        self.loader = loader
+        self.offsets = {}
+        self.version = loader.int()
+        self.plan = self.schema.plan(self.version)
+        self.plan.decoder(self.sections)(loader, self.__dict__, self.offsets)
+
+    def materialize(self, name: str):
+        offset = self.offsets.get(name)
+        if offset is None:
+            # not in this version of the format, use MapData's default if it has one
+            if name not in self.defaults:
+                raise AttributeError(name)
+            value = self.__dict__[name] = self.defaults[name]()
+            return value
+
+        loader = self.loader
+        loader.seek(offset)
+        kind = self.plan.field(name).kind
+        value = kind.read(loader, self.__dict__) if kind.contextual else kind.read(loader)
+        self.__dict__[name] = value
+        return value
+
+    def dump(self) -> bytearray:
+        for name in self.offsets:
+            getattr(self, name)
+        return super().dump()
+
+    def release(self, loader):
+        # the sections are read from the file on first access, see close
+        pass
+
+    def close(self):
+        if hasattr(self.loader, "close"):
+            self.loader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# One thing yielded by iter_things. source is the name of the thing group or terrain layer
+# the thing came from, or None for legacy things and backdrop flyers.
+class ThingRecord(NamedTuple):
+    section: ThingSection
+    source: str
+    thing: MapThing
+
+
+# Walks the fields of one plan: sections with a handler are passed to it, fields named in keep
+# are decoded into d, and everything else is skipped. With stop_early, the walk ends as soon as
+# every handler has run instead of moving the loader past the rest of the record.
+def walk_plan(plan, loader, handlers: dict, keep=(), stop_early: bool = False):
+    d = {}
+    remaining = set(handlers) & {f.name for f in plan.fields}
+    for codec, fields in plan.steps:
+        if stop_early and not remaining:
+            return
+        if codec is not None:
+            loader.skip(codec.size)
+            continue
+        field = fields[0]
+        handler = handlers.get(field.name)
+        if handler is not None:
+            remaining.discard(field.name)
+            yield from handler(loader, d)
+        elif field.name in keep:
+            d[field.name] = field.kind.read(loader)
+        else:
+            plan.skip_of(field)(loader)
+
+
+def iter_layer_tiles(loader):
+    version = loader.int()
+    plan = TerrainLayerData.schema.plan(version)
+    handlers = {
+        # tiles are decoded one at a time, as a layer can hold most of the map
+        "m_tiles": lambda loader, d: (ThingRecord(ThingSection.TERRAIN, d["name"], MapThing(loader)) for i in range(loader.int())),
+        "m_linkedLayers": lambda loader, d: (r for i in range(loader.int()) for r in iter_layer_tiles(loader)),
+    }
+    yield from walk_plan(plan, loader, handlers, keep=("name",))
+
+
+def iter_group_things(loader):
+    version = loader.int()
+    plan = MapThingGroup.schema.plan(version)
+    handlers = {
+        "m_things": lambda loader, d: (ThingRecord(ThingSection.GROUP, d["name"], t) for t in MapThingGroup.iter_things(loader, d["name"])),
+    }
+    yield from walk_plan(plan, loader, handlers, keep=("name",))
+
+
+# Streams the things of a map one at a time without building the MapData, so exporters and
+# filters run in constant memory. sections limits which sections are decoded; the others are
+# skipped. Things are loaded and validated exactly as MapData would.
+def iter_things(stream, sections=tuple(ThingSection)):
+    loader = as_loader(stream)
+    try:
+        plan = MapData.schema.plan(loader.int())
+        yield from walk_plan(plan, loader, thing_handlers(sections), stop_early=True)
+    finally:
+        # a file opened from a path is released once the walk is done
+        if isinstance(stream, str):
+            loader.close()
+
+
+# walk_plan handlers of MapData's thing sections, each yielding ThingRecords
+def thing_handlers(sections=tuple(ThingSection)) -> dict:
+    sections = set(sections)
+    handlers = {}
+    if ThingSection.LEGACY in sections:
+        handlers["m_things"] = lambda loader, d: (ThingRecord(ThingSection.LEGACY, None, t) for t in MapData.iter_legacy_things(loader))
+    if ThingSection.TERRAIN in sections:
+        handlers["m_terrainLayerData"] = lambda loader, d: (r for i in range(loader.int()) for r in iter_layer_tiles(loader))
+    if ThingSection.BACKDROP_FLYER in sections:
+        handlers["preplacedBackdropFlyers"] = lambda loader, d: (ThingRecord(ThingSection.BACKDROP_FLYER, None, t) for t in MapData.iter_backdrop_flyers(loader))
+    if ThingSection.GROUP in sections:
+        handlers["thingGroups"] = lambda loader, d: (r for i in range(loader.int()) for r in iter_group_things(loader))
+    return handlers
+
+
+# Yields a ThingRecord for every thing of a map loaded into MapThing objects, in the order of
+# the map's sections, like iter_things does for a map file
+def loaded_things(map_data: MapData):
+    if map_data.things is not None:
+        raise ValueError("the map's things are in a ThingTable, use its columns instead")
+    for thing in map_data.m_things:
+        yield ThingRecord(ThingSection.LEGACY, None, thing)
+    for layer in getattr(map_data, "m_terrainLayerData", ()):
+        for thing in layer.m_tiles:
+            yield ThingRecord(ThingSection.TERRAIN, layer.name, thing)
+    for thing in getattr(map_data, "preplacedBackdropFlyers", ()):
+        yield ThingRecord(ThingSection.BACKDROP_FLYER, None, thing)
+    for group in map_data.thingGroups:
+        for thing in group.m_things.values():
+            yield ThingRecord(ThingSection.GROUP, group.name, thing)
+
+
+# Plots a map's things, one WebGL scatter trace per thing name. Past max_points things, the
+# plot switches to a density image of the things binned into a bins x bins grid instead.
+def plot_map(map_data: MapData, max_points: int = 200000, bins: int = 512):
+    import numpy as np
+    import plotly.graph_objects as go
+    from ThingTable import ThingTable
+
+    table = ThingTable.from_map(map_data)
+    rows = np.flatnonzero(table.data_type != DataType.BACKDROP_FLYER.value)
+    x, y = table.x[rows], table.y[rows]
+
+    fig = go.Figure()
+    if len(rows) > max_points:
+        counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins)
+        fig.add_trace(go.Heatmap(
+            z=np.log1p(counts.T),
+            x=(x_edges[:-1] + x_edges[1:]) / 2,
+            y=(y_edges[:-1] + y_edges[1:]) / 2,
+            customdata=counts.T,
+            hovertemplate="x=%{x:.0f}<br>y=%{y:.0f}<br>things=%{customdata:.0f}<extra></extra>",
+            colorscale="Viridis",
+            showscale=False,
+        ))
+        fig.update_layout(title="{} ({:,} things, density)".format(map_data.m_name, len(rows)))
+    else:
+        # group the rows by name code once, then each trace is a slice
+        codes = table.name[rows]
+        order = np.argsort(codes, kind="stable")
+        codes, x, y = codes[order], x[order], y[order]
+        names = table.names
+        unique, starts = np.unique(codes, return_index=True)
+        bounds = list(starts) + [len(codes)]
+        for n, code in enumerate(unique):
+            part = slice(bounds[n], bounds[n + 1])
+            fig.add_trace(go.Scattergl(x=x[part], y=y[part], mode="markers", name=names[code] if code >= 0 else "None"))
+        fig.update_layout(title="{} ({:,} things)".format(map_data.m_name, len(rows)))
+    fig.update_yaxes(autorange="reversed")
+    fig.show()
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Read map data from Bastion map files."
     )
-    parser.add_argument("filename")
-    args = parser.parse_args()
-    f = open(args.filename, "rb")
-    map_data = MapData(f)
+    parser.add_argument("filename", nargs="+", help="the map to show, or maps, directories and globs with --batch")
+    parser.add_argument("--batch", action="store_true", help="parse every map found in parallel and print a report")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for --batch, defaults to the CPU count")
+    parser.add_argument("--chunksize", type=int, default=4, help="maps handed to a worker at a time in --batch")
+    parser.add_argument("--profile", action="store_true", help="parse the maps and print how long each section took instead of showing them")
+    parser.add_argument("--memory", action="store_true", help="load the maps with tracemalloc and print their memory per section, class and kind of object")
+    parser.add_argument("--flyweight", action="store_true", help="load the maps with terrain tiles sharing their fields and print the memory saved per map, or measure them so with --memory")
+    parser.add_argument("--max-points", type=int, default=200000, help="things shown as points before the plot becomes a density image")
+    parser.add_argument("--bins", type=int, default=512, help="bins along each axis of the density image")
+    parser.add_argument("--render", metavar="DIR", help="render the maps to PNG files in this directory instead of showing them")
+    parser.add_argument("--tiles", metavar="DIR", help="export each map as an XYZ tile pyramid in DIR/<map name>, re-rendering only changed tiles")
+    parser.add_argument("--query", action="store_true", help="print the things of the maps that pass --type, --name, --group, --layer and --bbox")
+    parser.add_argument("--type", action="append", choices=[t.name for t in DataType], help="with --query, only things of this data type; can be repeated")
+    parser.add_argument("--name", help="with --query, only things whose name matches this glob pattern")
+    parser.add_argument("--group", help="with --query, only things in this thing group")
+    parser.add_argument("--layer", help="with --query, only tiles of this terrain layer")
+    parser.add_argument("--bbox", type=int, nargs=4, metavar=("MIN_X", "MIN_Y", "MAX_X", "MAX_Y"), help="with --query, only things inside this box")
+    parser.add_argument("--diff", action="store_true", help="compare two maps, or two directories of maps, and print what changed")
+    parser.add_argument("--catalog", metavar="DB", help="bring the SQLite catalog DB up to date with the maps, re-parsing only changed ones")
+    parser.add_argument("--find", metavar="NAME", help="with --catalog, print the maps using this thing, spawn, script, group or layer name (or glob)")
+    parser.add_argument("--export", metavar="DIR", help="export the maps' things and spawn data as a columnar dataset partitioned by map")
+    parser.add_argument("--format", choices=("csv", "npz", "parquet"), default="csv", help="file format of --export")
+    parser.add_argument("--batch-size", type=int, default=65536, help="rows per file of --export")
+    parser.add_argument("--scale", type=float, default=None, help="pixels per map unit for --render (0.125) or at the deepest zoom of --tiles (0.25)")
+    parser.add_argument("--data", help="the game's data directory, things missing from its unit, obstacle, generator and loot data are dropped")
+    args = parser.parse_args(argv)
+
+    if args.data:
+        load_game_data(args.data)
+
+    if args.profile:
+        if args.batch:
+            parser.error("--profile parses in this process and can't be combined with --batch")
+        from MapBatch import find_maps
+
+        hooks = ProfileHooks()
+        size = 0
+        started = perf_counter()
+        for path in find_maps(args.filename):
+            with BufferLoadData(path, intern_strings=True) as loader:
+                MapData(loader, hooks=hooks)
+                size += loader.position()
+        seconds = perf_counter() - started
+        print(hooks)
+        print("{:<16} {:>6} {:>12,} {:>10} {:>10.2f} {:>10.1f}".format("total", "", size, "", seconds * 1000, size / 1e6 / max(seconds, 1e-9)))
+        return 0
+
+    if args.memory:
+        from MapBatch import find_maps
+        from MapMemory import measure
+
+        for path in find_maps(args.filename):
+            print("{}: {}\n".format(path, measure(path, tile_templates=TileTemplates() if args.flyweight else None)))
+        return 0
+
+    if args.flyweight:
+        from MapBatch import find_maps
+
+        for path in find_maps(args.filename):
+            templates = TileTemplates()
+            with BufferLoadData(path, intern_strings=True) as loader:
+                MapData(loader, tile_templates=templates)
+            print("{}: {}".format(path, templates))
+        return 0
+
+    if args.query:
+        from MapBatch import find_maps
+        from MapQuery import ThingQuery
+
+        query = ThingQuery(args.type, args.name, args.group, args.layer, args.bbox)
+        for path in find_maps(args.filename):
+            with BufferLoadData(path, intern_strings=True) as loader:
+                for record in query.run(loader):
+                    thing = record.thing
+                    print("\t".join(map(str, (path, record.section.name, record.source or "", thing.data_type.name, thing.m_name,
+                                               thing.m_location[0], thing.m_location[1], getattr(thing, "m_id", "")))))
+        return 0
+
+    if args.diff:
+        from MapDiff import diff_builds, diff_maps
+
+        if len(args.filename) != 2:
+            parser.error("--diff compares two maps or two directories: OLD NEW")
+        old, new = args.filename
+        if os.path.isdir(old) and os.path.isdir(new):
+            results = diff_builds(old, new, workers=args.workers)
+        else:
+            results = [(new, "changed", diff_maps(old, new))]
+        changed = 0
+        for name, status, result in results:
+            if status == "same" or (status == "changed" and not result):
+                continue
+            changed += 1
+            print("{}: {}".format(name, status if result is None else result))
+        print("{} of {} maps changed".format(changed, len(results)))
+        return 1 if changed else 0
+
+    if args.catalog:
+        from MapCatalog import MapCatalog
+
+        with MapCatalog(args.catalog) as catalog:
+            stats = catalog.update(args.filename, workers=args.workers)
+            print("{added} added, {updated} updated, {unchanged} unchanged, {removed} removed, {failed} failed in {seconds:.2f}s".format(**stats))
+            if args.find:
+                for path, kind, count in catalog.where_used(args.find):
+                    print("{}\t{}\t{}".format(path, kind, count))
+        return 1 if stats["failed"] else 0
+
+    if args.export:
+        from MapExport import export_maps
+
+        # maps are streamed, so even one map is exported through the batch runner
+        try:
+            report = export_maps(args.filename, args.export, args.batch_size, args.format, workers=args.workers if args.batch else 1, data_dir=args.data)
+        except ValueError as e:
+            parser.error(str(e))
+        print(report)
+        return 1 if report.failures else 0
+
+    if args.render or args.tiles:
+        if args.render and args.tiles:
+            parser.error("--render and --tiles can't be combined")
+        if args.render:
+            from MapRender import render_maps
+            export, directory, scale = render_maps, args.render, args.scale or 0.125
+        else:
+            from MapTiles import export_maps
+            export, directory, scale = export_maps, args.tiles, args.scale or 0.25
+        # a single map is rendered in this process, several in parallel
+        workers = args.workers if args.batch else 1
+        try:
+            report = export(args.filename, directory, scale, workers, args.chunksize, args.data)
+        except ValueError as e:
+            parser.error(str(e))
+        print(report)
+        return 1 if report.failures else 0
+
+    if args.batch:
+        from MapBatch import parse_maps
+
+        report = parse_maps(args.filename, workers=args.workers, chunksize=args.chunksize, data_dir=args.data)
+        for r in report.parsed:
+            print("{}: {} {} - {} things in {:.3f} s".format(r.path, r.name, r.map_size, r.things, r.seconds))
+        print(report)
+        return 1 if report.failures else 0
+
+    if len(args.filename) > 1:
+        parser.error("only one map can be shown at a time, use --batch for several")
+    with BufferLoadData(args.filename[0], intern_strings=True) as loader:
+        map_data = MapData(loader)
 
     print(map_data)
-    things = []
-    for thing in map_data.m_things:
-        things.append(thing.to_dict())
-    for group in map_data.thingGroups:
-        for thing in group.m_things:
-            t = group.m_things[thing]
-            things.append(t.to_dict())
-
-    for t in map_data.m_terrainLayerData:
-        for thing in t.m_tiles:
-            things.append(thing.to_dict())
+    plot_map(map_data, max_points=args.max_points, bins=args.bins)
+    return 0
 
 
-    things = [x for x in things if x['data_type'] != DataType.BACKDROP_FLYER]
+# main
+if __name__ == "__main__":
+    # run main from the imported module rather than __main__, so the helper modules it loads
+    # (MapBatch, ThingTable...) share one copy of these classes with it
+    from CaelondianAtlas import main
 
-    fig = px.scatter(things, x="x", y="y", color="m_name")
-    fig.update_yaxes(autorange='reversed')
-    fig.show()
\ No newline at end of file
+    raise SystemExit(main())
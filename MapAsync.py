@@ -0,0 +1,114 @@
+import asyncio
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import NamedTuple
+
+from CaelondianAtlas import BufferLoadData, MapData, ParseHooks, SectionEvent
+from ThingTable import ThingTable
+
+
+# Result of one map of load_maps. error is None when the map loaded, otherwise the exception
+# it raised, and map_data is None.
+class LoadResult(NamedTuple):
+    path: str
+    map_data: MapData = None
+    error: BaseException = None
+
+
+# Raised inside a decode that was cancelled, see CancelHooks
+class LoadCancelled(Exception):
+    pass
+
+
+# Stops a decode running in a thread once its load is cancelled. Threads can't be interrupted,
+# so the decode checks the event between the map's sections and gives up at the next one.
+class CancelHooks(ParseHooks):
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def section_start(self, section: str, offset: int):
+        if self.cancelled.is_set():
+            raise LoadCancelled(section)
+
+    def section_end(self, event: SectionEvent):
+        if self.cancelled.is_set():
+            raise LoadCancelled(event.section)
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# Decodes a map from the file's contents, in a worker thread
+def decode_map(data: bytes, thing_table: bool, hooks: ParseHooks) -> MapData:
+    with BufferLoadData(data, intern_strings=True) as loader:
+        return MapData(loader, thing_table=ThingTable() if thing_table else None, hooks=hooks)
+
+
+# Reads and decodes a map in a worker process, which sends back only the MapData
+def load_file(path: str, thing_table: bool) -> MapData:
+    with BufferLoadData(path, intern_strings=True) as loader:
+        return MapData(loader, thing_table=ThingTable() if thing_table else None)
+
+
+async def load_map(path: str, executor: Executor = None, thing_table: bool = False) -> MapData:
+    """
+    Load a map without blocking the event loop. The file is read in one go in the loop's
+    default thread pool and decoded in executor; with a ProcessPoolExecutor, the worker
+    process reads and decodes it and only the MapData comes back. Cancelling the call stops a
+    thread's decode at the map's next section, and a process's before it starts
+    :param path: The .map file
+    :param executor: Where the map is decoded, by default the loop's default thread pool
+    :param thing_table: Load the map's things into a ThingTable, see MapData(thing_table=...)
+    :return: The MapData
+    """
+    loop = asyncio.get_running_loop()
+    if isinstance(executor, ProcessPoolExecutor):
+        return await loop.run_in_executor(executor, load_file, path, thing_table)
+
+    data = await loop.run_in_executor(None, read_file, path)
+    hooks = CancelHooks()
+    try:
+        return await loop.run_in_executor(executor, decode_map, data, thing_table, hooks)
+    except asyncio.CancelledError:
+        hooks.cancelled.set()
+        raise
+
+
+async def load_maps(paths, executor: Executor = None, limit: int = 4, thing_table: bool = False):
+    """
+    Load many maps with at most limit of them in flight at once, see load_map. Results come in
+    the order the maps finish loading; a map that fails to load yields its error instead of
+    ending the iteration. Closing the iterator, or cancelling the task iterating it, cancels
+    the loads still running
+    :param paths: Map files
+    :param executor: Where the maps are decoded, by default the loop's default thread pool
+    :param limit: Maps read and decoded at the same time
+    :param thing_table: Load the maps' things into ThingTables
+    :return: An async iterator of LoadResult
+    """
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+    pending = {}
+    paths = iter(paths)
+    try:
+        while True:
+            # keep limit loads running, starting the next map as soon as one finishes
+            for path in paths:
+                pending[asyncio.ensure_future(load_map(path, executor, thing_table))] = path
+                if len(pending) >= limit:
+                    break
+            if not pending:
+                return
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                path = pending.pop(task)
+                error = task.exception()
+                yield LoadResult(path, error=error) if error is not None else LoadResult(path, task.result())
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            # let the cancelled loads unwind before the caller moves on
+            await asyncio.wait(pending)
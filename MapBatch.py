@@ -0,0 +1,168 @@
+import os
+import time
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+from CaelondianAtlas import BufferLoadData, MapData, load_game_data
+
+
+# Compact result for one map, cheap to send back from a worker process.
+# error is None when the map parsed, otherwise "ExceptionType: message".
+class MapSummary(NamedTuple):
+    path: str
+    size: int
+    seconds: float
+    error: str = None
+    name: str = None
+    map_size: tuple = None
+    music: str = None
+    terrain_layers: int = 0
+    terrain_tiles: int = 0
+    thing_groups: int = 0
+    group_things: int = 0
+    legacy_things: int = 0
+    backdrop_flyers: int = 0
+    spawn_points: int = 0
+
+    @property
+    def things(self) -> int:
+        return self.terrain_tiles + self.group_things + self.legacy_things + self.backdrop_flyers
+
+
+# Aggregate of a batch run
+class BatchReport:
+    def __init__(self, results: list, seconds: float, workers: int):
+        self.results = results
+        self.seconds = seconds
+        self.workers = workers
+
+    @property
+    def failures(self) -> list:
+        return [r for r in self.results if r.error is not None]
+
+    @property
+    def parsed(self) -> list:
+        return [r for r in self.results if r.error is None]
+
+    @property
+    def bytes(self) -> int:
+        return sum(r.size for r in self.results)
+
+    @property
+    def things(self) -> int:
+        return sum(r.things for r in self.parsed)
+
+    def __str__(self) -> str:
+        seconds = max(self.seconds, 1e-9)
+        lines = [
+            "{} maps ({} parsed, {} failed) in {:.2f} s with {} workers".format(
+                len(self.results), len(self.parsed), len(self.failures), self.seconds, self.workers),
+            "{:.1f} MB/s, {:.1f} maps/s, {:.0f} things/s".format(
+                self.bytes / 1e6 / seconds, len(self.results) / seconds, self.things / seconds),
+        ]
+        for r in self.failures:
+            lines.append("FAILED {}: {}".format(r.path, r.error))
+        return "\n".join(lines)
+
+
+def find_maps(paths: list, pattern: str = "*.map") -> list:
+    """
+    Expand directories (recursively) and glob patterns into a sorted list of map files
+    :param paths: Files, directories or glob patterns
+    :param pattern: The file pattern to look for inside directories
+    :return: The unique map paths found
+    """
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            found.update(glob(os.path.join(path, "**", pattern), recursive=True))
+        elif os.path.isfile(path):
+            found.add(path)
+        else:
+            found.update(p for p in glob(path, recursive=True) if os.path.isfile(p))
+    return sorted(found)
+
+
+def map_name(path: str) -> str:
+    # what a map's output (export partition, render, tile pyramid) is named after
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def check_names(files: list):
+    """
+    Make sure no two maps would write their output under the same name. Directories are
+    searched recursively, so maps with the same file name can come from different folders
+    :param files: The map paths
+    :raise ValueError: Naming the maps that clash
+    """
+    paths = {}
+    for path in files:
+        paths.setdefault(map_name(path), []).append(path)
+    clashes = ["{}: {}".format(name, ", ".join(same)) for name, same in paths.items() if len(same) > 1]
+    if clashes:
+        raise ValueError("maps with the same name would overwrite each other's output, " + "; ".join(clashes))
+
+
+def summarize_map(path: str) -> MapSummary:
+    """
+    Parse one map and reduce it to a MapSummary. Never raises for a bad map file
+    :param path: The map to parse
+    :return: The summary, with error set if the map couldn't be parsed
+    """
+    start = time.perf_counter()
+    size = 0
+    try:
+        size = os.path.getsize(path)
+        with BufferLoadData(path, intern_strings=True) as loader:
+            map_data = MapData(loader)
+    except Exception as e:
+        return MapSummary(path, size, time.perf_counter() - start, error="{}: {}".format(type(e).__name__, e))
+    return summary_of(map_data, path, size, time.perf_counter() - start)
+
+
+def summary_of(map_data: MapData, path: str, size: int, seconds: float) -> MapSummary:
+    layers = getattr(map_data, "m_terrainLayerData", [])
+    groups = map_data.thingGroups
+    return MapSummary(
+        path,
+        size,
+        seconds,
+        name=getattr(map_data, "m_name", None),
+        map_size=getattr(map_data, "m_size", None),
+        music=getattr(map_data, "MusicName", None),
+        terrain_layers=len(layers),
+        terrain_tiles=sum(len(layer.m_tiles) for layer in layers),
+        thing_groups=len(groups),
+        group_things=sum(len(group.m_things) for group in groups),
+        legacy_things=len(map_data.m_things),
+        backdrop_flyers=len(getattr(map_data, "preplacedBackdropFlyers", [])),
+        spawn_points=len(getattr(map_data, "m_spawnPointData", [])),
+    )
+
+
+def parse_maps(paths: list, workers: int = None, chunksize: int = 4, parse=summarize_map, data_dir: str = None, unique_names: bool = False) -> BatchReport:
+    """
+    Parse every map under the given paths in parallel
+    :param paths: Files, directories or glob patterns, see find_maps
+    :param workers: Worker processes, defaults to the CPU count; 1 parses in this process
+    :param chunksize: Maps handed to a worker at a time
+    :param parse: The picklable per-map function, summarize_map by default
+    :param data_dir: The game's data directory, loaded into the default GameDataManager of this process and every worker
+    :param unique_names: Fail before parsing anything if two maps have the same name, see check_names
+    :return: A BatchReport with one result per map, in path order
+    """
+    files = find_maps(paths)
+    if unique_names:
+        check_names(files)
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    if data_dir is not None:
+        load_game_data(data_dir)
+    if workers == 1 or len(files) <= 1:
+        results = [parse(path) for path in files]
+    else:
+        initializer = None if data_dir is None else load_game_data
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=(data_dir,)) as executor:
+            results = list(executor.map(parse, files, chunksize=max(1, chunksize)))
+    return BatchReport(results, time.perf_counter() - start, workers)
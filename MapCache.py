@@ -0,0 +1,270 @@
+import os
+import json
+import hashlib
+import tempfile
+import zipfile
+from enum import Enum
+
+import numpy as np
+
+from CaelondianAtlas import (
+    BufferLoadData, MapData, MapThing, MapThingGroup, TerrainLayerData, BloomSettings, Color,
+    SpawnPointData, SpawnWaveData, SpawnData, DataType, DrawLayer, TerrainTileType, Shader,
+    ThingSection, GameDataManager, game_data,
+)
+from ThingTable import ThingTable
+from SpatialIndex import SpatialIndex
+
+# Bump when the snapshot layout changes. Changes to the parser's schemas are picked up on their
+# own through schema_digest().
+CACHE_FORMAT = 5
+
+SNAPSHOT_CLASSES = {cls.__qualname__: cls for cls in (
+    Color, BloomSettings, MapThingGroup, TerrainLayerData, SpawnPointData, SpawnWaveData,
+    SpawnWaveData.Scale, SpawnData,
+)}
+SNAPSHOT_ENUMS = {cls.__qualname__: cls for cls in (
+    DataType, DrawLayer, TerrainTileType, Shader, TerrainLayerData.BlendFilter, ThingSection,
+)}
+
+
+def read_name(read) -> str:
+    # names a field's read function, and the functions and names its closure wraps (list_of's
+    # item reader, timed_section's section reader), without any object addresses
+    name = getattr(read, "__qualname__", None)
+    if name is None:
+        # methodcaller('string') and the like
+        return repr(read)
+    wrapped = []
+    for cell in getattr(read, "__closure__", None) or ():
+        value = cell.cell_contents
+        if callable(value) and value is not read:
+            wrapped.append(read_name(value))
+        elif isinstance(value, (str, int)):
+            wrapped.append(repr(value))
+    return "{}.{}({})".format(getattr(read, "__module__", ""), name, ", ".join(wrapped))
+
+
+def schema_digest() -> str:
+    """
+    Digest of every schema the parser decodes with, so a parser upgrade invalidates old entries
+    :return: A hex digest
+    """
+    h = hashlib.sha256(str(CACHE_FORMAT).encode())
+    for cls in (MapData, MapThing, MapThingGroup, TerrainLayerData, BloomSettings, SpawnPointData, SpawnWaveData, SpawnData):
+        for field in cls.schema.fields:
+            kind = field.kind.fmt if hasattr(field.kind, "fmt") else read_name(field.kind.read)
+            h.update("{}.{}:{}-{}:{};".format(cls.__name__, field.name, field.first, field.last, kind).encode())
+    return h.hexdigest()
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Turns the non-thing parts of a MapData into JSON-compatible values. Objects that appear more
+# than once (linked terrain layers are also in the flattened layer list) are stored once and
+# referenced by index, so identity survives the round trip.
+class SnapshotEncoder:
+    def __init__(self):
+        self.objects = []
+        self.seen = {}
+
+    def encode(self, value):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, Enum):
+            return {"enum": type(value).__qualname__, "name": value.name}
+        if isinstance(value, tuple):
+            return {"tuple": [self.encode(v) for v in value]}
+        if isinstance(value, range):
+            return {"range": [value.start, value.stop]}
+        if isinstance(value, list):
+            return [self.encode(v) for v in value]
+        if type(value).__qualname__ in SNAPSHOT_CLASSES:
+            ref = self.seen.get(id(value))
+            if ref is None:
+                ref = self.seen[id(value)] = len(self.objects)
+                self.objects.append(None)
+                self.objects[ref] = {
+                    "class": type(value).__qualname__,
+                    "fields": {k: self.encode(v) for k, v in vars(value).items()},
+                }
+            return {"ref": ref}
+        raise TypeError("can't snapshot {}".format(type(value).__name__))
+
+
+class SnapshotDecoder:
+    def __init__(self, objects: list):
+        self.objects = objects
+        self.built = [None] * len(objects)
+
+    def decode(self, value):
+        if isinstance(value, list):
+            return [self.decode(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        if "ref" in value:
+            return self.build(value["ref"])
+        if "enum" in value:
+            return SNAPSHOT_ENUMS[value["enum"]][value["name"]]
+        if "tuple" in value:
+            return tuple(self.decode(v) for v in value["tuple"])
+        if "range" in value:
+            return range(*value["range"])
+        raise ValueError("bad snapshot value {}".format(value))
+
+    def build(self, ref: int):
+        obj = self.built[ref]
+        if obj is None:
+            spec = self.objects[ref]
+            cls = SNAPSHOT_CLASSES[spec["class"]]
+            obj = self.built[ref] = cls.__new__(cls)
+            obj.__dict__.update({k: self.decode(v) for k, v in spec["fields"].items()})
+        return obj
+
+
+# Persistent parse cache for MapData. Entries are keyed by the map's fingerprint (path, size
+# and mtime, or the sha256 of its contents when hash_content is set) plus schema_digest() and
+# the digest of the game data things were validated against, and hold a compact snapshot: the
+# ThingTable columns as NumPy arrays and the rest of the map, string tables included, as JSON,
+# along with the map's SpatialIndex. Nothing is pickled. A hit rebuilds the MapData from the
+# snapshot without touching BinaryLoadData. The directory is kept under max_bytes by evicting
+# the least recently used entries.
+#
+#   cache = MapCache("~/.cache/caelondian")
+#   map_data = cache.load("Maps/ProtoIntro01.map")
+#   map_data.things.where(data_type=DataType.UNIT)
+class MapCache:
+    suffix = ".npz"
+
+    def __init__(self, directory: str, max_bytes: int = 512 << 20, hash_content: bool = False, game_data: GameDataManager = None):
+        self.directory = os.path.expanduser(directory)
+        self.game_data = game_data
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        self.schema = schema_digest()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, path: str) -> str:
+        if self.hash_content:
+            fingerprint = "content:" + hash_file(path)
+        else:
+            st = os.stat(path)
+            fingerprint = "file:{}:{}:{}".format(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        # the default registry can still be loaded after the cache is made
+        data = (self.game_data or game_data).digest()
+        return hashlib.sha256("{}|{}|{}".format(self.schema, data, fingerprint).encode()).hexdigest()
+
+    def entry(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def load(self, path: str) -> MapData:
+        """
+        Load a map through the cache
+        :param path: The .map file
+        :return: A MapData whose things are in a ThingTable, see MapData(thing_table=...)
+        """
+        entry = self.entry(self.key(path))
+        map_data = self.read(entry)
+        if map_data is not None:
+            self.hits += 1
+            # refresh the entry's position in the LRU order
+            os.utime(entry)
+            return map_data
+
+        self.misses += 1
+        with BufferLoadData(path, intern_strings=True) as loader:
+            map_data = MapData(loader, thing_table=ThingTable(), game_data=self.game_data)
+        self.write(entry, map_data)
+        self.evict()
+        return map_data
+
+    def read(self, entry: str):
+        try:
+            with np.load(entry, allow_pickle=False) as snapshot:
+                meta = json.loads(snapshot["meta"].tobytes())
+                if meta["schema"] != self.schema:
+                    return None
+                columns = {name: snapshot["column_" + name] for name in meta["columns"]}
+                spatial = {name: snapshot["spatial_" + name] for name in meta["spatial"]}
+
+            decoder = SnapshotDecoder(meta["objects"])
+            map_data = MapData.__new__(MapData)
+            map_data.__dict__.update({k: decoder.decode(v) for k, v in meta["map"].items()})
+            map_data.things = ThingTable.from_columns(columns, meta["names"], meta["groups"], meta["layers"])
+            map_data.spatial = SpatialIndex.from_arrays(spatial)
+        except (OSError, LookupError, TypeError, ValueError, EOFError, zipfile.BadZipFile):
+            # missing, truncated, foreign or forged entries are just misses
+            return None
+        return map_data
+
+    def write(self, entry: str, map_data: MapData):
+        things = map_data.things
+        encoder = SnapshotEncoder()
+        spatial = map_data.spatial_index().arrays()
+        fields = {k: encoder.encode(v) for k, v in vars(map_data).items() if k not in ("things", "spatial")}
+        meta = {
+            "schema": self.schema,
+            "map": fields,
+            "objects": encoder.objects,
+            "names": things.names,
+            "groups": things.groups,
+            "layers": things.layers,
+            "columns": list(things.columns),
+            "spatial": list(spatial),
+        }
+        arrays = {"column_" + name: column for name, column in things.columns.items()}
+        arrays.update({"spatial_" + name: array for name, array in spatial.items()})
+        arrays["meta"] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+
+        # write to a temporary file first so readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, entry)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def entries(self) -> list:
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+        return entries
+
+    def size(self) -> int:
+        return sum(size for mtime, size, path in self.entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        :return: None
+        """
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            os.unlink(path)
@@ -0,0 +1,245 @@
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from CaelondianAtlas import BufferLoadData, MapData, GameDataManager, game_data, loaded_things
+from MapCache import hash_file, schema_digest
+
+# Bump when the tables change; a catalog of another format is rebuilt from scratch
+CATALOG_FORMAT = 1
+
+# the tables of the catalog, and the indexes of the lookups it's made for
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS maps (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, fingerprint TEXT NOT NULL, size INTEGER,
+    version INTEGER, name TEXT, music TEXT, loot_table TEXT, things INTEGER, seconds REAL, error TEXT
+);
+CREATE TABLE IF NOT EXISTS things (
+    map_id INTEGER NOT NULL, section TEXT, source TEXT, idx INTEGER, data_type TEXT, name TEXT,
+    x INTEGER, y INTEGER, thing_id INTEGER, group_names TEXT
+);
+CREATE TABLE IF NOT EXISTS groups (map_id INTEGER NOT NULL, name TEXT, things INTEGER, visible INTEGER, selectable INTEGER);
+CREATE TABLE IF NOT EXISTS layers (map_id INTEGER NOT NULL, name TEXT, tiles INTEGER, linked_to TEXT);
+CREATE TABLE IF NOT EXISTS spawn_points (map_id INTEGER NOT NULL, point INTEGER, name TEXT, waves INTEGER);
+CREATE TABLE IF NOT EXISTS spawns (map_id INTEGER NOT NULL, point INTEGER, wave INTEGER, name TEXT, num INTEGER);
+CREATE TABLE IF NOT EXISTS scripts (map_id INTEGER NOT NULL, name TEXT);
+CREATE INDEX IF NOT EXISTS things_name ON things (name);
+CREATE INDEX IF NOT EXISTS things_type_name ON things (data_type, name);
+CREATE INDEX IF NOT EXISTS things_map ON things (map_id);
+CREATE INDEX IF NOT EXISTS groups_name ON groups (name);
+CREATE INDEX IF NOT EXISTS groups_map ON groups (map_id);
+CREATE INDEX IF NOT EXISTS layers_name ON layers (name);
+CREATE INDEX IF NOT EXISTS layers_map ON layers (map_id);
+CREATE INDEX IF NOT EXISTS spawn_points_map ON spawn_points (map_id);
+CREATE INDEX IF NOT EXISTS spawns_name ON spawns (name);
+CREATE INDEX IF NOT EXISTS spawns_map ON spawns (map_id);
+CREATE INDEX IF NOT EXISTS scripts_name ON scripts (name);
+CREATE INDEX IF NOT EXISTS scripts_map ON scripts (map_id);
+"""
+
+# tables with a row per item of a map, all keyed by map_id
+MAP_TABLES = ("things", "groups", "layers", "spawn_points", "spawns", "scripts")
+
+# rows inserted per executemany call
+BATCH_SIZE = 10000
+
+
+def map_rows(path: str, registry: GameDataManager = None) -> dict:
+    """
+    Parse a map into the rows the catalog stores for it, without their map_id. Runs in a
+    worker process, so only plain tuples are sent back. Never raises for a bad map file
+    :param path: The .map file
+    :param registry: The game data things are validated against, by default the default registry
+    :return: The "maps" row fields and the rows of each of MAP_TABLES, or "error"
+    """
+    start = time.perf_counter()
+    try:
+        with BufferLoadData(path, intern_strings=True) as loader:
+            map_data = MapData(loader, game_data=registry)
+    except Exception as e:
+        return {"seconds": time.perf_counter() - start, "error": "{}: {}".format(type(e).__name__, e)}
+
+    things = []
+    # position of each thing in its section and group or layer
+    counts = {}
+    for record in loaded_things(map_data):
+        thing = record.thing
+        key = (record.section, record.source)
+        index = counts.get(key, 0)
+        counts[key] = index + 1
+        things.append((record.section.name, record.source, index, thing.data_type.name, thing.m_name,
+                       thing.m_location[0], thing.m_location[1], getattr(thing, "m_id", None),
+                       ";".join(getattr(thing, "m_groupNames", ()))))
+
+    layers = getattr(map_data, "m_terrainLayerData", [])
+    linked_to = {id(linked): layer.name for layer in layers for linked in layer.m_linkedLayers}
+    spawn_points, spawns = [], []
+    for p, point in enumerate(getattr(map_data, "m_spawnPointData", [])):
+        spawn_points.append((p, point.m_name, len(point.m_spawnWaves)))
+        for w, wave in enumerate(point.m_spawnWaves):
+            spawns.extend((p, w, spawn.m_name, spawn.m_num) for spawn in wave.m_spawns)
+    return {
+        "version": map_data.version,
+        "name": getattr(map_data, "m_name", None),
+        "music": getattr(map_data, "MusicName", None),
+        "loot_table": getattr(map_data, "m_lootTableName", None),
+        "seconds": time.perf_counter() - start,
+        "things": things,
+        "groups": [(group.name, len(group.m_things), bool(getattr(group, "m_visible", True)), bool(getattr(group, "m_selectable", True)))
+                   for group in map_data.thingGroups],
+        "layers": [(layer.name, len(layer.m_tiles), linked_to.get(id(layer))) for layer in layers],
+        "spawn_points": spawn_points,
+        "spawns": spawns,
+        "scripts": [(name,) for name in getattr(map_data, "m_scripts", [])],
+    }
+
+
+# SQLite catalog of every map of a corpus: the maps, their things, thing groups, terrain layers,
+# spawn points, spawns and scripts, indexed for lookups by name, so finding where something is
+# used is a query instead of a parse of every map. update() only re-parses the maps whose
+# fingerprint (path, size and mtime, or content hash, plus the parser's schemas and game data)
+# changed, in parallel, and writes each map in one transaction with batched inserts.
+#
+#   catalog = MapCatalog("atlas.db")
+#   catalog.update(["Maps/"])
+#   catalog.where_used("Crate01")   # [("Maps/ProtoIntro01.map", "things", 12), ...]
+class MapCatalog:
+    def __init__(self, path: str, hash_content: bool = False, game_data: GameDataManager = None):
+        """
+        :param path: The database file, created if missing
+        :param hash_content: Fingerprint maps by the sha256 of their contents instead of their mtime
+        :param game_data: The registry maps are validated against, by default the module's default one
+        """
+        self.path = path
+        self.hash_content = hash_content
+        self.game_data = game_data
+        self.schema = schema_digest()
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        with self.db:
+            self.db.executescript(SCHEMA)
+            row = self.db.execute("SELECT value FROM info WHERE key = 'format'").fetchone()
+            if row is None or int(row[0]) != CATALOG_FORMAT:
+                for table in ("maps",) + MAP_TABLES:
+                    self.db.execute("DELETE FROM " + table)
+                self.db.execute("INSERT OR REPLACE INTO info VALUES ('format', ?)", (str(CATALOG_FORMAT),))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def fingerprint(self, path: str, data: str) -> str:
+        # data is the digest of the game data the map would be validated against
+        st = os.stat(path)
+        file = "content:" + hash_file(path) if self.hash_content else "file:{}:{}".format(st.st_size, st.st_mtime_ns)
+        return "{}|{}|{}".format(self.schema, data, file)
+
+    def update(self, paths: list, workers: int = None, prune: bool = True) -> dict:
+        """
+        Bring the catalog up to date with the maps under paths
+        :param paths: Files, directories or glob patterns, see MapBatch.find_maps
+        :param workers: Processes parsing changed maps, defaults to the CPU count; 1 parses in this process
+        :param prune: Remove maps whose file no longer exists
+        :return: How many maps were "added", "updated", "unchanged", "removed" and "failed", and the "seconds" it took
+        """
+        from MapBatch import find_maps
+
+        start = time.perf_counter()
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0, "failed": 0}
+        known = {path: (map_id, fingerprint) for map_id, path, fingerprint in self.db.execute("SELECT id, path, fingerprint FROM maps")}
+
+        # the default registry can still be loaded after the catalog is opened
+        registry = self.game_data or game_data
+        data = registry.digest()
+        stale = []
+        for path in find_maps(paths):
+            path = os.path.abspath(path)
+            fingerprint = self.fingerprint(path, data)
+            map_id, old = known.get(path, (None, None))
+            if old == fingerprint:
+                stats["unchanged"] += 1
+            else:
+                stale.append((path, fingerprint, map_id))
+
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(stale) <= 1:
+            results = (map_rows(path, registry) for path, fingerprint, map_id in stale)
+            executor = None
+        else:
+            # workers validate things against the same game data as this process
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=share_game_data, initargs=(registry,))
+            results = executor.map(map_rows, [path for path, fingerprint, map_id in stale], chunksize=2)
+        try:
+            for (path, fingerprint, map_id), rows in zip(stale, results):
+                self.write(path, fingerprint, map_id, rows)
+                stats["failed" if "error" in rows else "added" if map_id is None else "updated"] += 1
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        if prune:
+            for path, (map_id, fingerprint) in known.items():
+                if not os.path.exists(path):
+                    with self.db:
+                        self.delete(map_id)
+                    stats["removed"] += 1
+        stats["seconds"] = time.perf_counter() - start
+        return stats
+
+    def delete(self, map_id: int):
+        for table in MAP_TABLES:
+            self.db.execute("DELETE FROM {} WHERE map_id = ?".format(table), (map_id,))
+        self.db.execute("DELETE FROM maps WHERE id = ?", (map_id,))
+
+    def write(self, path: str, fingerprint: str, map_id: int, rows: dict):
+        # replaces a map's rows in one transaction
+        with self.db:
+            if map_id is not None:
+                self.delete(map_id)
+            map_id = self.db.execute(
+                "INSERT INTO maps (path, fingerprint, size, version, name, music, loot_table, things, seconds, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, fingerprint, os.path.getsize(path), rows.get("version"), rows.get("name"), rows.get("music"),
+                 rows.get("loot_table"), len(rows.get("things", ())), rows["seconds"], rows.get("error")),
+            ).lastrowid
+            for table in MAP_TABLES:
+                table_rows = rows.get(table)
+                if not table_rows:
+                    continue
+                sql = "INSERT INTO {} VALUES (?{})".format(table, ", ?" * len(table_rows[0]))
+                for i in range(0, len(table_rows), BATCH_SIZE):
+                    self.db.executemany(sql, ((map_id,) + row for row in table_rows[i:i + BATCH_SIZE]))
+
+    def query(self, sql: str, params=()) -> list:
+        return self.db.execute(sql, params).fetchall()
+
+    def where_used(self, name: str) -> list:
+        """
+        Every map that uses a name as a thing, spawn, script, thing group or terrain layer
+        :param name: The name, or a GLOB pattern such as "Crate*"
+        :return: (map path, table, rows) tuples, by map path
+        """
+        op = "GLOB" if any(c in name for c in "*?[") else "="
+        parts = []
+        for table in ("things", "spawns", "scripts", "groups", "layers"):
+            parts.append("SELECT map_id, '{0}' AS kind, count(*) AS n FROM {0} WHERE name {1} ? GROUP BY map_id".format(table, op))
+        sql = "SELECT maps.path, used.kind, used.n FROM ({}) AS used JOIN maps ON maps.id = used.map_id ORDER BY maps.path, used.kind".format(
+            " UNION ALL ".join(parts))
+        return self.query(sql, (name,) * len(parts))
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT count(*) FROM maps").fetchone()[0]
+
+
+# Worker initializer of MapCatalog.update: copies the catalog's game data into the worker's
+# default registry
+def share_game_data(registry: GameDataManager):
+    game_data.definitions = registry.definitions
+    game_data.clear_memo()
@@ -0,0 +1,331 @@
+import filecmp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from typing import NamedTuple
+
+from CaelondianAtlas import (
+    BufferLoadData, MapData, MapThing, MapThingGroup, SpawnPointData, TerrainLayerData, Color, ThingSection,
+)
+from MapSchema import Plan
+
+# see segments
+SEGMENTS = {}
+
+# the fields of a thing that name its group, which follow it into another group
+GROUP_FIELDS = ("m_groupName", "m_groupNames")
+
+# a thing that only changed these fields was moved
+LOCATION_FIELDS = frozenset(("m_location", "m_endLocation"))
+
+
+# Turns a loaded value into plain comparable (and JSON friendly) data
+def plain(value):
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, Color):
+        return value.r, value.g, value.b, value.a
+    if isinstance(value, (list, tuple)):
+        return [plain(v) for v in value]
+    if isinstance(value, dict):
+        return {k: plain(v) for k, v in value.items()}
+    if hasattr(value, "__dict__"):
+        return {k: plain(v) for k, v in vars(value).items() if k not in ("saved_fields", "dropped")}
+    return value
+
+
+def changed_fields(old: dict, new: dict, skip=()) -> dict:
+    # field name -> (old, new) for the fields of two records that differ
+    fields = {}
+    for name in list(old) + [name for name in new if name not in old]:
+        if name in skip or name in ("saved_fields", "dropped"):
+            continue
+        a, b = plain(old.get(name)), plain(new.get(name))
+        if a != b:
+            fields[name] = (a, b)
+    return fields
+
+
+# One difference between two maps. what is "thing", "layer", "group", "spawn_point" or "map";
+# kind is "added", "removed", "moved" or "modified". key identifies the record: for things
+# (section, group or layer, m_id, n) where n counts earlier things there with the same id, for
+# layers, groups and spawn points (name, n). fields maps changed field names to (old, new).
+class Change(NamedTuple):
+    what: str
+    kind: str
+    key: tuple
+    fields: dict = {}
+
+    def __str__(self) -> str:
+        line = "{} {} {}".format(self.kind, self.what, "/".join(map(str, self.key)))
+        if self.fields:
+            line += ": " + ", ".join("{} {!r} -> {!r}".format(name, a, b) for name, (a, b) in self.fields.items())
+        return line
+
+
+# The changes between two versions of a map, and how many records were the same
+class MapDiff:
+    def __init__(self, changes: list, unchanged: int):
+        self.changes = changes
+        self.unchanged = unchanged
+
+    def __bool__(self) -> bool:
+        return bool(self.changes)
+
+    def counts(self) -> dict:
+        counts = {}
+        for change in self.changes:
+            key = "{} {}".format(change.kind, change.what)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def __str__(self) -> str:
+        if not self.changes:
+            return "no changes ({} records)".format(self.unchanged)
+        summary = ", ".join("{} {}".format(n, key) for key, n in sorted(self.counts().items()))
+        return "\n".join(["{} ({} records unchanged)".format(summary, self.unchanged)] + [str(change) for change in self.changes])
+
+
+# (*key, n), n counting the earlier records with the same key
+def numbered(counts: dict, *key) -> tuple:
+    n = counts.get(key, 0)
+    counts[key] = n + 1
+    return key + (n,)
+
+
+# Plans of the runs of fields between a plan's sections, each with the section that follows it:
+# [(Plan, section field or None)]. Cached per plan, like Plan.split.
+def segments(plan: Plan, sections: frozenset) -> list:
+    key = (id(plan), sections)
+    parts = SEGMENTS.get(key)
+    if parts is None:
+        parts = []
+        run = []
+        for field in plan.fields:
+            if field.name in sections:
+                parts.append((Plan(run), field))
+                run = []
+            else:
+                run.append(field)
+        parts.append((Plan(run), None))
+        SEGMENTS[key] = parts
+    return parts
+
+
+# The records of one map file that diff_maps compares, read in one pass straight from its bytes.
+# The map's header, layers and groups are decoded; things and spawn points are kept as the
+# bytes they were saved as, so two versions of one compare with a single bytes comparison.
+# Things are read as the file holds them, before MapData validates them against the game data
+# or moves them into their group.
+class MapRecords:
+    def __init__(self, stream):
+        """
+        :param stream: A path to a map file, or its contents, e.g. map_data.dump()
+        """
+        self.things = {}
+        self.layers = {}
+        self.groups = {}
+        self.spawn_points = {}
+        self.counts = {}
+        layer_counts, group_counts = {}, {}
+        handlers = {
+            "m_things": lambda d: self.read_things(ThingSection.LEGACY, None),
+            "preplacedBackdropFlyers": lambda d: self.read_things(ThingSection.BACKDROP_FLYER, None),
+            "m_terrainLayerData": lambda d: [self.read_layer(layer_counts) for i in range(self.loader.int())],
+            "thingGroups": lambda d: [self.read_group(group_counts) for i in range(self.loader.int())],
+            "m_spawnPointData": lambda d: self.read_spawn_points(),
+        }
+        self.loader = BufferLoadData(stream)
+        try:
+            self.header = self.read_record(MapData.schema, handlers)
+        finally:
+            self.loader.close()
+            del self.loader
+
+    def read_record(self, schema, handlers: dict) -> dict:
+        # decodes a versioned record, passing its sections to their handlers instead
+        loader = self.loader
+        d = {"version": loader.int()}
+        for plan, field in segments(schema.plan(d["version"]), frozenset(handlers)):
+            plan.decode(loader, d)
+            if field is not None:
+                handlers[field.name](d)
+        return d
+
+    def read_things(self, section: ThingSection, source: str) -> list:
+        # keeps the bytes of each thing of a thing list, returns their ids
+        loader = self.loader
+        view = loader.view
+        ids = []
+        for i in range(loader.int()):
+            start = loader.position()
+            version = loader.int()
+            # the compiled decoder gets past a thing faster than skipping its fields one by one
+            d = {}
+            MapThing.schema.plan(version).decode(loader, d)
+            thing_id = d.get("m_id")
+            ids.append(thing_id)
+            self.things[numbered(self.counts, section.name, source, thing_id)] = bytes(view[start:loader.position()])
+        return ids
+
+    def read_spawn_points(self):
+        loader = self.loader
+        counts = {}
+        for i in range(loader.int()):
+            start = loader.position()
+            point = SpawnPointData.read(loader)
+            self.spawn_points[numbered(counts, point.m_name)] = bytes(loader.view[start:loader.position()])
+
+    def read_layer(self, counts: dict):
+        # a layer is numbered before its linked layers, which follow it as in MapData.m_terrainLayerData
+        layer = {"tiles": 0}
+
+        def tiles(d):
+            layer["tiles"] = len(self.read_things(ThingSection.TERRAIN, d["name"]))
+            layer["key"] = numbered(counts, d["name"])
+
+        def linked_layers(d):
+            for i in range(self.loader.int()):
+                self.read_layer(counts)
+
+        d = self.read_record(TerrainLayerData.schema, {"m_tiles": tiles, "m_linkedLayers": linked_layers})
+        key = layer.get("key") or numbered(counts, d["name"])
+        self.layers[key] = (plain(d), layer["tiles"])
+
+    def read_group(self, counts: dict):
+        ids = []
+        d = self.read_record(MapThingGroup.schema, {"m_things": lambda d: ids.extend(self.read_things(ThingSection.GROUP, d["name"]))})
+        self.groups[numbered(counts, d["name"])] = (plain(d), sorted(ids, key=repr))
+
+
+def diff_records(what: str, old: dict, new: dict, compare) -> tuple:
+    # records with the same key and value are unchanged after one comparison; compare gives the
+    # (kind, fields) of the rest
+    changes = []
+    unchanged = 0
+    for key, record in old.items():
+        other = new.get(key)
+        if other is None:
+            changes.append(Change(what, "removed", key))
+        elif record == other:
+            unchanged += 1
+        else:
+            kind, fields = compare(record, other)
+            changes.append(Change(what, kind, key, fields))
+    for key in new.keys() - old.keys():
+        changes.append(Change(what, "added", key))
+    return changes, unchanged
+
+
+def decode_thing(record: bytes) -> dict:
+    return MapThing(BufferLoadData(record)).__dict__
+
+
+def compare_things(old: bytes, new: bytes) -> tuple:
+    fields = changed_fields(decode_thing(old), decode_thing(new))
+    return ("moved" if fields and fields.keys() <= LOCATION_FIELDS else "modified"), fields
+
+
+def compare_spawn_points(old: bytes, new: bytes) -> tuple:
+    return "modified", changed_fields(plain(SpawnPointData.read(BufferLoadData(old))), plain(SpawnPointData.read(BufferLoadData(new))))
+
+
+def compare_containers(children: str):
+    # compares the (fields, tile count or thing ids) records of layers or groups
+    def compare(old: tuple, new: tuple) -> tuple:
+        fields = changed_fields(old[0], new[0])
+        if old[1] != new[1]:
+            count = lambda value: len(value) if isinstance(value, list) else value
+            fields[children] = (count(old[1]), count(new[1]))
+        return "modified", fields
+    return compare
+
+
+def relocated(changes: list, old: dict, new: dict) -> list:
+    # a thing removed from one group or layer and added to another with the same id was moved
+    # there; it's reported as one change with its source among the fields
+    ends = {}
+    for change in changes:
+        if change.kind in ("removed", "added"):
+            section, source, thing_id, n = change.key
+            ends.setdefault((section, thing_id), []).append(change)
+    pairs = {}
+    for pair in ends.values():
+        if len(pair) == 2 and {c.kind for c in pair} == {"removed", "added"}:
+            removed, added = sorted(pair, key=lambda c: c.kind != "removed")
+            fields = {"source": (removed.key[1], added.key[1])}
+            fields.update(changed_fields(decode_thing(old[removed.key]), decode_thing(new[added.key]), skip=GROUP_FIELDS))
+            pairs[removed.kind, removed.key] = Change("thing", "modified", added.key, fields)
+            pairs[added.kind, added.key] = None
+    changes = [pairs.get((change.kind, change.key), change) for change in changes]
+    return [change for change in changes if change is not None]
+
+
+def diff_maps(old, new) -> MapDiff:
+    """
+    Compare two versions of a map. Things are matched by section, group or layer and m_id;
+    terrain layers, groups and spawn points by name. Things and spawn points are compared by
+    the bytes they were saved as, so unchanged ones cost one comparison and only changed ones
+    are decoded and compared field by field. A thing that only changed location was moved;
+    one that kept its id but changed group or layer is modified, with a "source" field
+    :param old: The old map file, its contents or its MapRecords
+    :param new: The new map file, its contents or its MapRecords
+    :return: The MapDiff
+    """
+    old = old if isinstance(old, MapRecords) else MapRecords(old)
+    new = new if isinstance(new, MapRecords) else MapRecords(new)
+    changes = []
+    unchanged = 0
+
+    fields = changed_fields(old.header, new.header)
+    if fields:
+        changes.append(Change("map", "modified", (new.header.get("m_name", ""),), fields))
+
+    c, u = diff_records("thing", old.things, new.things, compare_things)
+    changes += relocated(c, old.things, new.things)
+    unchanged += u
+    for what, records, compare in (
+        ("layer", "layers", compare_containers("tiles")),
+        ("group", "groups", compare_containers("things")),
+        ("spawn_point", "spawn_points", compare_spawn_points),
+    ):
+        c, u = diff_records(what, getattr(old, records), getattr(new, records), compare)
+        changes += c
+        unchanged += u
+    return MapDiff(changes, unchanged)
+
+
+# Diffs one pair of map files for diff_builds, in a worker process
+def diff_pair(pair: tuple) -> tuple:
+    name, old_path, new_path = pair
+    if old_path is None or new_path is None:
+        return name, "added" if old_path is None else "removed", None
+    if filecmp.cmp(old_path, new_path, shallow=False):
+        # identical files need no parsing
+        return name, "same", None
+    try:
+        return name, "changed", diff_maps(old_path, new_path)
+    except Exception as e:
+        return name, "failed", "{}: {}".format(type(e).__name__, e)
+
+
+def diff_builds(old_dir: str, new_dir: str, workers: int = None) -> list:
+    """
+    Diff every map of two game builds, matched by their path under each directory. Files
+    with the same bytes are skipped without parsing, the rest are diffed in parallel
+    :param old_dir: The old build's map directory
+    :param new_dir: The new build's map directory
+    :param workers: Worker processes, defaults to the CPU count
+    :return: (relative path, status, MapDiff or error) tuples in path order, status being
+             "same", "changed", "added", "removed" or "failed"
+    """
+    from MapBatch import find_maps
+
+    old = {os.path.relpath(p, old_dir): p for p in find_maps([old_dir])}
+    new = {os.path.relpath(p, new_dir): p for p in find_maps([new_dir])}
+    pairs = [(name, old.get(name), new.get(name)) for name in sorted(old.keys() | new.keys())]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(pairs) <= 1:
+        return [diff_pair(pair) for pair in pairs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(diff_pair, pairs, chunksize=4))
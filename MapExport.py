@@ -0,0 +1,226 @@
+import csv
+import os
+import shutil
+import time
+from importlib import import_module
+
+import numpy as np
+
+from CaelondianAtlas import (
+    BufferLoadData, MapData, SpawnPointData, ThingSection, DataType, walk_plan, thing_handlers,
+)
+from ThingTable import FLAG_COLUMNS, pack_color
+
+FORMATS = ("csv", "npz", "parquet")
+
+# column name -> (MapThing attribute, value when the thing's version predates it)
+THING_FIELDS = {
+    "version": ("version", 0),
+    "data_type": ("data_type", DataType.UNKNOWN),
+    "name": ("m_name", ""),
+    "x": (None, 0),
+    "y": (None, 0),
+    "end_x": (None, 0),
+    "end_y": (None, 0),
+    "id": ("m_id", 0),
+    "group_names": ("m_groupNames", []),
+    "draw_layer": ("DrawLayer", None),
+    "color": ("Color", None),
+    "scale": ("Scale", 1.0),
+    "angle": ("Angle", 0.0),
+    "offset_z": ("OffsetZ", 0.0),
+    "rotation_speed": ("RotationSpeed", 0.0),
+    "health_fraction": ("HealthFraction", 1.0),
+    "attach_to_id": ("AttachToID", -1),
+    "activation_range": ("ActivationRange", 0.0),
+}
+
+# table name -> columns; the map a row came from is its partition, see TableWriter
+TABLES = {
+    "things": ["section", "source", "index"] + list(THING_FIELDS) + list(FLAG_COLUMNS),
+    "spawn_points": ["point", "name", "x_offset_min", "x_offset_max", "y_offset_min", "y_offset_max",
+                     "snap_horizontal", "snap_vertical", "waves"],
+    "spawn_waves": ["point", "wave", "min_interval", "max_interval", "loop_to_wave", "repeat_times",
+                    "count_scalar", "interval_scalar", "first_spawn_min_interval", "first_spawn_max_interval", "spawns"],
+    "spawns": ["point", "wave", "spawn", "name", "num", "max_attempts"],
+}
+
+
+# Buffers the rows of one table of one map column by column and writes them out every
+# batch_size rows, as directory/<table>/map=<map>/part-NNNNN.<format>. That's the hive
+# partitioned layout pandas, DuckDB and pyarrow read as one dataset with a map column:
+#
+#   duckdb.sql("SELECT map, count(*) FROM read_csv('out/things/*/*.csv', hive_partitioning=true) GROUP BY map")
+class TableWriter:
+    def __init__(self, directory: str, table: str, map_name: str, batch_size: int, format: str):
+        self.directory = os.path.join(directory, table, "map={}".format(map_name))
+        self.columns = TABLES[table]
+        self.batch_size = batch_size
+        self.format = format
+        self.buffers = [[] for column in self.columns]
+        self.parts = 0
+        self.rows = 0
+        # a map exported again replaces its partition
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def append(self, row: tuple):
+        for buffer, value in zip(self.buffers, row):
+            buffer.append(value)
+        if len(self.buffers[0]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        count = len(self.buffers[0])
+        if not count:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "part-{:05d}.{}".format(self.parts, self.format))
+        getattr(self, "write_" + self.format)(path)
+        self.parts += 1
+        self.rows += count
+        for buffer in self.buffers:
+            buffer.clear()
+
+    def write_csv(self, path: str):
+        with open(path, "w", newline="", encoding="utf8") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            writer.writerows(zip(*self.buffers))
+
+    def write_npz(self, path: str):
+        # one array per column; strings become fixed width unicode arrays, no pickling
+        np.savez(path, **{column: np.asarray(buffer) for column, buffer in zip(self.columns, self.buffers)})
+
+    def write_parquet(self, path: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        pq.write_table(pa.table(dict(zip(self.columns, self.buffers))), path)
+
+    def close(self) -> int:
+        self.flush()
+        return self.rows
+
+
+def thing_row(record, index: int) -> list:
+    thing = record.thing
+    d = thing.__dict__
+    row = [record.section.name, record.source or "", index]
+    for column, (attr, default) in THING_FIELDS.items():
+        if column in ("x", "y"):
+            value = d.get("m_location", (0, 0))[column == "y"]
+        elif column in ("end_x", "end_y"):
+            value = d.get("m_endLocation", (0, 0))[column == "end_y"]
+        else:
+            value = d.get(attr, default)
+        if column == "data_type" or column == "draw_layer":
+            value = "" if value is None else value.name
+        elif column == "color":
+            value = 0xFFFFFFFF if value is None else pack_color(value)
+        elif column == "group_names":
+            value = ";".join(value)
+        row.append(value)
+    row.extend(bool(d.get(attr)) for attr in FLAG_COLUMNS.values())
+    return row
+
+
+def spawn_rows(point: SpawnPointData, p: int):
+    # (table, row) pairs for a spawn point, its waves and their spawns
+    d = point.__dict__
+    yield "spawn_points", [p, point.m_name, point.m_xOffsetMin, point.m_xOffsetMax, point.m_yOffsetMin, point.m_yOffsetMax,
+                           bool(d.get("m_snapHorizontal")), bool(d.get("m_snapVertical")), len(point.m_spawnWaves)]
+    for w, wave in enumerate(point.m_spawnWaves):
+        d = wave.__dict__
+        yield "spawn_waves", [p, w, wave.m_minInterval, wave.m_maxInterval, wave.m_loopToWave, wave.m_repeatTimes,
+                              wave.m_scale.m_countScalar, wave.m_scale.m_intervalScalar,
+                              d.get("m_firstSpawnMinInterval", 0.0), d.get("m_firstSpawnMaxInterval", 0.0), len(wave.m_spawns)]
+        for s, spawn in enumerate(wave.m_spawns):
+            yield "spawns", [p, w, s, spawn.m_name, spawn.m_num, spawn.__dict__.get("m_maxAttempts", 0)]
+
+
+def export_map(path: str, directory: str, batch_size: int = 65536, format: str = "csv", map_name: str = None) -> dict:
+    """
+    Stream a map's things, spawn points, spawn waves and spawns into columnar files. Things
+    are read one at a time as iter_things does and written every batch_size rows, so memory
+    doesn't grow with the size of the map
+    :param path: The .map file
+    :param directory: The dataset's root directory
+    :param batch_size: Rows per part file
+    :param format: "csv", "npz" (a NumPy array per column) or "parquet", which needs pyarrow
+    :param map_name: The partition, by default the map file's name without extension
+    :return: Rows written per table, and things per section under "sections"
+    """
+    if format not in FORMATS:
+        raise ValueError("unknown export format {}, expected one of {}".format(format, ", ".join(FORMATS)))
+    if format == "parquet":
+        # fail before writing anything
+        import_module("pyarrow.parquet")
+
+    if map_name is None:
+        from MapBatch import map_name as default_name
+
+        map_name = default_name(path)
+    writers = {table: TableWriter(directory, table, map_name, batch_size, format) for table in TABLES}
+
+    def spawn_points(loader, d):
+        for p in range(loader.int()):
+            for table, row in spawn_rows(SpawnPointData.read(loader), p):
+                writers[table].append(row)
+        return ()
+
+    handlers = thing_handlers()
+    handlers["m_spawnPointData"] = spawn_points
+    things = writers["things"]
+    # position of each thing in its section and group or layer
+    counts = {}
+    with BufferLoadData(path, intern_strings=True) as loader:
+        plan = MapData.schema.plan(loader.int())
+        for record in walk_plan(plan, loader, handlers, stop_early=True):
+            key = (record.section, record.source)
+            index = counts.get(key, 0)
+            counts[key] = index + 1
+            things.append(thing_row(record, index))
+    rows = {table: writer.close() for table, writer in writers.items()}
+    rows["sections"] = {}
+    for (section, source), count in counts.items():
+        rows["sections"][section] = rows["sections"].get(section, 0) + count
+    return rows
+
+
+# Exports one map file for MapBatch.parse_maps(parse=...) through functools.partial.
+# Never raises for a bad map file.
+def export_file(path: str, directory: str, batch_size: int = 65536, format: str = "csv"):
+    from MapBatch import MapSummary
+
+    start = time.perf_counter()
+    size = 0
+    try:
+        size = os.path.getsize(path)
+        rows = export_map(path, directory, batch_size, format)
+    except Exception as e:
+        return MapSummary(path, size, time.perf_counter() - start, error="{}: {}".format(type(e).__name__, e))
+    sections = rows["sections"]
+    return MapSummary(
+        path,
+        size,
+        time.perf_counter() - start,
+        terrain_tiles=sections.get(ThingSection.TERRAIN, 0),
+        group_things=sections.get(ThingSection.GROUP, 0),
+        legacy_things=sections.get(ThingSection.LEGACY, 0),
+        backdrop_flyers=sections.get(ThingSection.BACKDROP_FLYER, 0),
+        spawn_points=rows["spawn_points"],
+    )
+
+
+def export_maps(paths: list, directory: str, batch_size: int = 65536, format: str = "csv", workers: int = None, data_dir: str = None):
+    """
+    Export every map under the given paths into one dataset partitioned by map
+    :param paths: Files, directories or glob patterns, see MapBatch.find_maps
+    :return: The BatchReport
+    :raise ValueError: If two maps have the same name, as their partitions would overwrite each other
+    """
+    from functools import partial
+    from MapBatch import parse_maps
+
+    return parse_maps(paths, workers=workers, data_dir=data_dir, unique_names=True,
+                      parse=partial(export_file, directory=directory, batch_size=batch_size, format=format))
@@ -0,0 +1,211 @@
+import sys
+import tracemalloc
+import types
+from array import array
+from enum import Enum
+from time import perf_counter
+
+from CaelondianAtlas import BufferLoadData, MapData, ParseHooks, SectionEvent
+
+# attributes of a MapData and the section their objects are counted in; the rest are "header"
+SECTIONS = {
+    "m_things": "legacy_things",
+    "m_spawnPointData": "spawn_data",
+    "m_terrainLayerData": "terrain_layers",
+    "preplacedBackdropFlyers": "backdrop_flyers",
+    "thingGroups": "thing_groups",
+    "dropped": "dropped_things",
+    "things": "thing_table",
+    "spatial": "spatial_index",
+    "loader": "loader",
+}
+
+# attributes shared by every map (LazyMapData's compiled decode plan), never counted
+SHARED = frozenset(("plan",))
+
+# what an object is counted as in MemoryReport.kinds
+KINDS = {str: "strings", bytes: "strings", int: "numbers", float: "numbers", complex: "numbers",
+         list: "containers", tuple: "containers", dict: "containers", set: "containers", frozenset: "containers",
+         array: "arrays", bytearray: "arrays", memoryview: "arrays"}
+
+
+def shared(obj) -> bool:
+    # objects that belong to the interpreter or to the module rather than to a map
+    return (obj is None or obj is True or obj is False or isinstance(obj, (type, Enum, types.ModuleType, types.FunctionType, types.MethodType))
+            or (type(obj) is int and -5 <= obj <= 256))
+
+
+# Tracks the memory traced by tracemalloc while each section of a map is parsed, see measure.
+# sections maps a section to [bytes still allocated when it ended, peak above its start].
+class MemoryHooks(ParseHooks):
+    def __init__(self):
+        self.sections = {}
+        self.peak = 0
+        self.start = 0
+
+    def section_start(self, section: str, offset: int):
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak is reset per section, so keep the highest one seen so far
+        self.peak = max(self.peak, peak)
+        self.start = current
+        tracemalloc.reset_peak()
+
+    def section_end(self, event: SectionEvent):
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        totals = self.sections.setdefault(event.section, [0, 0])
+        totals[0] += current - self.start
+        totals[1] = max(totals[1], peak - self.start)
+
+
+# Where the memory of resident maps goes: bytes and object counts per section of the map, per
+# class and per kind of object (strings, numbers, containers, arrays, objects). Sizes come from
+# walking each map's object graph with sys.getsizeof; an object reachable from several places
+# (an interned string, a TerrainTile template, a linked terrain layer) is counted once, in the
+# first section it's found in, including between maps added to the same report, so keep the
+# maps alive until they have all been added. A report from measure also holds what tracemalloc
+# saw while the map was parsed.
+#
+#   report = MemoryReport()
+#   for map_data in maps:
+#       report.add(map_data)
+#   print(report)
+class MemoryReport:
+    def __init__(self):
+        self.maps = 0
+        # name -> [objects, bytes]
+        self.sections = {}
+        self.classes = {}
+        self.kinds = {}
+        # section -> [bytes allocated, peak bytes] while parsing, from MemoryHooks
+        self.traced = {}
+        self.retained = 0
+        self.peak = 0
+        self.seconds = 0.0
+        self.seen = set()
+
+    def add(self, map_data: MapData):
+        """
+        Count the objects of a map that this report hasn't counted yet
+        :param map_data: The map, loaded in any mode (ThingTable, TileTemplates, LazyMapData)
+        """
+        d = vars(map_data)
+        if id(map_data) in self.seen:
+            return
+        self.maps += 1
+        self.seen.update((id(map_data), id(d)))
+        self.tally("header", type(map_data).__name__, "objects", sys.getsizeof(map_data) + sys.getsizeof(d))
+        for name, value in d.items():
+            if name not in SHARED:
+                self.count(value, SECTIONS.get(name, "header"))
+
+    def count(self, root, section: str):
+        seen = self.seen
+        getsizeof = sys.getsizeof
+        stack = [root]
+        while stack:
+            obj = stack.pop()
+            if id(obj) in seen or shared(obj):
+                continue
+            seen.add(id(obj))
+            cls = type(obj)
+            size = getsizeof(obj)
+            if cls in (list, tuple, set, frozenset):
+                stack.extend(obj)
+            elif cls is dict:
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif cls is memoryview:
+                stack.append(obj.obj)
+            elif cls.__module__ == "numpy":
+                if getattr(obj, "base", None) is not None:
+                    stack.append(obj.base)
+                if getattr(obj, "dtype", None) == object:
+                    stack.extend(obj.flat)
+            elif cls not in KINDS:
+                # an object's attribute dict is counted as part of it
+                d = getattr(obj, "__dict__", None)
+                if d is not None and id(d) not in seen:
+                    seen.add(id(d))
+                    size += getsizeof(d)
+                    stack.extend(d.keys())
+                    stack.extend(d.values())
+                for klass in cls.__mro__:
+                    for slot in getattr(klass, "__slots__", ()):
+                        if hasattr(obj, slot):
+                            stack.append(getattr(obj, slot))
+            self.tally(section, cls.__name__, KINDS.get(cls, "arrays" if cls.__module__ == "numpy" else "objects"), size)
+
+    def tally(self, section: str, name: str, kind: str, size: int):
+        for totals, key in ((self.sections, section), (self.classes, name), (self.kinds, kind)):
+            counts = totals.get(key)
+            if counts is None:
+                counts = totals[key] = [0, 0]
+            counts[0] += 1
+            counts[1] += size
+
+    @property
+    def size(self) -> int:
+        return sum(size for objects, size in self.sections.values())
+
+    def __str__(self) -> str:
+        lines = ["{:,} map(s), {:,} objects, {:.1f} MB".format(self.maps, sum(objects for objects, size in self.sections.values()), self.size / 1e6)]
+        if self.seconds:
+            lines.append("parsed in {:.2f}s: {:.1f} MB retained, {:.1f} MB peak".format(self.seconds, self.retained / 1e6, self.peak / 1e6))
+        for title, totals in (("section", self.sections), ("class", self.classes), ("kind", self.kinds)):
+            lines.append("{:<24} {:>12} {:>14}".format(title, "objects", "bytes"))
+            for name, (objects, size) in sorted(totals.items(), key=lambda item: -item[1][1]):
+                lines.append("{:<24} {:>12,} {:>14,}".format(name, objects, size))
+        if self.traced:
+            lines.append("{:<24} {:>12} {:>14}".format("traced section", "allocated", "peak"))
+            for name, (allocated, peak) in self.traced.items():
+                lines.append("{:<24} {:>12,} {:>14,}".format(name, allocated, peak))
+        return "\n".join(lines)
+
+
+def measure(path: str, report: MemoryReport = None, lazy: bool = False, **options) -> MemoryReport:
+    """
+    Load a map with tracemalloc tracing and count its objects. Tracing slows parsing down
+    several times, so the seconds are only comparable between measured loads
+    :param path: The .map file
+    :param report: Add the map to this report instead of a new one
+    :param lazy: Load a LazyMapData, which keeps the file open and only holds its header
+    :param options: Passed to MapData, such as thing_table or tile_templates
+    :return: The report, with the parse's peak and retained memory and the memory of each section
+    """
+    from CaelondianAtlas import LazyMapData
+
+    report = report or MemoryReport()
+    hooks = MemoryHooks()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        started = perf_counter()
+        loader = BufferLoadData(path, intern_strings=True)
+        try:
+            map_data = (LazyMapData if lazy else MapData)(loader, hooks=hooks, **options)
+        finally:
+            if not lazy:
+                loader.close()
+        report.seconds += perf_counter() - started
+        current, peak = tracemalloc.get_traced_memory()
+        report.retained += current - before
+        report.peak = max(report.peak, max(peak, hooks.peak) - before)
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    for section, (allocated, section_peak) in hooks.sections.items():
+        totals = report.traced.setdefault(section, [0, 0])
+        totals[0] += allocated
+        totals[1] = max(totals[1], section_peak)
+    # the hooks stay on a LazyMapData's loader, but aren't part of the map
+    report.seen.add(id(hooks))
+    report.add(map_data)
+    if lazy:
+        map_data.close()
+    # the map is dropped, so the ids of its objects can be reused by the next one
+    report.seen.clear()
+    return report
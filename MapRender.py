@@ -0,0 +1,259 @@
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from CaelondianAtlas import MapData, DataType, DrawLayer, ThingSection, TerrainLayerData
+from ThingTable import ThingTable
+
+BlendFilter = TerrainLayerData.BlendFilter
+
+# Rec. 601 luma weights, for saturation
+LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+# marker color of things by data type, before the thing's own Color is applied
+THING_COLORS = {
+    DataType.UNIT: (0.90, 0.25, 0.20),
+    DataType.OBSTACLE: (0.55, 0.55, 0.60),
+    DataType.GENERATOR: (0.95, 0.65, 0.15),
+    DataType.LOOT: (0.95, 0.90, 0.30),
+    DataType.SPAWN_POINT: (0.25, 0.80, 0.35),
+    DataType.MAP_AREA: (0.30, 0.55, 0.95),
+}
+
+
+def write_png(path: str, pixels: np.ndarray):
+    """
+    Write an 8 bit RGB or RGBA image as a PNG, with no image library
+    :param path: Where to write it
+    :param pixels: uint8 array of shape (height, width, 3 or 4)
+    :return: None
+    """
+    height, width, channels = pixels.shape
+    color_type = {3: 2, 4: 6}[channels]
+    # every scanline starts with filter type 0
+    raw = np.zeros((height, width * channels + 1), dtype=np.uint8)
+    raw[:, 1:] = pixels.reshape(height, width * channels)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+# Splits packed 0xRRGGBBAA colors into float RGB and alpha in 0..1
+def unpack_colors(packed: np.ndarray):
+    channels = packed.astype(np.uint32)[:, None] >> np.array([24, 16, 8, 0], dtype=np.uint32)
+    values = (channels & 0xFF).astype(np.float32) / 255
+    return values[:, :3], values[:, 3]
+
+
+# Applies a layer's contrast and saturation, each an adjustment around 0 (no change)
+def adjust(rgb: np.ndarray, contrast: float, saturation: float) -> np.ndarray:
+    if contrast:
+        rgb = (rgb - 0.5) * (1 + contrast) + 0.5
+    if saturation:
+        luma = (rgb @ LUMA)[..., None]
+        rgb = luma + (rgb - luma) * (1 + saturation)
+    return np.clip(rgb, 0, 1)
+
+
+# Pixel coordinates that fall inside a width x height image, and which of them did
+def clipped(x: np.ndarray, y: np.ndarray, width: int, height: int):
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    return x[inside], y[inside], inside
+
+
+# The ThingTable rows of each terrain layer, in the order of map_data.m_terrainLayerData
+def layer_rows(map_data: MapData) -> list:
+    if map_data.things is not None:
+        # layers already hold their row ranges
+        return [np.arange(layer.m_tiles.start, layer.m_tiles.stop) for layer in getattr(map_data, "m_terrainLayerData", ())]
+    # ThingTable.from_map adds legacy things, then the tiles of each layer in turn
+    start = len(map_data.m_things)
+    rows = []
+    for layer in getattr(map_data, "m_terrainLayerData", ()):
+        rows.append(np.arange(start, start + len(layer.m_tiles)))
+        start += len(layer.m_tiles)
+    return rows
+
+
+# Headless renderer that composites a map's terrain layers and things into an RGBA image with
+# NumPy. Every terrain tile covers a tile_size footprint around its location, drawn in its
+# Color times its layer's color, and each layer is adjusted by its contrast and saturation
+# before being blended over the layers below: NONE blends by coverage, MULTIPLY darkens what
+# is below and MASK only draws the layer where its linked layers have tiles. Layers with
+# m_mask set are only used as masks. Things are drawn on top as squares in DrawLayer order.
+# All drawing is vectorized over a layer's tiles; Python only loops over footprint offsets.
+#
+#   pixels = MapRenderer(scale=0.125).render(map_data)
+#   write_png("map.png", pixels)
+class MapRenderer:
+    def __init__(self, scale: float = 0.125, tile_size: tuple = (64, 32), thing_size: int = 3, max_size: int = 4096):
+        """
+        :param scale: Pixels per map unit
+        :param tile_size: Width and height a terrain tile covers, in map units
+        :param thing_size: Width of a thing's square, in pixels
+        :param max_size: The scale is lowered until the image's longer side fits in this many pixels
+        """
+        self.scale = scale
+        self.tile_size = tile_size
+        self.thing_size = thing_size
+        self.max_size = max_size
+
+    def bounds(self, table: ThingTable) -> tuple:
+        # (min_x, min_y, max_x, max_y) of the map units the things and tile footprints cover
+        tile_w, tile_h = self.tile_size
+        if not len(table):
+            return 0, 0, tile_w, tile_h
+        return (int(table.x.min()) - tile_w // 2, int(table.y.min()) - tile_h // 2,
+                int(table.x.max()) + tile_w // 2, int(table.y.max()) + tile_h // 2)
+
+    def render(self, map_data: MapData, frame: tuple = None, table: ThingTable = None, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Render a map, or a window of it
+        :param map_data: A map loaded with or without a ThingTable
+        :param frame: (min_x, min_y, scale, width, height) of the window, by default the whole map
+        :param table: The map's ThingTable.from_map, if already built
+        :param rows: Only draw these rows of the table, sorted, e.g. the ones near the window
+        :return: uint8 array of shape (height, width, 4)
+        """
+        if table is None:
+            table = ThingTable.from_map(map_data)
+        if frame is None:
+            min_x, min_y, max_x, max_y = self.bounds(table)
+            scale = min(self.scale, self.max_size / max(max_x - min_x + 1, max_y - min_y + 1))
+            width = max(1, int(np.ceil((max_x - min_x + 1) * scale)))
+            height = max(1, int(np.ceil((max_y - min_y + 1) * scale)))
+            frame = (min_x, min_y, scale, width, height)
+        self.frame = frame
+        min_x, min_y, scale, width, height = frame
+
+        backdrop = getattr(map_data, "backdropColor", None)
+        canvas = np.empty((height, width, 3), dtype=np.float32)
+        canvas[:] = (0, 0, 0) if backdrop is None else (backdrop.r / 255, backdrop.g / 255, backdrop.b / 255)
+
+        # fields the layer's version predates keep the game's defaults
+        layers = getattr(map_data, "m_terrainLayerData", [])
+        per_layer = layer_rows(map_data)
+        if rows is not None:
+            per_layer = [np.intersect1d(r, rows, assume_unique=True) for r in per_layer]
+        row_of = {id(layer): r for layer, r in zip(layers, per_layer)}
+        for layer, r in zip(layers, per_layer):
+            if getattr(layer, "m_mask", False) or not len(r):
+                continue
+            rgb, coverage = self.paint_tiles(table, r, layer)
+            blend = getattr(layer, "m_blendFilter", BlendFilter.NONE)
+            if blend == BlendFilter.MASK and layer.m_linkedLayers:
+                mask = np.zeros_like(coverage)
+                for linked in layer.m_linkedLayers:
+                    np.maximum(mask, self.paint_tiles(table, row_of[id(linked)])[1], out=mask)
+                coverage *= mask
+            coverage = coverage[..., None]
+            if blend == BlendFilter.MULTIPLY:
+                canvas *= 1 - coverage + rgb * coverage
+            else:
+                canvas += (rgb - canvas) * coverage
+
+        self.draw_things(canvas, table, rows)
+        pixels = np.empty((height, width, 4), dtype=np.uint8)
+        pixels[..., :3] = np.round(canvas * 255)
+        pixels[..., 3] = 255
+        return pixels
+
+    def pixels_of(self, table: ThingTable, rows: np.ndarray):
+        min_x, min_y, scale, width, height = self.frame
+        px = np.floor((table.x[rows] - min_x) * scale).astype(np.int64)
+        py = np.floor((table.y[rows] - min_y) * scale).astype(np.int64)
+        return px, py
+
+    def paint_tiles(self, table: ThingTable, rows: np.ndarray, layer: TerrainLayerData = None):
+        # a layer's tiles in their colors, and how much of each pixel they cover
+        min_x, min_y, scale, width, height = self.frame
+        rgb = np.zeros((height, width, 3), dtype=np.float32)
+        coverage = np.zeros((height, width), dtype=np.float32)
+        tile_rgb, tile_alpha = unpack_colors(table.color[rows])
+        if layer is not None:
+            color = layer.color
+            tile_rgb = tile_rgb * np.array([color.r, color.g, color.b], dtype=np.float32) / 255
+            tile_alpha = tile_alpha * color.a / 255
+            tile_rgb = adjust(tile_rgb, layer.contrast, layer.saturation)
+
+        tile_w = max(1, int(round(self.tile_size[0] * scale)))
+        tile_h = max(1, int(round(self.tile_size[1] * scale)))
+        px, py = self.pixels_of(table, rows)
+        px -= tile_w // 2
+        py -= tile_h // 2
+        for dy in range(tile_h):
+            for dx in range(tile_w):
+                x, y, inside = clipped(px + dx, py + dy, width, height)
+                rgb[y, x] = tile_rgb[inside]
+                coverage[y, x] = tile_alpha[inside]
+        return rgb, coverage
+
+    def draw_things(self, canvas: np.ndarray, table: ThingTable, rows: np.ndarray = None):
+        if rows is None:
+            rows = np.flatnonzero(table.section != ThingSection.TERRAIN.value)
+        else:
+            rows = rows[table.section[rows] != ThingSection.TERRAIN.value]
+        if not len(rows):
+            return
+        # things without a DrawLayer are drawn with the GROUND layer
+        draw_layer = table.draw_layer[rows].astype(np.int16)
+        draw_layer[draw_layer < 0] = DrawLayer.GROUND.value
+        rows = rows[np.argsort(draw_layer, kind="stable")]
+
+        palette = np.ones((max(t.value for t in DataType) + 1, 3), dtype=np.float32)
+        for data_type, color in THING_COLORS.items():
+            palette[data_type.value] = color
+        rgb, alpha = unpack_colors(table.color[rows])
+        rgb = rgb * palette[table.data_type[rows]]
+
+        min_x, min_y, scale, width, height = self.frame
+        px, py = self.pixels_of(table, rows)
+        size = self.thing_size
+        for dy in range(size):
+            for dx in range(size):
+                x, y, inside = clipped(px + dx - size // 2, py + dy - size // 2, width, height)
+                # fancy assignment keeps the last write per pixel, so later draw layers win
+                canvas[y, x] += (rgb[inside] - canvas[y, x]) * alpha[inside, None]
+
+    def save(self, map_data: MapData, path: str):
+        write_png(path, self.render(map_data))
+
+
+# Renders one map file to a PNG in directory, for MapBatch.parse_maps(parse=...) through
+# functools.partial. Never raises for a bad map file.
+def render_file(path: str, directory: str, scale: float = 0.125):
+    from MapBatch import MapSummary, map_name, summary_of
+
+    start = time.perf_counter()
+    size = 0
+    try:
+        size = os.path.getsize(path)
+        map_data = MapData(path, thing_table=ThingTable())
+        MapRenderer(scale).save(map_data, os.path.join(directory, map_name(path) + ".png"))
+    except Exception as e:
+        return MapSummary(path, size, time.perf_counter() - start, error="{}: {}".format(type(e).__name__, e))
+    return summary_of(map_data, path, size, time.perf_counter() - start)
+
+
+def render_maps(paths: list, directory: str, scale: float = 0.125, workers: int = None, chunksize: int = 4, data_dir: str = None):
+    """
+    Render every map under the given paths to directory/<map file name>.png
+    :param paths: Files, directories or glob patterns, see MapBatch.find_maps
+    :return: The BatchReport
+    :raise ValueError: If two maps have the same name, as their renders would overwrite each other
+    """
+    from functools import partial
+    from MapBatch import parse_maps
+
+    os.makedirs(directory, exist_ok=True)
+    return parse_maps(paths, workers=workers, chunksize=chunksize, data_dir=data_dir, unique_names=True,
+                      parse=partial(render_file, directory=directory, scale=scale))
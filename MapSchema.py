@@ -0,0 +1,376 @@
+from operator import methodcaller, attrgetter
+from struct import Struct
+
+# Bastion writes its maps with .NET's BinaryWriter, which is always little endian
+ENDIAN = "<"
+
+
+# A fixed-size field. Runs of neighbouring scalars are packed into one struct and read with a
+# single unpack. decode, if given, turns the field's unpacked values into the stored attribute,
+# and encode turns the attribute back into them for saving.
+class Scalar:
+    def __init__(self, fmt: str, decode=None, encode=None):
+        self.fmt = fmt
+        codec = Struct(ENDIAN + fmt)
+        self.count = len(codec.unpack(bytes(codec.size)))
+        self.decode = decode
+        self.encode = encode
+
+
+# A variable-length field, read by a function of the loader. Contextual reads are also passed
+# the fields decoded so far, for sections that depend on them (e.g. a group's things on its name).
+# skip, if given, moves the loader past the field without decoding it. write saves the field to
+# a SaveData and size returns how many bytes that takes; contextual ones are passed the record too.
+class Value:
+    def __init__(self, read, skip=None, contextual: bool = False, write=None, size=None):
+        self.read = read
+        self.skip = skip
+        self.contextual = contextual
+        self.write = write
+        self.size = size
+
+
+def skip_list(skip):
+    # skips an int32 count followed by that many items
+    def skip_items(loader):
+        for i in range(loader.int()):
+            skip(loader)
+    return skip_items
+
+
+def skip_ints(loader):
+    loader.skip(4 * loader.int())
+
+
+def write_list(write):
+    # writes an int32 count followed by the items
+    def write_items(saver, items):
+        saver.int(len(items))
+        for item in items:
+            write(saver, item)
+    return write_items
+
+
+def list_size(size):
+    return lambda items: 4 + sum(size(item) for item in items)
+
+
+def string_size(s: str) -> int:
+    # a 7-bit encoded byte count followed by the UTF-8 bytes
+    n = len(s) if s.isascii() else len(s.encode("utf8"))
+    size = n + 1
+    while n >= 0x80:
+        n >>= 7
+        size += 1
+    return size
+
+
+def write_string(saver, s: str):
+    saver.string(s)
+
+
+def write_str_list(saver, l: list):
+    saver.str_list(l)
+
+
+def write_int_list(saver, l: list):
+    saver.int_list(l)
+
+
+BOOL = Scalar("B")
+INT = Scalar("i")
+LONG = Scalar("q")
+FLOAT = Scalar("f")
+POINT = Scalar("2i", tuple)
+VECTOR = Scalar("2f", tuple)
+STRING = Value(methodcaller("string"), methodcaller("skip_string"), write=write_string, size=string_size)
+STRING_LIST = Value(methodcaller("str_list"), skip_list(methodcaller("skip_string")), write=write_str_list, size=list_size(string_size))
+INT_LIST = Value(methodcaller("int_list"), skip_ints, write=write_int_list, size=lambda l: 4 + 4 * len(l))
+
+
+def enum_name(enum_type) -> Value:
+    # enums that are stored by their name, e.g. DataType
+    return Value(
+        methodcaller("enum", enum_type),
+        methodcaller("skip_string"),
+        write=lambda saver, value: saver.string(value.name),
+        size=lambda value: string_size(value.name),
+    )
+
+
+def enum_value(enum_type) -> Scalar:
+    # enums that are stored as their int32 value, e.g. BlendFilter
+    return Scalar("i", enum_type, attrgetter("value"))
+
+
+def list_of(read, skip=None, write=None, size=None) -> Value:
+    # an int32 count followed by that many items
+    return Value(
+        lambda loader: [read(loader) for i in range(loader.int())],
+        skip and skip_list(skip),
+        write=write and write_list(write),
+        size=size and list_size(size),
+    )
+
+
+# One attribute of a schema, present from version `first` up to but not including `last`
+class Field:
+    def __init__(self, version, name: str, kind):
+        if isinstance(version, tuple):
+            self.first, self.last = version
+        else:
+            self.first, self.last = version, None
+        self.name = name
+        self.kind = kind
+
+    def present(self, version: int) -> bool:
+        return self.first <= version and (self.last is None or version < self.last)
+
+
+# The decode steps for one format version of a schema. Adjacent scalar fields are merged into a
+# single struct step, everything else is read by its own Value step. The steps are then compiled
+# into one straight-line function, so decoding a record runs no per-field loop or branching.
+class Plan:
+    def __init__(self, fields: list):
+        self.fields = fields
+        self.steps = []
+
+        run = []
+        for field in fields:
+            if isinstance(field.kind, Scalar):
+                run.append(field)
+                continue
+            if run:
+                self.steps.append((Struct(ENDIAN + "".join(f.kind.fmt for f in run)), run))
+                run = []
+            self.steps.append((None, [field]))
+        if run:
+            self.steps.append((Struct(ENDIAN + "".join(f.kind.fmt for f in run)), run))
+
+        self.decode = self.compile_decode()
+        self.decoders = {}
+        self.parts = {}
+        self.skipper = None
+        self.encoder = None
+        self.sizer = None
+
+    def field(self, name: str) -> Field:
+        for f in self.fields:
+            if f.name == name:
+                return f
+        raise KeyError(name)
+
+    def compile_decode(self, lazy: frozenset = frozenset()):
+        # fields named in lazy are skipped, and their offset is recorded in offsets instead
+        namespace = {}
+        lines = ["def decode(loader, d, offsets=None):", "    unpack = loader.unpack"]
+        for i, (codec, fields) in enumerate(self.steps):
+            if codec is None:
+                field = fields[0]
+                kind = field.kind
+                if field.name in lazy:
+                    namespace["skip%d" % i] = self.skip_of(field)
+                    lines.append("    offsets[%r] = loader.position()" % field.name)
+                    lines.append("    skip%d(loader)" % i)
+                    continue
+                namespace["read%d" % i] = kind.read
+                args = "loader, d" if kind.contextual else "loader"
+                lines.append("    d[%r] = read%d(%s)" % (field.name, i, args))
+                continue
+
+            namespace["codec%d" % i] = codec
+            if all(f.kind.count == 1 and f.kind.decode is None for f in fields):
+                targets = "".join("d[%r], " % f.name for f in fields)
+                lines.append("    %s = unpack(codec%d)" % (targets, i))
+                continue
+
+            lines.append("    v = unpack(codec%d)" % i)
+            start = 0
+            for j, f in enumerate(fields):
+                kind = f.kind
+                if kind.count == 1:
+                    value = "v[%d]" % start
+                else:
+                    value = "v[%d:%d]" % (start, start + kind.count)
+                if kind.decode is not None and not (kind.decode is tuple and kind.count > 1):
+                    namespace["decode%d_%d" % (i, j)] = kind.decode
+                    value = "decode%d_%d(%s)" % (i, j, value)
+                lines.append("    d[%r] = %s" % (f.name, value))
+                start += kind.count
+        if len(lines) == 2:
+            lines.append("    pass")
+
+        exec("\n".join(lines), namespace)
+        return namespace["decode"]
+
+    def decoder(self, lazy: frozenset):
+        decode = self.decoders.get(lazy)
+        if decode is None:
+            decode = self.decoders[lazy] = self.compile_decode(lazy)
+        return decode
+
+    def split(self, count: int) -> tuple:
+        # plans of the first count fields and of the rest, so a record's leading fields can be
+        # decoded on their own and the rest decoded or skipped depending on them
+        parts = self.parts.get(count)
+        if parts is None:
+            parts = self.parts[count] = (Plan(self.fields[:count]), Plan(self.fields[count:]))
+        return parts
+
+    def skip_of(self, field: Field):
+        if field.kind.skip is None:
+            raise TypeError("field %s can't be skipped" % field.name)
+        return field.kind.skip
+
+    def compile_skip(self):
+        # runs of scalars are skipped with a single jump
+        namespace = {}
+        lines = ["def skip(loader):"]
+        size = 0
+        for i, (codec, fields) in enumerate(self.steps):
+            if codec is not None:
+                size += codec.size
+                continue
+            if size:
+                lines.append("    loader.skip(%d)" % size)
+                size = 0
+            namespace["skip%d" % i] = self.skip_of(fields[0])
+            lines.append("    skip%d(loader)" % i)
+        if size:
+            lines.append("    loader.skip(%d)" % size)
+        if len(lines) == 1:
+            lines.append("    pass")
+
+        exec("\n".join(lines), namespace)
+        return namespace["skip"]
+
+    def skip(self, loader):
+        if self.skipper is None:
+            self.skipper = self.compile_skip()
+        self.skipper(loader)
+
+    def compile_encode(self):
+        # runs of scalars are packed into the saver's buffer with a single pack_into
+        namespace = {}
+        lines = ["def encode(saver, d):", "    buffer = saver.buffer", "    pos = saver.pos"]
+        for i, (codec, fields) in enumerate(self.steps):
+            if codec is None:
+                field = fields[0]
+                if field.kind.write is None:
+                    raise TypeError("field %s can't be saved" % field.name)
+                namespace["write%d" % i] = field.kind.write
+                args = "saver, d[%r], d" if field.kind.contextual else "saver, d[%r]"
+                lines.append("    saver.pos = pos")
+                lines.append("    write%d(%s)" % (i, args % field.name))
+                lines.append("    pos = saver.pos")
+                continue
+
+            namespace["pack%d" % i] = codec.pack_into
+            values = []
+            for j, f in enumerate(fields):
+                kind = f.kind
+                value = "d[%r]" % f.name
+                if kind.encode is not None:
+                    namespace["encode%d_%d" % (i, j)] = kind.encode
+                    value = "encode%d_%d(%s)" % (i, j, value)
+                elif kind.decode not in (None, tuple):
+                    raise TypeError("field %s can't be saved" % f.name)
+                values.append("*" + value if kind.count > 1 else value)
+            lines.append("    pack%d(buffer, pos, %s)" % (i, ", ".join(values)))
+            lines.append("    pos += %d" % codec.size)
+        lines.append("    saver.pos = pos")
+
+        exec("\n".join(lines), namespace)
+        return namespace["encode"]
+
+    def compile_size(self):
+        # scalars add up to a constant, only the variable-length fields are measured
+        namespace = {}
+        terms = [0]
+        for i, (codec, fields) in enumerate(self.steps):
+            if codec is not None:
+                terms[0] += codec.size
+                continue
+            field = fields[0]
+            if field.kind.size is None:
+                raise TypeError("field %s can't be saved" % field.name)
+            namespace["size%d" % i] = field.kind.size
+            args = "d[%r], d" if field.kind.contextual else "d[%r]"
+            terms.append("size%d(%s)" % (i, args % field.name))
+
+        exec("def size(d):\n    return %s" % " + ".join(map(str, terms)), namespace)
+        return namespace["size"]
+
+    def encode(self, saver, d: dict):
+        if self.encoder is None:
+            self.encoder = self.compile_encode()
+        self.encoder(saver, d)
+
+    def size(self, d: dict) -> int:
+        if self.sizer is None:
+            self.sizer = self.compile_size()
+        return self.sizer(d)
+
+
+def saved_values(obj) -> dict:
+    # the attributes to save; fields the loader normalised keep their on-disk value in saved_fields,
+    # which is written back unless the field was edited since, and flyweight objects add the
+    # fields they share with others from their shared dict
+    d = obj.__dict__
+    shared = getattr(obj, "shared", None)
+    if shared:
+        d = {**shared, **d}
+    saved = d.get("saved_fields")
+    if saved:
+        d = dict(d)
+        for name, (on_disk, normalised) in saved.items():
+            if d.get(name) == normalised:
+                d[name] = on_disk
+    return d
+
+
+# The versioned layout of one of Bastion's serialized classes. Plans are compiled on first use
+# and cached per version, so loading a thing is a fixed list of steps instead of a chain of ifs.
+# Loaded objects remember their version, and are saved in it; new ones get the latest version.
+class Schema:
+    def __init__(self, fields: list, versioned: bool = True):
+        self.fields = [Field(*field) for field in fields]
+        self.versioned = versioned
+        self.latest = max(f.first for f in self.fields) if versioned else 0
+        self.plans = {}
+
+    def plan(self, version: int) -> Plan:
+        plan = self.plans.get(version)
+        if plan is None:
+            plan = self.plans[version] = Plan([f for f in self.fields if f.present(version)])
+        return plan
+
+    def load(self, loader, obj) -> int:
+        if not self.versioned:
+            self.plan(0).decode(loader, obj.__dict__)
+            return 0
+        version = obj.version = loader.int()
+        self.plan(version).decode(loader, obj.__dict__)
+        return version
+
+    def skip(self, loader):
+        version = loader.int() if self.versioned else 0
+        self.plan(version).skip(loader)
+
+    def version_of(self, d: dict) -> int:
+        return d.get("version", self.latest) if self.versioned else 0
+
+    def size(self, obj) -> int:
+        d = saved_values(obj)
+        version = self.version_of(d)
+        try:
+            return self.plan(version).size(d) + (4 if self.versioned else 0)
+        except KeyError as e:
+            raise ValueError("{} version {} needs {} to be saved".format(type(obj).__name__, version, e.args[0])) from None
+
+    def save(self, saver, obj):
+        d = saved_values(obj)
+        version = self.version_of(d)
+        if self.versioned:
+            saver.int(version)
+        self.plan(version).encode(saver, d)
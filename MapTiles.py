@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from CaelondianAtlas import MapData
+from MapRender import MapRenderer, BlendFilter, layer_rows, write_png
+from SpatialIndex import SpatialIndex
+from ThingTable import ThingTable
+
+# bumped when the tiles a pyramid would render for the same map change
+PYRAMID_FORMAT = 1
+
+# origins are snapped to this many map units, so small changes to a map's extent keep its tiles
+ORIGIN_STEP = 1024
+
+# 64 bit multiplier of the row digest mix
+MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+# Order-sensitive uint64 digest of each row, over the values the renderer draws with
+def row_digests(columns: list) -> np.ndarray:
+    h = np.full(len(columns[0]), 0xCBF29CE484222325, dtype=np.uint64)
+    for column in columns:
+        h ^= np.asarray(column).astype(np.int64).view(np.uint64)
+        h *= MIX
+        h ^= h >> np.uint64(29)
+    return h
+
+
+def layer_digest(layer, index_of: dict) -> int:
+    color = layer.color
+    params = (
+        color.r, color.g, color.b, color.a,
+        round(float(layer.contrast), 6), round(float(layer.saturation), 6),
+        getattr(layer, "m_blendFilter", BlendFilter.NONE).value,
+        bool(getattr(layer, "m_mask", False)),
+        [index_of[id(linked)] for linked in layer.m_linkedLayers],
+    )
+    return int.from_bytes(hashlib.sha256(repr(params).encode()).digest()[:8], "little")
+
+
+# XYZ tile pyramid of a map, rendered with MapRenderer into directory/z/x/y.png. The deepest
+# zoom draws scale pixels per map unit and each zoom out halves it, down to zoom 0 where one
+# tile holds the whole map. Tiles with nothing on them aren't written.
+#
+# manifest.json keeps, for every tile, the hash of everything that goes into it (the settings,
+# and the rows of the things and terrain tiles that reach into it, with their layer's
+# parameters) and the sha256 of its PNG. Exporting a map again only renders the tiles whose
+# input hash changed and removes the ones that are gone, so editing a few things only
+# re-renders the tiles around them at each zoom. A change to the map's extent that moves the
+# origin, or to the number of zoom levels, re-renders everything.
+#
+#   pyramid = TilePyramid("atlas/ProtoIntro01")
+#   pyramid.export(map_data)   # {"rendered": 341, "kept": 0, "removed": 0}
+class TilePyramid:
+    tile_pixels = 256
+
+    def __init__(self, directory: str, scale: float = 0.25, renderer: MapRenderer = None):
+        """
+        :param directory: Where the tiles and manifest.json are written
+        :param scale: Pixels per map unit at the deepest zoom
+        :param renderer: Draws the tiles; its scale and max_size are not used
+        """
+        self.directory = directory
+        self.scale = scale
+        self.renderer = renderer or MapRenderer()
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, "manifest.json")
+
+    def read_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"tiles": {}}
+
+    def write_atomic(self, path: str, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        os.close(fd)
+        try:
+            write(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def layout(self, table: ThingTable) -> tuple:
+        # origin and deepest zoom that fit the map's bounds into one tile at zoom 0
+        min_x, min_y, max_x, max_y = self.renderer.bounds(table)
+        origin_x = min_x // ORIGIN_STEP * ORIGIN_STEP
+        origin_y = min_y // ORIGIN_STEP * ORIGIN_STEP
+        extent = max(max_x - origin_x + 1, max_y - origin_y + 1)
+        max_zoom = max(0, int(np.ceil(np.log2(extent * self.scale / self.tile_pixels))))
+        return origin_x, origin_y, max_zoom, (max_x, max_y)
+
+    def digests(self, map_data: MapData, table: ThingTable) -> np.ndarray:
+        layers = getattr(map_data, "m_terrainLayerData", [])
+        index_of = {id(layer): i for i, layer in enumerate(layers)}
+        # terrain tiles carry their layer's parameters, other things 0
+        layer_code = np.zeros(len(table), dtype=np.uint64)
+        for layer, rows in zip(layers, layer_rows(map_data)):
+            layer_code[rows] = layer_digest(layer, index_of)
+        return row_digests([table.x, table.y, table.color, table.draw_layer, table.data_type, table.section, layer_code])
+
+    def export(self, map_data: MapData) -> dict:
+        """
+        Render the map's tiles, reusing the ones whose inputs didn't change since the last export
+        :param map_data: A map loaded with or without a ThingTable
+        :return: Counts of tiles "rendered", "kept" and "removed", and the "seconds" it took
+        """
+        start = time.perf_counter()
+        table = ThingTable.from_map(map_data)
+        # built from the table rather than kept with the map, which may have been edited since
+        index = SpatialIndex(table.x, table.y, table.id)
+        digests = self.digests(map_data, table)
+        origin_x, origin_y, max_zoom, (max_x, max_y) = self.layout(table)
+
+        renderer = self.renderer
+        backdrop = getattr(map_data, "backdropColor", None)
+        settings = repr((
+            PYRAMID_FORMAT, self.tile_pixels, self.scale, origin_x, origin_y, max_zoom,
+            renderer.tile_size, renderer.thing_size,
+            None if backdrop is None else (backdrop.r, backdrop.g, backdrop.b),
+        )).encode()
+        # how far a row's drawing reaches past its location, in map units
+        reach_x = renderer.tile_size[0] // 2 + 1
+        reach_y = renderer.tile_size[1] // 2 + 1
+
+        old = self.read_manifest()["tiles"]
+        tiles = {}
+        stats = {"rendered": 0, "kept": 0, "removed": 0}
+        pixels = self.tile_pixels
+        for zoom in range(max_zoom + 1):
+            scale = self.scale / 2 ** (max_zoom - zoom)
+            units = pixels / scale
+            thing_reach = renderer.thing_size / scale
+            columns = int(np.ceil((max_x - origin_x + 1) / units))
+            rows_of_tiles = int(np.ceil((max_y - origin_y + 1) / units))
+            for ty in range(rows_of_tiles):
+                for tx in range(columns):
+                    left, top = origin_x + tx * units, origin_y + ty * units
+                    rows = index.bbox(
+                        int(np.floor(left - max(reach_x, thing_reach))), int(np.floor(top - max(reach_y, thing_reach))),
+                        int(np.ceil(left + units + max(reach_x, thing_reach))), int(np.ceil(top + units + max(reach_y, thing_reach))),
+                        rows=True,
+                    )
+                    if not len(rows):
+                        continue
+                    key = "{}/{}/{}".format(zoom, tx, ty)
+                    h = hashlib.sha256(settings)
+                    h.update(key.encode())
+                    h.update(digests[rows].tobytes())
+                    inputs = h.hexdigest()
+                    path = os.path.join(self.directory, str(zoom), str(tx), "{}.png".format(ty))
+
+                    entry = old.get(key)
+                    if entry is not None and entry["inputs"] == inputs and os.path.exists(path):
+                        tiles[key] = entry
+                        stats["kept"] += 1
+                        continue
+                    frame = (left, top, scale, pixels, pixels)
+                    image = renderer.render(map_data, frame, table, rows)
+                    self.write_atomic(path, lambda tmp: write_png(tmp, image))
+                    with open(path, "rb") as f:
+                        content = hashlib.sha256(f.read()).hexdigest()
+                    tiles[key] = {"inputs": inputs, "content": content}
+                    stats["rendered"] += 1
+
+        for key in old.keys() - tiles.keys():
+            zoom, tx, ty = key.split("/")
+            try:
+                os.unlink(os.path.join(self.directory, zoom, tx, ty + ".png"))
+            except FileNotFoundError:
+                pass
+            stats["removed"] += 1
+
+        manifest = {
+            "format": PYRAMID_FORMAT,
+            "name": getattr(map_data, "m_name", None),
+            "tile_pixels": pixels,
+            "scale": self.scale,
+            "max_zoom": max_zoom,
+            "origin": [origin_x, origin_y],
+            "tiles": tiles,
+        }
+        def write_manifest(tmp):
+            with open(tmp, "w") as f:
+                json.dump(manifest, f)
+
+        self.write_atomic(self.manifest_path, write_manifest)
+        stats["seconds"] = time.perf_counter() - start
+        return stats
+
+
+# Exports one map file's pyramid into directory/<map file name>, for MapBatch.parse_maps(parse=...)
+# through functools.partial. Never raises for a bad map file.
+def export_file(path: str, directory: str, scale: float = 0.25):
+    from MapBatch import MapSummary, map_name, summary_of
+
+    start = time.perf_counter()
+    size = 0
+    try:
+        size = os.path.getsize(path)
+        map_data = MapData(path, thing_table=ThingTable())
+        TilePyramid(os.path.join(directory, map_name(path)), scale).export(map_data)
+    except Exception as e:
+        return MapSummary(path, size, time.perf_counter() - start, error="{}: {}".format(type(e).__name__, e))
+    return summary_of(map_data, path, size, time.perf_counter() - start)
+
+
+def export_maps(paths: list, directory: str, scale: float = 0.25, workers: int = None, chunksize: int = 4, data_dir: str = None):
+    """
+    Export every map under the given paths as a tile pyramid in directory/<map file name>
+    :param paths: Files, directories or glob patterns, see MapBatch.find_maps
+    :return: The BatchReport
+    :raise ValueError: If two maps have the same name, as their pyramids would overwrite each other
+    """
+    from functools import partial
+    from MapBatch import parse_maps
+
+    os.makedirs(directory, exist_ok=True)
+    return parse_maps(paths, workers=workers, chunksize=chunksize, data_dir=data_dir, unique_names=True,
+                      parse=partial(export_file, directory=directory, scale=scale))
@@ -0,0 +1,172 @@
+import math
+
+import numpy as np
+
+from CaelondianAtlas import MapData, loaded_things
+
+
+# Uniform grid over the locations of a map's things, for range and nearest neighbour queries
+# without scanning every thing. Points are bucketed into square cells and sorted by cell, so
+# each row of cells is one contiguous slice of the sorted points: a query only looks at the
+# slices its rows of cells cover and filters those exactly. Queries return thing ids, or with
+# rows=True the positions of the points, which for a map with a ThingTable are its rows.
+#
+#   index = map_data.spatial_index()
+#   index.bbox(0, 0, 640, 480)
+#   index.radius(320, 240, 100)
+#   index.nearest(320, 240, k=5)
+class SpatialIndex:
+    # average points per cell when no cell size is given
+    points_per_cell = 4
+
+    def __init__(self, x, y, ids, cell_size: int = None, things: list = None):
+        """
+        Build the index
+        :param x: The points' x coordinates
+        :param y: The points' y coordinates
+        :param ids: The thing id of every point
+        :param cell_size: Cell size in map units, by default chosen from the points' extent
+        :param things: The objects behind the points, if any, in the same order
+        """
+        self.x = np.asarray(x, dtype=np.int64)
+        self.y = np.asarray(y, dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.things = things
+        n = len(self.x)
+        if n:
+            self.min_x, self.min_y = int(self.x.min()), int(self.y.min())
+            width = int(self.x.max()) - self.min_x + 1
+            height = int(self.y.max()) - self.min_y + 1
+        else:
+            self.min_x = self.min_y = 0
+            width = height = 1
+        if cell_size is None:
+            cell_size = int(np.ceil(np.sqrt(width * height * self.points_per_cell / max(n, 1))))
+        self.cell_size = max(1, int(cell_size))
+        self.cells_x = (width - 1) // self.cell_size + 1
+        self.cells_y = (height - 1) // self.cell_size + 1
+
+        cells = self.cell_of(self.x, self.y)
+        # points sorted by cell; starts[c]:starts[c + 1] are the points in cell c
+        self.order = np.argsort(cells, kind="stable")
+        self.starts = np.zeros(self.cells_x * self.cells_y + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self.cells_x * self.cells_y), out=self.starts[1:])
+
+    @classmethod
+    def from_map(cls, map_data: MapData, cell_size: int = None):
+        """
+        Index every thing of a map: legacy things, terrain tiles, backdrop flyers and group things
+        :param map_data: A map loaded with or without a ThingTable
+        :param cell_size: Cell size in map units
+        :return: The index
+        """
+        table = map_data.things
+        if table is not None:
+            table.finish()
+            return cls(table.x, table.y, table.id, cell_size)
+        things = [record.thing for record in loaded_things(map_data)]
+        x = np.fromiter((thing.m_location[0] for thing in things), dtype=np.int64, count=len(things))
+        y = np.fromiter((thing.m_location[1] for thing in things), dtype=np.int64, count=len(things))
+        ids = np.fromiter((getattr(thing, "m_id", -1) for thing in things), dtype=np.int64, count=len(things))
+        return cls(x, y, ids, cell_size, things)
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, things: list = None):
+        """
+        Rebuild an index from its arrays, e.g. from a MapCache, without sorting the points again
+        :return: The index
+        """
+        index = cls.__new__(cls)
+        index.x, index.y, index.ids = arrays["x"], arrays["y"], arrays["ids"]
+        index.order, index.starts = arrays["order"], arrays["starts"]
+        index.min_x, index.min_y, index.cell_size, index.cells_x, index.cells_y = (int(v) for v in arrays["grid"])
+        index.things = things
+        return index
+
+    def arrays(self) -> dict:
+        grid = np.array([self.min_x, self.min_y, self.cell_size, self.cells_x, self.cells_y], dtype=np.int64)
+        return {"x": self.x, "y": self.y, "ids": self.ids, "order": self.order, "starts": self.starts, "grid": grid}
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    def cell_of(self, x, y):
+        column = np.clip((np.asarray(x) - self.min_x) // self.cell_size, 0, self.cells_x - 1)
+        row = np.clip((np.asarray(y) - self.min_y) // self.cell_size, 0, self.cells_y - 1)
+        return row * self.cells_x + column
+
+    def candidates(self, min_x, min_y, max_x, max_y) -> np.ndarray:
+        # points in the cells overlapping the box, one slice of the sorted points per row of cells
+        if not len(self) or max_x < min_x or max_y < min_y:
+            return np.empty(0, dtype=np.int64)
+        # the bounds can be floats, as world coordinates are elsewhere
+        size = self.cell_size
+        first_column = max(0, int(math.floor((min_x - self.min_x) / size)))
+        last_column = min(self.cells_x - 1, int(math.floor((max_x - self.min_x) / size)))
+        first_row = max(0, int(math.floor((min_y - self.min_y) / size)))
+        last_row = min(self.cells_y - 1, int(math.floor((max_y - self.min_y) / size)))
+        if first_column > last_column or first_row > last_row:
+            return np.empty(0, dtype=np.int64)
+        starts = self.starts
+        slices = [
+            self.order[starts[row * self.cells_x + first_column]:starts[row * self.cells_x + last_column + 1]]
+            for row in range(first_row, last_row + 1)
+        ]
+        return np.concatenate(slices)
+
+    def result(self, points: np.ndarray, rows: bool):
+        return points if rows else self.ids[points]
+
+    def bbox(self, min_x, min_y, max_x, max_y, rows: bool = False) -> np.ndarray:
+        """
+        Things inside a box, inclusive
+        :param min_x, min_y, max_x, max_y: The box
+        :param rows: Return point positions instead of thing ids
+        :return: An array of thing ids or positions
+        """
+        points = self.candidates(min_x, min_y, max_x, max_y)
+        x, y = self.x[points], self.y[points]
+        points = points[(x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)]
+        return self.result(np.sort(points), rows)
+
+    def radius(self, x, y, r, rows: bool = False) -> np.ndarray:
+        """
+        Things within a distance of a point, inclusive
+        :param x, y: The point
+        :param r: The distance in map units
+        :param rows: Return point positions instead of thing ids
+        :return: An array of thing ids or positions, nearest first
+        """
+        points = self.candidates(int(np.floor(x - r)), int(np.floor(y - r)), int(np.ceil(x + r)), int(np.ceil(y + r)))
+        distances = (self.x[points] - x) ** 2 + (self.y[points] - y) ** 2
+        inside = distances <= r * r
+        points, distances = points[inside], distances[inside]
+        return self.result(points[np.lexsort((points, distances))], rows)
+
+    def nearest(self, x, y, k: int = 1, rows: bool = False) -> np.ndarray:
+        """
+        The k things closest to a point. Ties are broken by position, so results are stable
+        :param x, y: The point
+        :param k: How many things
+        :param rows: Return point positions instead of thing ids
+        :return: An array of up to k thing ids or positions, nearest first
+        """
+        n = len(self)
+        k = min(k, n)
+        if k <= 0:
+            return self.result(np.empty(0, dtype=np.int64), rows)
+        # grow a search radius from the size of the cells that should hold k points
+        r = self.cell_size * max(1.0, np.sqrt(k / self.points_per_cell))
+        while True:
+            points = self.candidates(int(np.floor(x - r)), int(np.floor(y - r)), int(np.ceil(x + r)), int(np.ceil(y + r)))
+            distances = (self.x[points] - x) ** 2 + (self.y[points] - y) ** 2
+            inside = distances <= r * r
+            # every point within r is among the candidates, so k of them inside r are the k nearest
+            if np.count_nonzero(inside) >= k or len(points) == n:
+                break
+            r *= 2
+        order = np.lexsort((points, distances))[:k]
+        return self.result(points[order], rows)
+
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays().values())
@@ -2,7 +2,7 @@ from io import BytesIO
 from enum import IntEnum
 from os.path import isfile
 from random import randbytes
-from struct import pack, unpack, calcsize
+from struct import Struct, pack, unpack, calcsize
 from typing import Union, Callable, BinaryIO
 from hashlib import md5, sha1, sha256, sha512
 from ctypes import Structure, BigEndianStructure, sizeof
@@ -18,6 +18,20 @@ SHA512_DIGEST_LEN = 64
 
 rand_str = lambda n: randbytes(n).hex().upper()
 
+# compiled struct codecs shared by every stream, keyed by endian + format
+codec_cache = {}
+
+def get_codec(fmt: str) -> Struct:
+	"""
+	Get a precompiled struct codec for a format, including its endian prefix
+	:param fmt: The full struct format, e.g. "<i"
+	:return: The cached Struct for that format
+	"""
+	codec = codec_cache.get(fmt)
+	if codec is None:
+		codec = codec_cache[fmt] = Struct(fmt)
+	return codec
+
 class Endian(IntEnum):
 	LITTLE = 0
 	BIG = 1
@@ -67,7 +81,20 @@ class StreamSection:
 class StreamIO:
 	stream = None
 	endian = None
-	labels = {}
+	labels = None
+
+	# precompiled codecs for the current endian
+	sbyte_codec = None
+	byte_codec = None
+	bool_codec = None
+	int16_codec = None
+	uint16_codec = None
+	int32_codec = None
+	uint32_codec = None
+	int64_codec = None
+	uint64_codec = None
+	float32_codec = None
+	float64_codec = None
 
 	# I/O functions
 	read_func = None
@@ -181,6 +208,32 @@ class StreamIO:
 		endians = ["<", ">", "!", "@"]
 		if endian in range(0, len(endians)):
 			self.endian = endians[endian]
+			self.set_codecs()
+
+	def set_codecs(self) -> None:
+		"""
+		Build the primitive codecs for the current endian
+		:return: None
+		"""
+		self.sbyte_codec = self.codec("b")
+		self.byte_codec = self.codec("B")
+		self.bool_codec = self.codec("?")
+		self.int16_codec = self.codec("h")
+		self.uint16_codec = self.codec("H")
+		self.int32_codec = self.codec("i")
+		self.uint32_codec = self.codec("I")
+		self.int64_codec = self.codec("q")
+		self.uint64_codec = self.codec("Q")
+		self.float32_codec = self.codec("f")
+		self.float64_codec = self.codec("d")
+
+	def codec(self, fmt: str) -> Struct:
+		"""
+		Get a precompiled codec for a format in the current endian
+		:param fmt: The struct format without an endian prefix
+		:return: The cached Struct
+		"""
+		return get_codec(f"{self.endian}{fmt}")
 
 	def set_read_func(self, name: str) -> None:  #, *param_types):
 		"""
@@ -330,12 +383,11 @@ class StreamIO:
 		return self.write_func(data)
 
 	def stream_unpack(self, fmt: str) -> (tuple, list):
-		fmt = f"{self.endian}{fmt}"
-		return unpack(fmt, self.read(calcsize(fmt)))
+		codec = self.codec(fmt)
+		return codec.unpack(self.read(codec.size))
 
 	def stream_pack(self, fmt: str, *values) -> int:
-		fmt = f"{self.endian}{fmt}"
-		return self.write(pack(fmt, *values))
+		return self.write(self.codec(fmt).pack(*values))
 
 	def stream_unpack_array(self, t: str, num: int) -> Union[tuple, list]:
 		fmt = f"{self.endian}{num}{t}"
@@ -345,10 +397,16 @@ class StreamIO:
 		fmt = f"{self.endian}{len(values)}{t}"
 		return self.write(pack(fmt, *values))
 
+	def codec_unpack(self, codec: Struct) -> Union[int, float, bool]:
+		(val,) = codec.unpack(self.read_func(codec.size))
+		return val
+
+	def codec_pack(self, codec: Struct, value: Union[int, float, bool]) -> int:
+		return self.write_func(codec.pack(value))
+
 	# bytes
 	def read_sbyte(self) -> int:
-		(val,) = self.stream_unpack("b")
-		return val
+		return self.codec_unpack(self.sbyte_codec)
 
 	def read_sbyte_at(self, offset: int, ret: bool = True) -> int:
 		loc = self.tell()
@@ -370,7 +428,7 @@ class StreamIO:
 		return output
 
 	def write_sbyte(self, value: int) -> int:
-		return self.stream_pack("b", value)
+		return self.codec_pack(self.sbyte_codec, value)
 
 	def write_sbyte_at(self, offset: int, value: int, ret: bool = True) -> int:
 		loc = self.tell()
@@ -393,8 +451,7 @@ class StreamIO:
 
 	# bytes
 	def read_byte(self) -> int:
-		(val,) = self.stream_unpack("B")
-		return val
+		return self.codec_unpack(self.byte_codec)
 
 	read_ubyte = read_byte
 
@@ -420,7 +477,7 @@ class StreamIO:
 	read_ubytes_at = read_bytes_at
 
 	def write_byte(self, value: int):
-		return self.stream_pack("B", value)
+		return self.codec_pack(self.byte_codec, value)
 
 	write_ubyte = write_byte
 
@@ -450,22 +507,20 @@ class StreamIO:
 
 	# boolean
 	def read_bool(self) -> bool:
-		(val,) = self.stream_unpack("?")
-		return val
+		return self.codec_unpack(self.bool_codec)
 
 	def read_bool_array(self, num: int) -> tuple:
 		return self.stream_unpack_array("?", num)
 
 	def write_bool(self, value: bool) -> int:
-		return self.stream_pack("?", value)
+		return self.codec_pack(self.bool_codec, value)
 
 	def write_bool_array(self, values: Union[list, tuple]) -> int:
 		return self.stream_pack_array("?", *values)
 
 	# int16/short
 	def read_int16(self) -> int:
-		(val,) = self.stream_unpack("h")
-		return val
+		return self.codec_unpack(self.int16_codec)
 
 	read_short = read_int16
 
@@ -475,7 +530,7 @@ class StreamIO:
 	read_short_array = read_int16_array
 
 	def write_int16(self, value: int) -> int:
-		return self.stream_pack("h", value)
+		return self.codec_pack(self.int16_codec, value)
 
 	write_short = write_int16
 
@@ -486,8 +541,7 @@ class StreamIO:
 
 	# uint16/ushort
 	def read_uint16(self) -> int:
-		(val,) = self.stream_unpack("H")
-		return val
+		return self.codec_unpack(self.uint16_codec)
 
 	read_ushort = read_uint16
 
@@ -497,7 +551,7 @@ class StreamIO:
 	read_ushort_array = read_uint16_array
 
 	def write_uint16(self, value: int) -> int:
-		return self.stream_pack("H", value)
+		return self.codec_pack(self.uint16_codec, value)
 
 	write_ushort = write_uint16
 
@@ -508,8 +562,7 @@ class StreamIO:
 
 	# int32/int/long
 	def read_int32(self) -> int:
-		(val,) = self.stream_unpack("i")
-		return val
+		return self.codec_unpack(self.int32_codec)
 
 	read_int = read_int32
 	read_long = read_int32
@@ -521,7 +574,7 @@ class StreamIO:
 	read_long_array = read_int32_array
 
 	def write_int32(self, value: int) -> int:
-		return self.stream_pack("i", value)
+		return self.codec_pack(self.int32_codec, value)
 
 	write_int = write_int32
 	write_long = write_int32
@@ -534,8 +587,7 @@ class StreamIO:
 
 	# uint32/uint/ulong
 	def read_uint32(self) -> int:
-		(val,) = self.stream_unpack("I")
-		return val
+		return self.codec_unpack(self.uint32_codec)
 
 	read_uint = read_uint32
 	read_ulong = read_uint32
@@ -547,7 +599,7 @@ class StreamIO:
 	read_ulong_array = read_uint32_array
 
 	def write_uint32(self, value: int) -> int:
-		return self.stream_pack("I", value)
+		return self.codec_pack(self.uint32_codec, value)
 
 	write_uint = write_uint32
 	write_ulong = write_uint32
@@ -560,7 +612,7 @@ class StreamIO:
 
 	# int64/longlong
 	def read_int64(self) -> int:
-		return self.stream_unpack("q")[0]
+		return self.codec_unpack(self.int64_codec)
 
 	read_longlong = read_int64
 
@@ -570,7 +622,7 @@ class StreamIO:
 	read_longlong_array = read_int64_array
 
 	def write_int64(self, value: int) -> int:
-		return self.stream_pack("q", value)
+		return self.codec_pack(self.int64_codec, value)
 
 	write_longlong = write_int64
 
@@ -581,8 +633,7 @@ class StreamIO:
 
 	# uint64/ulonglong
 	def read_uint64(self) -> int:
-		(val,) = self.stream_unpack("Q")
-		return val
+		return self.codec_unpack(self.uint64_codec)
 
 	read_ulonglong = read_uint64
 
@@ -592,7 +643,7 @@ class StreamIO:
 	read_ulonglong_array = read_uint64_array
 
 	def write_uint64(self, value: int) -> int:
-		return self.stream_pack("Q", value)
+		return self.codec_pack(self.uint64_codec, value)
 
 	write_ulonglong = write_uint64
 
@@ -603,8 +654,7 @@ class StreamIO:
 
 	# float32/single
 	def read_float32(self) -> float:
-		(val,) = self.stream_unpack("f")
-		return val
+		return self.codec_unpack(self.float32_codec)
 
 	read_single = read_float32
 
@@ -614,7 +664,7 @@ class StreamIO:
 	read_single_array = read_float32_array
 
 	def write_float32(self, value: float) -> float:
-		return self.stream_pack("f", value)
+		return self.codec_pack(self.float32_codec, value)
 
 	write_single = write_float32
 
@@ -625,8 +675,7 @@ class StreamIO:
 
 	# float64/double
 	def read_float64(self) -> float:
-		(val,) = self.stream_unpack("d")
-		return val
+		return self.codec_unpack(self.float64_codec)
 
 	read_double = read_float64
 
@@ -636,7 +685,7 @@ class StreamIO:
 	read_double_array = read_float64_array
 
 	def write_float64(self, value: float) -> float:
-		return self.stream_pack("d", value)
+		return self.codec_pack(self.float64_codec, value)
 
 	write_double = write_float64
 
@@ -703,7 +752,10 @@ class StreamIO:
 		return sum([self.write_int7(x) for x in values])
 
 	def read_string(self, encoding: str = "utf8") -> str:
-		str_size = self.read_int7()
+		# almost every string is shorter than 128 bytes, so its length prefix is a single byte
+		str_size = self.read_func(1)[0]
+		if str_size & 0x80:
+			str_size = (str_size & 0x7F) | (self.read_int7() << 7)
 		if str_size <= 0:
 			return ""
 		return self.read(str_size).decode(encoding)
@@ -718,8 +770,10 @@ class StreamIO:
 	read_c_str = read_c_string
 
 	def write_string(self, value: str, encoding: str = "utf8") -> int:
-		bw = self.write_int7(len(value))
-		bw += self.write(value.encode(encoding))
+		# the length prefix counts encoded bytes, not characters
+		data = value.encode(encoding)
+		bw = self.write_int7(len(data))
+		bw += self.write(data)
 		return bw
 
 	write_str = write_string
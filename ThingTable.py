@@ -0,0 +1,274 @@
+from array import array
+
+import numpy as np
+
+from CaelondianAtlas import MapThing, DataType, DrawLayer, ThingSection, game_data_of, loaded_things
+
+
+# column name -> (array typecode while filling, NumPy dtype once finished)
+NUMBER_COLUMNS = {
+    "version": ("B", np.uint8),
+    "section": ("B", np.uint8),
+    "group": ("i", np.int32),
+    "layer": ("i", np.int32),
+    "data_type": ("B", np.uint8),
+    "name": ("i", np.int32),
+    "x": ("i", np.int32),
+    "y": ("i", np.int32),
+    "end_x": ("i", np.int32),
+    "end_y": ("i", np.int32),
+    "id": ("i", np.int32),
+    "scale": ("f", np.float32),
+    "angle": ("f", np.float32),
+    "offset_z": ("f", np.float32),
+    "rotation_speed": ("f", np.float32),
+    "health_fraction": ("f", np.float32),
+    "color": ("I", np.uint32),
+    "draw_layer": ("b", np.int8),
+}
+
+# boolean column name -> MapThing attribute
+FLAG_COLUMNS = {
+    "active": "m_active",
+    "activate_when_seen": "m_activateWhenSeen",
+    "requires_solid_ground": "m_requiresSolidGround",
+    "use_target_ai": "m_useTargetAI",
+    "use_move_ai": "m_useMoveAI",
+    "use_attack_ai": "m_useAttackAI",
+    "flip_horizontal": "m_flipHorizontal",
+    "flip_vertical": "m_flipVertical",
+    "drop_loot": "DropLoot",
+    "use_unexplored_hue": "UseUnexploredHue",
+    "walkable": "Walkable",
+    "invulnerable": "Invulnerable",
+    "use_as_fx": "UseAsFx",
+    "fall_in": "FallIn",
+    "flying": "Flying",
+    "give_xp": "GiveXP",
+    "friendly": "Friendly",
+    "parallax": "Parallax",
+    "ignore_grid_manager": "IgnoreGridManager",
+    "wobble": "Wobble",
+}
+
+
+# Packs a Color into one uint32 as 0xRRGGBBAA
+def pack_color(color) -> int:
+    return (color.r << 24) | (color.g << 16) | (color.b << 8) | color.a
+
+
+# Columnar store for the things of one or more maps. Instead of a MapThing object per thing,
+# every field lives in a NumPy array with one row per thing, and names, groups and terrain
+# layers are dictionary encoded into int codes. Pass one to MapData to fill it while parsing:
+#
+#   table = ThingTable()
+#   map_data = MapData(BufferLoadData(path), thing_table=table)
+#   units = table.where(data_type=DataType.UNIT)
+#
+# Only the positional, visual and flag fields are kept; per-thing activation names, id lists,
+# help text and extra group names are dropped.
+class ThingTable:
+    def __init__(self):
+        # dictionary encodings: code -> string lists and string -> code lookups
+        self.names = []
+        self.groups = []
+        self.layers = []
+        self.codes = {"names": {}, "groups": {}, "layers": {}}
+        self.columns = {name: array(spec[0]) for name, spec in NUMBER_COLUMNS.items()}
+        for name in FLAG_COLUMNS:
+            self.columns[name] = array("B")
+        # the growable columns in row order, for append
+        self.number_columns = [self.columns[name] for name in NUMBER_COLUMNS]
+        self.flag_columns = [(self.columns[name], attr) for name, attr in FLAG_COLUMNS.items()]
+        self.finished = False
+
+    @classmethod
+    def from_columns(cls, columns: dict, names: list, groups: list, layers: list):
+        """
+        Rebuild a finished table from its NumPy columns and string tables, e.g. from a MapCache
+        :return: The table
+        """
+        table = cls()
+        table.columns.update(columns)
+        table.names = list(names)
+        table.groups = list(groups)
+        table.layers = list(layers)
+        for kind in table.codes:
+            table.codes[kind] = {value: code for code, value in enumerate(getattr(table, kind))}
+        table.finished = True
+        return table
+
+    @classmethod
+    def from_map(cls, map_data):
+        """
+        The things of a map as a finished table: its own ThingTable if it was loaded with one,
+        otherwise a new table with a row per MapThing, in the order of loaded_things
+        :param map_data: The map
+        :return: The table
+        """
+        if map_data.things is not None:
+            return map_data.things.finish()
+        table = cls()
+        for record in loaded_things(map_data):
+            thing = record.thing
+            group = record.source if record.section == ThingSection.GROUP else None
+            layer = record.source if record.section == ThingSection.TERRAIN else None
+            d = thing.fields()
+            group_code = -1 if group is None else table.encode("groups", group)
+            layer_code = -1 if layer is None else table.encode("layers", layer)
+            table.append(d, getattr(thing, "version", 0), record.section, group_code, layer_code, d.get("data_type", DataType.UNKNOWN))
+        return table.finish()
+
+    def __len__(self) -> int:
+        return len(self.columns["x"])
+
+    def __getattr__(self, name: str):
+        try:
+            return self.__dict__["columns"][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def encode(self, kind: str, value: str) -> int:
+        codes = self.codes[kind]
+        code = codes.get(value)
+        if code is None:
+            table = getattr(self, kind)
+            code = codes[value] = len(table)
+            table.append(value)
+        return code
+
+    def code(self, kind: str, value: str) -> int:
+        # -2 never matches a row, unlike -1 which marks rows without a value
+        return self.codes[kind].get(value, -2)
+
+    def read(self, loader, section: ThingSection, group: str = None, layer: str = None, validate: bool = False, unique: bool = False, known: bool = False) -> range:
+        """
+        Decode an int32 count and that many things into new rows
+        :param loader: The loader positioned at the thing count
+        :param section: The section the things belong to
+        :param group: The name of the group holding the things
+        :param layer: The name of the terrain layer holding the things
+        :param validate: Drop things the game data rejects, as MapData does
+        :param unique: Keep only the first thing with each id, as MapThingGroup does
+        :param known: Drop things of an UNKNOWN data type, as for backdrop flyers
+        :return: The range of rows that were added
+        """
+        if self.finished:
+            raise ValueError("ThingTable is already finished")
+
+        validate_type = game_data_of(loader).validate
+        group_code = -1 if group is None else self.encode("groups", group)
+        layer_code = -1 if layer is None else self.encode("layers", layer)
+        ids = set()
+
+        start = len(self)
+        d = {}
+        for i in range(loader.int()):
+            d.clear()
+            version = loader.int()
+            MapThing.schema.plan(version).decode(loader, d)
+
+            data_type = d.get("data_type", DataType.UNKNOWN)
+            if known and data_type == DataType.UNKNOWN:
+                continue
+            if validate and data_type != DataType.UNKNOWN:
+                data_type = validate_type(data_type, d["m_name"])
+                if data_type is None:
+                    continue
+            if unique:
+                thing_id = d.get("m_id", 0)
+                if thing_id in ids:
+                    continue
+                ids.add(thing_id)
+            self.append(d, version, section, group_code, layer_code, data_type)
+        return range(start, len(self))
+
+    def append(self, d: dict, version: int, section: ThingSection, group_code: int, layer_code: int, data_type: DataType):
+        # adds a row for a thing's decoded fields, a MapThing's __dict__ works as well
+        x, y = d.get("m_location", (0, 0))
+        end_x, end_y = d.get("m_endLocation", (0, 0))
+        color = d.get("Color")
+        draw_layer = d.get("DrawLayer")
+        row = (
+            version,
+            section.value,
+            group_code,
+            layer_code,
+            data_type.value,
+            self.encode("names", d["m_name"]) if "m_name" in d else -1,
+            x,
+            y,
+            end_x,
+            end_y,
+            d.get("m_id", 0),
+            d.get("Scale", 1.0),
+            d.get("Angle", 0.0),
+            d.get("OffsetZ", 0.0),
+            d.get("RotationSpeed", 0.0),
+            d.get("HealthFraction", 1.0),
+            0xFFFFFFFF if color is None else pack_color(color),
+            -1 if draw_layer is None else draw_layer.value,
+        )
+        for column, value in zip(self.number_columns, row):
+            column.append(value)
+        for column, attr in self.flag_columns:
+            column.append(1 if d.get(attr) else 0)
+
+    def finish(self):
+        """
+        Convert the growable columns into NumPy arrays, after which no more rows can be added
+        :return: The table itself
+        """
+        if self.finished:
+            return self
+        for name, (typecode, dtype) in NUMBER_COLUMNS.items():
+            self.columns[name] = np.frombuffer(self.columns[name], dtype=dtype).copy()
+        for name in FLAG_COLUMNS:
+            self.columns[name] = np.frombuffer(self.columns[name], dtype=np.uint8).astype(np.bool_)
+        self.finished = True
+        return self
+
+    def nbytes(self) -> int:
+        """
+        Memory held by the column arrays, not counting the name tables
+        :return: The size in bytes
+        """
+        return sum(column.nbytes if self.finished else column.itemsize * len(column) for column in self.columns.values())
+
+    def where(self, data_type: DataType = None, name: str = None, group: str = None, layer: str = None, section: ThingSection = None, bounds: tuple = None) -> np.ndarray:
+        """
+        Vectorized filter over the finished table
+        :param data_type: Only things of this DataType
+        :param name: Only things with this name
+        :param group: Only things in the group with this name
+        :param layer: Only tiles of the terrain layer with this name
+        :param section: Only things from this section of the map
+        :param bounds: Only things inside (min_x, min_y, max_x, max_y), inclusive
+        :return: Boolean mask over the rows
+        """
+        self.finish()
+        mask = np.ones(len(self), dtype=np.bool_)
+        if data_type is not None:
+            mask &= self.data_type == data_type.value
+        if name is not None:
+            mask &= self.name == self.code("names", name)
+        if group is not None:
+            mask &= self.group == self.code("groups", group)
+        if layer is not None:
+            mask &= self.layer == self.code("layers", layer)
+        if section is not None:
+            mask &= self.section == section.value
+        if bounds is not None:
+            min_x, min_y, max_x, max_y = bounds
+            mask &= (self.x >= min_x) & (self.x <= max_x) & (self.y >= min_y) & (self.y <= max_y)
+        return mask
+
+    def data_types(self, rows=None) -> list:
+        return [DataType(v) for v in (self.data_type if rows is None else self.data_type[rows])]
+
+    def draw_layers(self, rows=None) -> list:
+        return [None if v < 0 else DrawLayer(v) for v in (self.draw_layer if rows is None else self.draw_layer[rows])]
+
+    def thing_names(self, rows=None) -> list:
+        names = self.names
+        return [names[v] if v >= 0 else None for v in (self.name if rows is None else self.name[rows])]
@@ -0,0 +1,165 @@
+# Micro-benchmark for the precompiled StreamIO codecs used by BinaryLoadData.
+#
+# Parses a .map file (or a synthetic stream of MapThings when no file is given) once through
+# a loader that rebuilds the struct format on every primitive read, the way StreamIO used to,
+# and once through the current BinaryLoadData, then reports the cost per decoded field.
+import argparse
+import os
+import re
+import sys
+import time
+from io import BytesIO
+from struct import unpack, calcsize
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from StreamIO import StreamIO
+from CaelondianAtlas import BinaryLoadData, Color, MapData, MapThing
+
+
+# BinaryLoadData as it was before the codecs: every primitive builds its format and calls unpack
+class LegacyLoadData(BinaryLoadData):
+    def stream_unpack(self, fmt):
+        fmt = f"{self.stream.endian}{fmt}"
+        return unpack(fmt, self.stream.read(calcsize(fmt)))
+
+    def unpack(self, codec):
+        # the schema merges runs of scalars into one struct, but StreamIO read each field alone
+        values = []
+        for count, char in re.findall(r"(\d*)(\D)", codec.format[1:]):
+            for i in range(int(count or 1)):
+                values.extend(self.stream_unpack(char))
+        return tuple(values)
+
+    def bool(self):
+        return self.stream_unpack("B")[0]
+
+    def float(self):
+        return self.stream_unpack("f")[0]
+
+    def int(self):
+        return self.stream_unpack("i")[0]
+
+    def int_list(self):
+        return [self.int() for i in range(self.int())]
+
+    def long(self):
+        return self.stream_unpack("q")[0]
+
+    def vector(self):
+        return (self.float(), self.float())
+
+    def color(self):
+        b = self.stream_unpack("B")[0]
+        g = self.stream_unpack("B")[0]
+        r = self.stream_unpack("B")[0]
+        a = self.stream_unpack("B")[0]
+        return Color(r, g, b, a)
+
+
+# Counts primitive reads so the timings can be reported per field
+class CountingLoadData(BinaryLoadData):
+    fields = 0
+
+    def unpack(self, codec):
+        values = BinaryLoadData.unpack(self, codec)
+        self.fields += len(values)
+        return values
+
+    def count(name):
+        method = getattr(BinaryLoadData, name)
+
+        def counted(self, *args):
+            self.fields += 1
+            return method(self, *args)
+
+        return counted
+
+    bool = count("bool")
+    float = count("float")
+    int = count("int")
+    long = count("long")
+    string = count("string")
+    vector = count("vector")
+    color = count("color")
+
+
+def write_things(num: int) -> bytes:
+    stream = StreamIO()
+    stream.write_int32(num)
+    for i in range(num):
+        stream.write_int32(35)
+        stream.write_string("TERRAIN_TILE")
+        stream.write_string("Tile%02d" % (i % 40))
+        stream.write_int32_array([i % 512 * 64, i // 512 * 32])
+        stream.write_bytes(bytes([1, 0]))
+        stream.write_int32_array([0, 0, i, -1])
+        stream.write_string("")
+        stream.write_int32(0)
+        stream.write_byte(0)
+        stream.write_string("")
+        stream.write_bytes(bytes(3))
+        stream.write_int32(0)
+        stream.write_bytes(bytes(2))
+        stream.write_int32(0)
+        stream.write_byte(0)
+        stream.write_int32(0)
+        stream.write_bytes(bytes([255, 255, 255, 255]))
+        stream.write_float32(1.0)
+        stream.write_byte(0)
+        stream.write_float32(1.0)
+        stream.write_bytes(bytes(3))
+        stream.write_float32(0.0)
+        stream.write_string("TERRAIN")
+        stream.write_float32_array([0.0, 0.0])
+        stream.write_byte(0)
+        stream.write_int32(-1)
+        stream.write_float32(0.0)
+        stream.write_string("")
+        stream.write_byte(0)
+        stream.write_int32(0)
+        stream.write_bytes(bytes(5))
+    return stream.getvalue()
+
+
+def parse_things(loader):
+    for i in range(loader.int()):
+        MapThing(loader)
+
+
+def run(loader_type, data: bytes, parse, repeat: int) -> float:
+    best = None
+    for i in range(repeat):
+        loader = loader_type(BytesIO(data))
+        start = time.perf_counter()
+        parse(loader)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-field decode cost before and after the StreamIO codecs.")
+    parser.add_argument("filename", nargs="?", help="a .map file to parse; a synthetic thing stream is used otherwise")
+    parser.add_argument("--things", type=int, default=40000, help="things in the synthetic stream")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.filename:
+        with open(args.filename, "rb") as f:
+            data = f.read()
+        parse = MapData
+    else:
+        data = write_things(args.things)
+        parse = parse_things
+
+    counter = CountingLoadData(BytesIO(data))
+    parse(counter)
+    fields = counter.fields
+
+    before = run(LegacyLoadData, data, parse, args.repeat)
+    after = run(BinaryLoadData, data, parse, args.repeat)
+    print("{:.2f} MB, {} fields".format(len(data) / 1e6, fields))
+    print("before: {:8.3f} s  {:7.1f} ns/field".format(before, before / fields * 1e9))
+    print("after:  {:8.3f} s  {:7.1f} ns/field".format(after, after / fields * 1e9))
+    print("speedup: {:.2f}x".format(before / after))
@@ -0,0 +1,193 @@
+# Parser throughput benchmark.
+#
+# Parses every map of a synthetic corpus (see corpus.py), or the maps given on the command line,
+# and reports MB/s and things/s for the whole file, for saving it again and for each of its big
+# sections: legacy things, spawn data, terrain layers, backdrop flyers and thing groups. Saving
+# must give back the same bytes, also when the terrain tiles were loaded with TileTemplates,
+# and edits to fields the loader normalised must be saved.
+# Sections are located with LazyMapData and decoded on their own, so a section's time doesn't
+# include the rest of the map. Results can be written as JSON and compared against an earlier
+# run:
+#
+#   python benchmarks/bench_parser.py --corpus /tmp/corpus --json before.json
+#   python benchmarks/bench_parser.py --corpus /tmp/corpus --json after.json --baseline before.json
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CaelondianAtlas import BufferLoadData, MapData, LazyMapData, TileTemplates, GameDataManager, DataType, loaded_things
+from MapSchema import saved_values
+from corpus import SCALES, generate_corpus
+
+# report name -> MapData attribute
+SECTIONS = {
+    "legacy_things": "m_things",
+    "spawn_data": "m_spawnPointData",
+    "terrain_layers": "m_terrainLayerData",
+    "backdrop_flyers": "preplacedBackdropFlyers",
+    "thing_groups": "thingGroups",
+}
+
+
+def count_things(name: str, value) -> int:
+    if name == "m_terrainLayerData":
+        # linked layers are already flattened into the list
+        return sum(len(layer.m_tiles) for layer in value)
+    if name == "thingGroups":
+        return sum(len(group.m_things) for group in value)
+    if name == "m_spawnPointData":
+        return 0
+    return len(value)
+
+
+def rates(size: int, things: int, seconds: float) -> dict:
+    seconds = max(seconds, 1e-9)
+    return {
+        "bytes": size,
+        "things": things,
+        "seconds": seconds,
+        "mb_per_s": size / 1e6 / seconds,
+        "things_per_s": things / seconds,
+    }
+
+
+def best_of(repeat: int, run):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        value = run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value
+
+
+def check_edits(path: str):
+    # generators with only obstacle data are loaded as obstacles, and group things are moved to
+    # their group; saving must keep those fields as they were on disk, unless they were edited
+    registry = GameDataManager()
+    registry.add(DataType.GENERATOR, "none")
+    for name in ("Legacy%d" % u for u in range(7)):
+        registry.add(DataType.OBSTACLE, name)
+    for name in ("Unit%d" % u for u in range(7)):
+        registry.add(DataType.OBSTACLE, name)
+    map_data = MapData(path, game_data=registry)
+    for record in loaded_things(map_data):
+        thing = record.thing
+        if "saved_fields" not in thing.__dict__:
+            continue
+        if "data_type" in thing.saved_fields:
+            thing.data_type = DataType.UNIT
+            edited = {"data_type": DataType.UNIT}
+        else:
+            thing.setGroupName("Edited")
+            edited = {"m_groupName": "Edited", "m_groupNames": ["Edited"]}
+        values = saved_values(thing)
+        if any(name in thing.saved_fields and values[name] != value for name, value in edited.items()):
+            raise ValueError("{}: an edit to a field the loader normalised wouldn't be saved".format(path))
+
+
+def bench_map(path: str, repeat: int) -> dict:
+    size = os.path.getsize(path)
+
+    def parse():
+        with BufferLoadData(path) as loader:
+            map_data = MapData(loader)
+            if loader.position() != size:
+                raise ValueError("{}: parser stopped at byte {} of {}".format(path, loader.position(), size))
+        return map_data
+
+    seconds, map_data = best_of(repeat, parse)
+    things = sum(count_things(name, getattr(map_data, name, [])) for name in SECTIONS.values())
+    result = {"path": path, "parse": rates(size, things, seconds), "sections": {}}
+
+    seconds, data = best_of(repeat, map_data.dump)
+    with open(path, "rb") as f:
+        if data != f.read():
+            raise ValueError("{}: saving the map doesn't give back the same bytes".format(path))
+    if MapData(path, tile_templates=TileTemplates()).dump() != data:
+        raise ValueError("{}: saving the map with shared terrain tiles doesn't give back the same bytes".format(path))
+    check_edits(path)
+    result["save"] = rates(size, things, seconds)
+
+    with BufferLoadData(path) as loader:
+        lazy = LazyMapData(loader)
+        result["version"] = lazy.version
+        for section, name in SECTIONS.items():
+            offset = lazy.offsets.get(name)
+            if offset is None:
+                continue
+            kind = lazy.plan.field(name).kind
+            loader.seek(offset)
+            kind.skip(loader)
+            end = loader.position()
+
+            def read():
+                loader.seek(offset)
+                return kind.read(loader, {}) if kind.contextual else kind.read(loader)
+
+            seconds, value = best_of(repeat, read)
+            result["sections"][section] = rates(end - offset, count_things(name, value), seconds)
+    return result
+
+
+def totals(maps: list) -> dict:
+    sums = {}
+    for result in maps:
+        parts = [("parse", result["parse"]), ("save", result["save"])] + list(result["sections"].items())
+        for name, r in parts:
+            s = sums.setdefault(name, [0, 0, 0.0])
+            s[0] += r["bytes"]
+            s[1] += r["things"]
+            s[2] += r["seconds"]
+    return {name: rates(*s) for name, s in sums.items()}
+
+
+def print_report(report: dict, baseline: dict = None):
+    for result in report["maps"]:
+        r = result["parse"]
+        print("{} (v{}): {:.2f} MB, {:,} things, {:.1f} MB/s, {:,.0f} things/s".format(
+            os.path.basename(result["path"]), result["version"], r["bytes"] / 1e6, r["things"], r["mb_per_s"], r["things_per_s"]))
+    print()
+    print("{:<16} {:>10} {:>12} {:>10} {:>14}".format("section", "MB", "things", "MB/s", "things/s"))
+    base = baseline["totals"] if baseline else {}
+    for name, r in report["totals"].items():
+        line = "{:<16} {:>10.2f} {:>12,} {:>10.1f} {:>14,.0f}".format(name, r["bytes"] / 1e6, r["things"], r["mb_per_s"], r["things_per_s"])
+        if name in base:
+            line += "  {:.2f}x".format(r["mb_per_s"] / max(base[name]["mb_per_s"], 1e-9))
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure parser throughput per map section.")
+    parser.add_argument("maps", nargs="*", help=".map files to parse instead of the synthetic corpus")
+    parser.add_argument("--corpus", default=os.path.join("benchmarks", "corpus"), help="where the synthetic corpus is kept")
+    parser.add_argument("--scales", nargs="+", default=["small", "medium"], choices=list(SCALES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    paths = args.maps or generate_corpus(args.corpus, args.scales)
+    maps = [bench_map(path, args.repeat) for path in paths]
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeat": args.repeat,
+        "maps": maps,
+        "totals": totals(maps),
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,298 @@
+# Synthetic .map corpus for the parser benchmarks.
+#
+# Maps are written with StreamIO's write_* methods, field by field in the order of the parser's
+# schemas, so any MapData version from 1 to 32 and any MapThing version from 1 to 35 can be
+# produced. The things of each section cycle through every thing version their section allows.
+#
+#   python benchmarks/corpus.py corpus/ --scales small medium large
+import argparse
+import os
+import sys
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from StreamIO import StreamIO, get_codec
+from MapSchema import ENDIAN, Scalar
+from CaelondianAtlas import (
+    MapData, MapThing, MapThingGroup, TerrainLayerData, BloomSettings, SpawnPointData, SpawnWaveData,
+    SpawnData,
+)
+
+MAP_VERSIONS = range(1, 33)
+THING_VERSIONS = range(1, 36)
+# things in a group are deduplicated by m_id, which only exists from version 4 on
+GROUP_THING_VERSIONS = range(4, 36)
+
+# things per section for each scale
+SCALES = {
+    "small": {"tiles": 1000, "groups": 4, "per_group": 50, "legacy": 1000, "spawns": 4},
+    "medium": {"tiles": 20000, "groups": 20, "per_group": 250, "legacy": 20000, "spawns": 16},
+    "large": {"tiles": 100000, "groups": 50, "per_group": 1000, "legacy": 100000, "spawns": 64},
+    "huge": {"tiles": 400000, "groups": 100, "per_group": 2000, "legacy": 400000, "spawns": 128},
+}
+
+UNIT_TYPES = ("UNIT", "OBSTACLE", "GENERATOR", "LOOT", "SPAWN_POINT", "MAP_AREA")
+
+
+def write_value(stream: StreamIO, kind, value):
+    # scalars take their raw values (colors as BGRA tuples), sections take a function that
+    # writes them, strings and lists of strings or ints are written .NET style
+    if isinstance(kind, Scalar):
+        stream.write_bytes(get_codec(ENDIAN + kind.fmt).pack(*(value if isinstance(value, tuple) else (value,))))
+    elif callable(value):
+        value(stream)
+    elif isinstance(value, str):
+        stream.write_string(value)
+    else:
+        stream.write_int32(len(value))
+        for item in value:
+            if isinstance(item, str):
+                stream.write_string(item)
+            else:
+                stream.write_int32(item)
+
+
+def write_record(stream: StreamIO, schema, version: int, values: dict):
+    if schema.versioned:
+        stream.write_int32(version)
+    for field in schema.plan(version).fields:
+        write_value(stream, field.kind, values[field.name])
+
+
+def write_list(stream: StreamIO, items: list, write):
+    stream.write_int32(len(items))
+    for item in items:
+        write(stream, item)
+
+
+def thing_values(i: int, data_type: str, name: str, group: str = "") -> dict:
+    return {
+        "data_type": data_type,
+        "m_name": name,
+        "m_location": (i % 512 * 64, i // 512 * 32),
+        "m_active": 1,
+        "m_activateWhenSeen": i % 3 == 0,
+        "m_endLocation": (0, 0),
+        "m_id": i,
+        "m_activateOnEnterID": -1,
+        "m_activateOnEnterName": "",
+        "m_activateOnEnterNames": ["trigger%d" % (i % 5)] if i % 10 == 0 else [],
+        "m_requiresSolidGround": 1,
+        "m_groupName": group,
+        "m_useTargetAI": 1,
+        "m_useMoveAI": 1,
+        "m_useAttackAI": 1,
+        "m_flipEffect": 0,
+        "m_flipHorizontal": i % 2,
+        "m_flipVertical": 0,
+        "m_activateOnEnterIDs": [i - 1, i + 1] if i % 10 == 0 else [],
+        "DropLoot": 0,
+        "SortModifier": 0,
+        "Color": (i % 256, 128, 64, 255),
+        "Scale": 1.0,
+        "UseUnexploredHue": 0,
+        "HealthFraction": 1.0,
+        "Walkable": 0,
+        "Invulnerable": 0,
+        "UseAsFx": 0,
+        "RotationSpeed": 0.0,
+        "DrawLayer": "GROUND" if group else "TERRAIN",
+        "OffsetZ": 0.0,
+        "Angle": float(i % 360),
+        "FallIn": 0,
+        "AttachToID": -1,
+        "ActivationRange": 0.0,
+        "HelpTextId": "",
+        "Flying": 0,
+        "m_groupNames": [group] if group else [],
+        "GiveXP": 1,
+        "Friendly": 0,
+        "Parallax": 0,
+        "IgnoreGridManager": 0,
+        "Wobble": 0,
+    }
+
+
+# The same tile over and over, only its location, id and the sign of its zero floats differ.
+# TileTemplates must keep -0.0 and 0.0 apart for such a map to save back byte for byte.
+def signed_zero_values(i: int, data_type: str, name: str, group: str = "") -> dict:
+    values = thing_values(0, data_type, "Tile00", group)
+    values.update({
+        "m_location": (i % 512 * 64, i // 512 * 32),
+        "m_id": i,
+        "OffsetZ": -0.0 if i % 2 else 0.0,
+        "RotationSpeed": -0.0 if i % 4 >= 2 else 0.0,
+    })
+    return values
+
+
+def write_things(stream: StreamIO, count: int, versions, data_types, names, group: str = "", make_values=thing_values):
+    versions = list(versions)
+    stream.write_int32(count)
+    for i in range(count):
+        values = make_values(i, data_types[i % len(data_types)], names[i % len(names)], group)
+        write_record(stream, MapThing.schema, versions[i % len(versions)], values)
+
+
+def write_spawn_point(stream: StreamIO, p: int):
+    def write_spawns(stream):
+        write_list(stream, range(2), lambda stream, k: write_record(stream, SpawnData.schema, 2, {
+            "m_name": "Spawn%d" % k, "m_num": 3, "m_maxAttempts": 5,
+        }))
+
+    def write_waves(stream):
+        write_list(stream, range(2), lambda stream, w: write_record(stream, SpawnWaveData.schema, 2, {
+            "m_minInterval": 1.0, "m_maxInterval": 2.0, "m_spawns": write_spawns, "m_loopToWave": 0,
+            "m_repeatTimes": 1, "m_scale": (1.0, 1.5), "m_firstSpawnMinInterval": 0.5,
+            "m_firstSpawnMaxInterval": 0.75,
+        }))
+
+    write_record(stream, SpawnPointData.schema, 2, {
+        "m_name": "SpawnPoint%d" % p, "m_xOffsetMin": -64, "m_xOffsetMax": 64, "m_yOffsetMin": -32,
+        "m_yOffsetMax": 32, "m_spawnWaves": write_waves, "m_snapHorizontal": 1, "m_snapVertical": 0,
+    })
+
+
+def write_terrain_layer(stream: StreamIO, name: str, tiles: int, linked: list = (), make_values=thing_values):
+    write_record(stream, TerrainLayerData.schema, 7, {
+        "name": name,
+        "color": (200, 180, 160, 255),
+        "m_tiles": lambda stream: write_things(stream, tiles, THING_VERSIONS, ["TERRAIN_TILE"], ["Tile%02d" % t for t in range(40)], make_values=make_values),
+        "m_linkedLayers": lambda stream: write_list(stream, linked, lambda stream, layer: write_terrain_layer(stream, *layer, make_values=make_values)),
+        "m_mask": 0,
+        "m_blendFilter": 2 if linked else 0,
+        "shader": 5,
+        "contrast": 0.1,
+        "saturation": 0.3,
+    })
+
+
+def write_group(stream: StreamIO, g: int, things: int):
+    name = "Group%d" % g
+    write_record(stream, MapThingGroup.schema, 1, {
+        "name": name,
+        "m_things": lambda stream: write_things(stream, things, GROUP_THING_VERSIONS, UNIT_TYPES, ["Unit%d" % u for u in range(7)], name),
+        "m_visible": 1,
+        "m_selectable": 1,
+    })
+
+
+def bloom(name: str):
+    return lambda stream: write_record(stream, BloomSettings.schema, 0, {
+        "name": name, "bloomThreshold": 0.25, "blurAmount": 4.0, "bloomIntensity": 1.25,
+        "baseIntensity": 1.0, "bloomSaturation": 1.0, "baseSaturation": 1.0,
+    })
+
+
+def write_map(version: int = 32, tiles: int = 1000, groups: int = 4, per_group: int = 50, legacy: int = 1000, spawns: int = 4, tile_values=thing_values) -> bytes:
+    """
+    Write a synthetic map. Terrain tiles are split over two layers, the first with a linked
+    layer; legacy things only exist before version 20 and thing groups from version 20 on.
+    :param version: The MapData version, 1 to 32
+    :param tiles: Terrain tiles
+    :param groups: Thing groups
+    :param per_group: Things per group
+    :param legacy: Legacy things
+    :param spawns: Spawn points, each with two waves of two spawns
+    :param tile_values: The field values of terrain tile i, see thing_values
+    :return: The map file's bytes
+    """
+    layers = [
+        ("Layer0", tiles // 2 - tiles // 10, [("Layer0Linked", tiles // 10)]),
+        ("Layer1", tiles - tiles // 2),
+    ]
+    values = {
+        "m_things": lambda stream: write_things(stream, legacy, THING_VERSIONS, UNIT_TYPES, ["Legacy%d" % u for u in range(7)]),
+        "m_spawnPointData": lambda stream: write_list(stream, range(spawns), write_spawn_point),
+        "startingCash": 100,
+        "m_name": "Synthetic%02d" % version,
+        "m_lootTableName": "loot",
+        "PathfinderBonus": 1.0,
+        "scrollSpeed": 2.0,
+        "scrollAngle": 3.0,
+        "m_size": (512, max(1, tiles // 512 + 1)),
+        "MusicName": "music",
+        "AmbienceName": "ambience",
+        "m_terrainLayerData": lambda stream: write_list(stream, layers, lambda stream, layer: write_terrain_layer(stream, *layer, make_values=tile_values)),
+        "m_scripts": ["script"],
+        "backdropTiles": ["tile"],
+        "backdropColumns": 4,
+        "backdropColor": (0, 0, 0, 255),
+        "backdropFlyers": ["flyer"],
+        "backdropFlyerIntervalMin": 1.0,
+        "backdropFlyerIntervalMax": 2.0,
+        "backdropFlyerSpeedMin": 3.0,
+        "backdropFlyerSpeedMax": 4.0,
+        "backdropFlyerColor": (255, 255, 255, 255),
+        "FullBlackTime": 1.0,
+        "FadeInTime": 2.0,
+        "backdropFlyerRefractRate": 1.0,
+        "backdropFlyerRefractAmount": 2.0,
+        "backdropRows": 5,
+        "backdropTileRefractRate": 1.0,
+        "backdropTileRefractAmount": 2.0,
+        "preplacedBackdropFlyers": lambda stream: write_things(stream, 8, THING_VERSIONS, ["BACKDROP_FLYER"], ["flyer"]),
+        "backgroundBloomSetting": bloom("background"),
+        "terrainBloomSetting": bloom("terrain"),
+        "backdropFlyerParallax": 0.5,
+        "tileAssembleSound": "assemble",
+        "terrainType": "HUE",
+        "unexploredColor": (9, 9, 9, 255),
+        "thingGroups": lambda stream: write_list(stream, range(groups), lambda stream, g: write_group(stream, g, per_group)),
+        "brightness": 1.1,
+        "playerStartFall": 1,
+        "unexploredContrast": 0.3,
+        "unexploredSaturation": 0.4,
+        "tilePhaseInTimeMin": 0.1,
+        "tilePhaseInTimeMax": 0.2,
+        "terrainLightTexture": "light",
+        "terrainLightVelocity": (0.5, 0.6),
+        "keepWeapons": 1,
+        "canPlantSeeds": 0,
+        "titleId": "title",
+        "noWeapons": 0,
+        "parallax": 0.9,
+        "backdropSaturaton": 0.8,
+        "cameraLocation": (10.0, 20.0),
+        "cameraZoom": 1.25,
+    }
+    stream = StreamIO()
+    write_record(stream, MapData.schema, version, values)
+    return stream.getvalue()
+
+
+def generate_corpus(directory: str, scales=("small", "medium")) -> list:
+    """
+    Write a corpus: one map per MapData version at the smallest scale, plus a map before
+    (version 19, legacy things) and after (version 32, thing groups) the thing group change
+    at every larger scale, and a small map of signed zero tiles. Existing files are reused.
+    :param directory: Where to write the maps
+    :param scales: Names from SCALES
+    :return: The paths of the maps, in generation order
+    """
+    os.makedirs(directory, exist_ok=True)
+    maps = []
+    for n, scale in enumerate(scales):
+        versions = MAP_VERSIONS if n == 0 else (19, 32)
+        maps.extend(("{}-v{:02d}.map".format(scale, version), partial(write_map, version, **SCALES[scale])) for version in versions)
+    maps.append(("signed-zeros.map", partial(write_map, tile_values=signed_zero_values, **SCALES["small"])))
+    paths = []
+    for name, write in maps:
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            data = write()
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a corpus of synthetic .map files.")
+    parser.add_argument("directory")
+    parser.add_argument("--scales", nargs="+", default=["small", "medium"], choices=list(SCALES))
+    args = parser.parse_args()
+    for path in generate_corpus(args.directory, args.scales):
+        print("{:>12,} {}".format(os.path.getsize(path), path))
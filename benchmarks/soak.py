@@ -0,0 +1,190 @@
+# Soak test for long-running services: loads thousands of maps in one process, through every
+# way of reading a map, and fails unless resident memory and open file descriptors stay flat
+# and every load gives the same result as the first one. It also streams a small and a ten
+# times larger map through iter_things and export_map, and fails unless their peak traced
+# memory is the same.
+#
+#   python benchmarks/soak.py --loads 5000 --threads 4
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CaelondianAtlas import BufferLoadData, MapData, LazyMapData, iter_things
+from MapExport import export_map
+from ThingTable import ThingTable
+from corpus import write_map
+
+
+def resident_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # no procfs, fall back to the peak, which is still flat when nothing leaks
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def open_files() -> int:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return 0
+
+
+def signature(map_data) -> tuple:
+    groups = map_data.thingGroups
+    return (
+        map_data.version,
+        len(map_data.m_things),
+        len(groups),
+        sum(len(group.m_things) for group in groups),
+        sum(len(layer.m_tiles) for layer in map_data.m_terrainLayerData),
+        len(map_data.m_spawnPointData),
+    )
+
+
+# every way of loading a map; each returns the map's signature
+def load_path(path):
+    return signature(MapData(path))
+
+
+def load_buffer(path):
+    with BufferLoadData(path, intern_strings=True) as loader:
+        return signature(MapData(loader))
+
+
+def load_file(path):
+    with open(path, "rb") as f:
+        return signature(MapData(f))
+
+
+def load_lazy(path):
+    with LazyMapData(path) as map_data:
+        return signature(map_data)
+
+
+def load_table(path):
+    with BufferLoadData(path) as loader:
+        map_data = MapData(loader, thing_table=ThingTable())
+    return (map_data.version, len(map_data.things))
+
+
+def load_stream(path):
+    with BufferLoadData(path) as loader:
+        return sum(1 for record in iter_things(loader))
+
+
+def load_save(path):
+    with BufferLoadData(path) as loader:
+        return len(MapData(loader).dump())
+
+
+LOADS = [load_path, load_buffer, load_file, load_lazy, load_table, load_stream, load_save]
+
+
+# the ways of streaming a map that shouldn't hold more than one thing (or one batch) at a time
+def stream_things(path, directory):
+    for record in iter_things(path):
+        pass
+
+
+def stream_export(path, directory):
+    export_map(path, os.path.join(directory, "export"), batch_size=1000)
+
+
+STREAMS = [stream_things, stream_export]
+
+
+def streaming_peaks(directory: str, tiles: int) -> dict:
+    """
+    Write a map with the given number of terrain tiles and trace each way of streaming it
+    :return: Peak traced bytes per stream
+    """
+    path = os.path.join(directory, "stream-{}.map".format(tiles))
+    with open(path, "wb") as f:
+        f.write(write_map(32, tiles=tiles, groups=1, per_group=10, legacy=0, spawns=4))
+    peaks = {}
+    for stream in STREAMS:
+        # the first run builds plans and imports, which aren't part of the map
+        stream(path, directory)
+        tracemalloc.start()
+        try:
+            stream(path, directory)
+            peaks[stream.__name__] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    os.remove(path)
+    return peaks
+
+
+def run(jobs: list, threads: int) -> list:
+    if threads <= 1:
+        return [load(path) for load, path in jobs]
+    with ThreadPoolExecutor(threads) as executor:
+        return list(executor.map(lambda job: job[0](job[1]), jobs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load maps repeatedly and check that memory stays flat.")
+    parser.add_argument("maps", nargs="*", help=".map files to load instead of synthetic ones")
+    parser.add_argument("--loads", type=int, default=3000, help="map loads after the warm up")
+    parser.add_argument("--threads", type=int, default=1, help="load maps from this many threads at once")
+    parser.add_argument("--tolerance", type=float, default=4.0, help="allowed growth of resident memory, in MB")
+    parser.add_argument("--stream-tiles", type=int, default=100000, help="terrain tiles of the larger streamed map, 0 to skip")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = args.maps
+        if not paths:
+            paths = []
+            for version in (12, 19, 20, 32):
+                path = os.path.join(directory, "soak-v{}.map".format(version))
+                with open(path, "wb") as f:
+                    f.write(write_map(version, tiles=400, groups=4, per_group=50, legacy=200, spawns=4))
+                paths.append(path)
+
+        jobs = [(load, path) for path in paths for load in LOADS]
+        expected = run(jobs, 1)
+        # warm up: schema plans, codecs and interpreter caches are built once
+        for i in range(3):
+            run(jobs, args.threads)
+        gc.collect()
+        start_memory = resident_bytes()
+        start_files = open_files()
+
+        start = time.perf_counter()
+        rounds = max(1, args.loads // len(jobs))
+        for i in range(rounds):
+            results = run(jobs, args.threads)
+            if results != expected:
+                raise AssertionError("round {} loaded different maps: {} != {}".format(i, results, expected))
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        growth = (resident_bytes() - start_memory) / 1e6
+        files = open_files() - start_files
+
+        streamed = {}
+        if args.stream_tiles:
+            small = streaming_peaks(directory, args.stream_tiles // 10)
+            large = streaming_peaks(directory, args.stream_tiles)
+            streamed = {name: (small[name], large[name]) for name in small}
+
+    print("{} loads in {:.1f} s, resident memory {:+.2f} MB, open files {:+d}".format(rounds * len(jobs), elapsed, growth, files))
+    if growth > args.tolerance or files > 0:
+        print("FAILED: memory or file descriptors grew across loads")
+        sys.exit(1)
+    for name, (small, large) in streamed.items():
+        print("{}: {:.1f} MB peak at {:,} tiles, {:.1f} MB at {:,}".format(name, small / 1e6, args.stream_tiles // 10, large / 1e6, args.stream_tiles))
+        if (large - small) / 1e6 > args.tolerance:
+            print("FAILED: streaming memory grew with the size of the map")
+            sys.exit(1)
+    print("OK")